@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import json
+import time
+import asyncio
+from typing import List
+from app.node import Node, parse_bootstrap_nodes
+from app.protocol import OP_PING, OP_FIND, OP_STATS, OP_LABELS, decode_contacts
+from app.lookup import Lookup, LookupResult
+from app.chunk import IncomingTransfer
+from app.retry import Retry
+from app import ingest
+from data.config import journal_flush_interval, lookup_timeout, lookup_negative_ttl, chunk_threshold, cache_path_nodes, cache_ttl, cache_min_ttl, chunk_rto, chunk_window, chunk_transfer_timeout, chunk_max_total
+from app.log import get_logger
+
+log = get_logger('node')
+transfer_log = get_logger('transfer')
+
+class NodeProtocol(asyncio.DatagramProtocol):
+	""" Bridge between asyncio datagram endpoint and node message handling """
+	def __init__(self, node):
+		self.node = node
+
+	def connection_made(self, transport):
+		self.node.attach(transport)
+
+	def datagram_received(self, data, addr):
+		try:
+			self.node.receive(data, addr)
+		except Exception as e:
+			""" A bad datagram must not stop the loop """
+			log.exception("datagram_received:: %s", e)
+		self.node.schedule_inbound()
+
+	def error_received(self, exc):
+		log.info("error_received:: %s", exc)
+
+	def connection_lost(self, exc):
+		self.node.transport = None
+
+	def pause_writing(self):
+		self.node.writing_paused = True
+
+	def resume_writing(self):
+		self.node.writing_paused = False
+		self.node.schedule_flush()
+
+class AsyncNode(Node):
+	""" Node running on an asyncio event loop """
+	""" Every handler is dispatched from the loop, pings and lookups are awaitable """
+	transport = None
+	""" Virtual host sharing this process, datagrams to its other nodes skip the network """
+	host = None
+	writing_paused = False
+	flush_scheduled = False
+	inbound_scheduled = False
+
+	def __init__(self, node_id='', port=0):
+		super().__init__(node_id=node_id, port=port)
+		""" Pending pings, nonce -> futures """
+		self.pending_pings = {}
+		""" Pinged address, nonce -> (ip, port) """
+		self.ping_targets = {}
+		""" Pending forwarded lookups, request ID -> futures """
+		self.pending_topics = {}
+		""" Forwarded lookups topic, request ID -> topic """
+		self.forwarded_topics = {}
+		""" Pending iterative lookup queries, request ID -> futures """
+		self.pending_finds = {}
+		""" Lookups in flight, topic -> task """
+		self.inflight_lookups = {}
+		""" Chunked transfers we receive, request ID -> transfer """
+		self.incoming_transfers = {}
+		""" FIND requests whose answer is read as a stream """
+		self.streaming_requests = set()
+		self.poller = None
+		self.shutdown_event = None
+
+	async def start(self):
+		""" Attach node socket to the running loop """
+		loop = asyncio.get_running_loop()
+		await loop.create_datagram_endpoint(lambda: NodeProtocol(self), sock=self.socket)
+		self.poller = asyncio.ensure_future(self.poll_loop())
+
+	def attach(self, transport):
+		""" Send queue writes through the loop transport from now on """
+		self.transport = transport
+		self.send_queue.sendto = transport.sendto
+
+	def stop(self):
+		if self.shutdown_event is not None:
+			self.shutdown_event.set()
+
+	def close(self):
+		if self.poller is not None:
+			self.poller.cancel()
+			self.poller = None
+		if self.transport is not None:
+			self.flush()
+			self.transport.close()
+
+	def send_datagram(self, encoded, target):
+		""" Queue datagram, queue is flushed once per loop iteration """
+		if self.host is not None and self.host.deliver(encoded, target, self):
+			return True
+		if self.transport is None:
+			return super().send_datagram(encoded, target)
+		if not self.send_queue.enqueue(encoded, target):
+			return False
+		self.schedule_flush()
+		return True
+
+	def now(self):
+		""" Loop clock, simulated time on a simulated network """
+		try:
+			return asyncio.get_running_loop().time()
+		except RuntimeError:
+			return super().now()
+
+	def schedule_inbound(self):
+		""" Queued messages are handled a batch per loop iteration, timers and other tasks run in between """
+		if not self.inbound_scheduled and self.receive_queue.depth() > 0:
+			self.inbound_scheduled = True
+			asyncio.get_running_loop().call_soon(self.handle_inbound)
+
+	def handle_inbound(self):
+		self.inbound_scheduled = False
+		try:
+			self.process_inbound()
+		except Exception as e:
+			log.exception("handle_inbound:: %s", e)
+		self.schedule_inbound()
+
+	def schedule_flush(self):
+		if not self.flush_scheduled and not self.writing_paused:
+			self.flush_scheduled = True
+			asyncio.get_running_loop().call_soon(self.flush)
+
+	def flush(self):
+		self.flush_scheduled = False
+		if not self.writing_paused:
+			self.send_queue.flush()
+
+	async def ping(self, node_info, timeout=None):
+		""" Try reach node, returns 0 on success """
+		""" Pong is received on main socket and matched by nonce, so many pings can be in flight """
+		""" Sent again with backoff, timeout caps the whole wait when given """
+		loop = asyncio.get_running_loop()
+		target = (node_info[1], int(node_info[2]))
+		nonce = self.next_request_id()
+		future = loop.create_future()
+		self.pending_pings[nonce] = [future]
+		self.ping_targets[nonce] = target
+
+		request = self.build_message(OP_PING, ping_port=self.node['port'], request_id=nonce)
+		retry = Retry(self.kbuckets.timeout_for(node_info[0]), loop.time(), timeout, request, target)
+		try:
+			if await self.send_with_retries(retry, future) is None:
+				log.info("No response from %s:%s", node_info[1], node_info[2])
+				return -1
+			self.observe_rtt(node_info[0], retry, 'ping')
+			return 0
+		finally:
+			self.forget(self.pending_pings, nonce, future)
+			self.ping_targets.pop(nonce, None)
+
+	async def send_with_retries(self, retry, future):
+		""" Send request until future is resolved, returns its result or None once retry gives up """
+		loop = asyncio.get_running_loop()
+		self.send_message(retry.request, retry.target)
+		while True:
+			done, _ = await asyncio.wait([future], timeout=max(0, retry.deadline - loop.time()))
+			if len(done) > 0:
+				return future.result()
+			if not retry.next(loop.time()):
+				return None
+			self.metrics.inc('request_retries', OP_LABELS[retry.request.op])
+			self.send_message(retry.request, retry.target)
+
+	async def get_topic(self, topic, timeout=lookup_timeout):
+		""" Lookup topic, returns data (or IP:PORT for contacts), None if not found """
+		result = await self.lookup(topic, timeout)
+		if not result.found and result.messages > 0 and result.responses == 0:
+			""" Nobody answered FIND, peers may only speak forwarded GET """
+			return await self.get_topic_forwarded(topic, timeout)
+		return result.value
+
+	async def lookup(self, topic, timeout=lookup_timeout):
+		""" Iterative lookup, returns LookupResult with value and statistics """
+		""" Answered from local table or cache when possible, identical lookups in flight share one query """
+		value = self.find_local(topic)
+		if value is not None:
+			""" Known locally """
+			result = LookupResult(topic)
+			result.found = True
+			result.value = value
+			return result
+
+		hit, value = self.lookup_cache.get(topic)
+		if hit:
+			result = LookupResult(topic)
+			result.found = value is not None
+			result.value = value
+			result.cached = True
+			return result
+
+		if topic not in self.inflight_lookups:
+			task = asyncio.ensure_future(self.run_lookup(topic, timeout))
+			self.inflight_lookups[topic] = task
+			task.add_done_callback(lambda _: self.inflight_lookups.pop(topic, None))
+		""" Shield, a cancelled caller must not cancel the shared lookup """
+		return await asyncio.shield(self.inflight_lookups[topic])
+
+	async def run_lookup(self, topic, timeout):
+		started = time.monotonic()
+		lookup = Lookup(self, topic)
+		try:
+			result = await asyncio.wait_for(lookup.run(), timeout)
+		except asyncio.TimeoutError:
+			log.info("lookup:: Timeout for [%s]", topic)
+			self.metrics.observe('lookup_seconds', time.monotonic() - started, 'timeout')
+			return lookup.result
+
+		if result.found and isinstance(result.value, IncomingTransfer):
+			result.value = await self.wait_transfer(result.value)
+			result.found = result.value is not None
+			result.elapsed = time.monotonic() - started
+
+		self.metrics.observe('lookup_seconds', time.monotonic() - started, 'found' if result.found else 'not_found')
+		if result.found:
+			self.lookup_cache.put(topic, result.value)
+			self.cache_on_path(result)
+		elif result.responses > 0:
+			""" Peers answered and nobody has it """
+			self.lookup_cache.put(topic, None, lookup_negative_ttl)
+		return result
+
+	def cache_on_path(self, result):
+		""" Store found value at the closest path contacts that did not have it """
+		""" Copies far from the topic are hit less often, their lifetime halves per extra bit of distance """
+		if result.holder is None or not isinstance(result.value, str) or len(result.value) > chunk_threshold:
+			return
+		target = int(result.topic, 16)
+		holder_bits = (int(result.holder[0], 16) ^ target).bit_length()
+		path = sorted(result.path, key=lambda contact: int(contact[0], 16) ^ target)
+		for contact in path[:cache_path_nodes]:
+			extra_bits = max(0, (int(contact[0], 16) ^ target).bit_length() - holder_bits)
+			ttl = max(cache_min_ttl, cache_ttl / (1 << min(extra_bits, 32)))
+			self.send_store(contact, result.topic, result.value, ttl)
+			self.metrics.inc('path_caches_sent')
+
+	def replicate_topic(self, topic_id, data, contacts=None):
+		""" With a running loop, find the k closest nodes in the network instead of our table """
+		if contacts is not None or len(data) > chunk_threshold:
+			return super().replicate_topic(topic_id, data, contacts)
+		try:
+			asyncio.get_running_loop()
+		except RuntimeError:
+			return super().replicate_topic(topic_id, data)
+		asyncio.ensure_future(self.replicate_to_closest(topic_id, data))
+		return 0
+
+	async def replicate_to_closest(self, topic_id, data):
+		lookup = Lookup(self, topic_id, find_value=False)
+		try:
+			result = await asyncio.wait_for(lookup.run(), lookup_timeout)
+			closest = result.closest
+		except asyncio.TimeoutError:
+			closest = sorted(lookup.responsive.values(), key=lambda contact: lookup.distance(contact[0]))
+		if len(closest) == 0:
+			""" Nobody answered, fall back on routing table """
+			closest = None
+		super().replicate_topic(topic_id, data, closest)
+
+	async def query_peer(self, contact, topic, timeout=None, streaming=False):
+		""" Send FIND to contact, again with backoff, timeout caps the whole wait when given """
+		""" Returns ('value', data), ('peers', contacts), ('transfer', IncomingTransfer) or None on timeout """
+		loop = asyncio.get_running_loop()
+		request_id = self.next_request_id()
+		future = loop.create_future()
+		self.pending_finds[request_id] = [future]
+		if streaming:
+			self.streaming_requests.add(request_id)
+
+		request = self.build_message(OP_FIND, topic=topic, request_id=request_id)
+		retry = Retry(self.kbuckets.timeout_for(contact[0]), loop.time(), timeout, request, (contact[1], int(contact[2])))
+		try:
+			answer = await self.send_with_retries(retry, future)
+			if answer is not None:
+				self.observe_rtt(contact[0], retry, 'find')
+			return answer
+		finally:
+			self.forget(self.pending_finds, request_id, future)
+			self.streaming_requests.discard(request_id)
+
+	async def add_file(self, source, topic_id=None):
+		""" Reading and hashing run on executor threads, loop keeps serving meanwhile """
+		loop = asyncio.get_running_loop()
+		digest = await loop.run_in_executor(None, ingest.digest, source)
+		return self.publish_digest(digest, topic_id)
+
+	async def query_stats(self, target, timeout=2.0):
+		""" Metrics snapshot of node at target, None if it did not answer """
+		loop = asyncio.get_running_loop()
+		request_id = self.next_request_id()
+		future = loop.create_future()
+		self.pending_finds[request_id] = [future]
+		request = self.build_message(OP_STATS, request_id=request_id)
+		""" Anonymous, a stats client is no routing table candidate """
+		request.sender_id = ''
+		self.send_message(request, target)
+		try:
+			kind, value = await asyncio.wait_for(future, timeout)
+		except asyncio.TimeoutError:
+			return None
+		finally:
+			self.forget(self.pending_finds, request_id, future)
+		if kind == 'transfer':
+			value = await self.wait_transfer(value)
+		return json.loads(value) if value is not None else None
+
+	def handle_stats(self, sender, message):
+		if message.data is not None and message.request_id in self.pending_finds:
+			self.resolve(self.pending_finds, message.request_id, ('value', message.data))
+		else:
+			super().handle_stats(sender, message)
+
+	async def stream_topic(self, topic, timeout=lookup_timeout):
+		""" Async iterator over topic value blocks, large values are never held in full """
+		""" A block is a memoryview only valid until next block is requested """
+		value = self.topics.get_buffer(topic)
+		if value is None:
+			value = self.find_local(topic)
+		if value is None:
+			lookup = Lookup(self, topic, streaming=True)
+			try:
+				result = await asyncio.wait_for(lookup.run(), timeout)
+			except asyncio.TimeoutError:
+				return
+			if not result.found:
+				return
+			value = result.value
+
+		if isinstance(value, IncomingTransfer):
+			async for block in self.stream_transfer(value):
+				yield block
+		elif isinstance(value, memoryview):
+			""" Slice of segment file """
+			yield value
+		else:
+			yield memoryview(value.encode('UTF-8'))
+
+	async def stream_transfer(self, transfer):
+		try:
+			while not transfer.finished():
+				block = transfer.next_block()
+				if block is None:
+					if not await self.wait_progress(transfer):
+						raise TimeoutError("Transfer of [" + str(transfer.topic) + "] stalled")
+					continue
+				yield block
+				transfer.consume()
+				if transfer.consumed % max(1, chunk_window // 4) == 0 or transfer.finished():
+					""" Slots freed, open credit """
+					self.send_ack(transfer)
+		finally:
+			self.incoming_transfers.pop(transfer.transfer_id, None)
+
+	async def wait_transfer(self, transfer):
+		""" Wait for every chunk, returns value or None if sender went silent """
+		try:
+			while not transfer.complete():
+				if not await self.wait_progress(transfer):
+					transfer_log.warning("wait_transfer:: Transfer of [%s] stalled", transfer.topic)
+					return None
+			return transfer.value().decode('UTF-8')
+		finally:
+			self.incoming_transfers.pop(transfer.transfer_id, None)
+
+	async def wait_progress(self, transfer):
+		""" Returns False when no chunk arrived in time """
+		event = asyncio.Event()
+		transfer.on_progress = event.set
+		try:
+			await asyncio.wait_for(event.wait(), chunk_transfer_timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+		finally:
+			transfer.on_progress = None
+
+	def handle_chunk(self, sender, message):
+		transfer = self.incoming_transfers.get(message.request_id)
+		if transfer is None:
+			if message.request_id not in self.pending_finds:
+				return
+			""" First chunk answers the FIND """
+			streaming = message.request_id in self.streaming_requests
+			if not streaming and message.total > chunk_max_total:
+				""" Size comes from the peer, never allocate what it asks for unchecked """
+				transfer_log.warning("handle_chunk:: Dropping %d bytes transfer from %s", message.total, sender[0])
+				self.metrics.inc('transfers_rejected')
+				return
+			transfer = IncomingTransfer(message.request_id, sender, message.topic, message.total, streaming=streaming)
+			self.incoming_transfers[message.request_id] = transfer
+			self.resolve(self.pending_finds, message.request_id, ('transfer', transfer))
+		elif transfer.sender != sender:
+			return
+
+		if transfer.on_chunk(message.seq, message.data):
+			self.send_ack(transfer)
+
+	async def poll_loop(self):
+		""" Chunk retransmissions, routing table maintenance """
+		while True:
+			await asyncio.sleep(chunk_rto / 2)
+			self.poll_transfers()
+			self.maintain_routes()
+			self.maintain_requests()
+			self.maintain_topics()
+			now = time.monotonic()
+			for request_id, transfer in list(self.incoming_transfers.items()):
+				if now - transfer.last_activity > chunk_transfer_timeout:
+					""" Abandoned, e.g. second holder answering the same lookup """
+					del self.incoming_transfers[request_id]
+
+	def refresh_bucket(self, distance):
+		""" Also look up a random ID in bucket range, answers bring fresh contacts """
+		super().refresh_bucket(distance)
+		target = self.kbuckets.random_id_in_bucket(distance)
+		if target not in self.inflight_lookups:
+			asyncio.ensure_future(self.lookup(target))
+
+	async def get_topic_forwarded(self, topic, timeout=2.0):
+		""" Hop by hop lookup (GET relayed with FOR), for nodes not answering FIND """
+		loop = asyncio.get_running_loop()
+		request_id = self.next_request_id()
+		future = loop.create_future()
+		self.pending_topics[request_id] = [future]
+		self.forwarded_topics[request_id] = topic
+
+		cached = super().get_topic(topic, request_id=request_id)
+		if cached is not None:
+			self.forget(self.pending_topics, request_id, future)
+			self.forwarded_topics.pop(request_id, None)
+			return cached
+
+		try:
+			return await asyncio.wait_for(future, timeout)
+		except asyncio.TimeoutError:
+			log.info("get_topic:: Timeout for [%s]", topic)
+			return None
+		finally:
+			self.forget(self.pending_topics, request_id, future)
+			self.forwarded_topics.pop(request_id, None)
+
+	async def get_bootstrap_routes(self, bootstrap_nodes:List[str], timeout=None):
+		""" Register bootstrap nodes, all pings in parallel """
+		""" Returns seeds count, reached count and elapsed seconds """
+		started = time.monotonic()
+		nodes_info = parse_bootstrap_nodes(bootstrap_nodes)
+		statuses = await asyncio.gather(*[self.ping(node_info, timeout) for node_info in nodes_info])
+		return self.bootstrap_report(nodes_info, statuses.count(0), started)
+
+	def handle_pong(self, sender, message):
+		if message.request_id is not None:
+			self.resolve(self.pending_pings, message.request_id, sender)
+		else:
+			""" Peer does not echo nonce, match on address """
+			target = (sender[0], int(message.sender_port))
+			for nonce in [nonce for nonce, ping_target in self.ping_targets.items() if ping_target == target]:
+				self.resolve(self.pending_pings, nonce, sender)
+
+	def handle_found(self, sender, message):
+		if message.origin is None and message.request_id in self.pending_finds:
+			""" Answer to an iterative lookup query """
+			self.resolve(self.pending_finds, message.request_id, ('value', message.data))
+		else:
+			super().handle_found(sender, message)
+
+	def handle_peers(self, sender, message):
+		if message.request_id in self.pending_finds:
+			self.resolve(self.pending_finds, message.request_id, ('peers', decode_contacts(message.data)))
+		else:
+			super().handle_peers(sender, message)
+
+	def add_received_topic(self, sender, message):
+		super().add_received_topic(sender, message)
+		self.resolve_forwarded(message, message.data)
+
+	def handle_not_found(self, sender, message):
+		super().handle_not_found(sender, message)
+		self.resolve_forwarded(message, None)
+
+	def resolve_forwarded(self, message, result):
+		""" Match answer by request ID, legacy peers do not echo it so fall back on topic """
+		if message.request_id is not None:
+			request_ids = [message.request_id]
+		else:
+			request_ids = [request_id for request_id, topic in self.forwarded_topics.items() if topic == message.topic]
+		for request_id in request_ids:
+			self.resolve(self.pending_topics, request_id, result)
+
+	def resolve(self, pending, key, result):
+		for future in pending.pop(key, list()):
+			if not future.done():
+				future.set_result(result)
+
+	def forget(self, pending, key, future):
+		if key in pending and future in pending[key]:
+			pending[key].remove(future)
+			if len(pending[key]) == 0:
+				del pending[key]
+
+	async def serve(self, kbuckets_full_path=''):
+		""" Run node until stop() is called """
+		self.shutdown_event = asyncio.Event()
+		if len(kbuckets_full_path) > 0:
+			""" Storage was loaded at init, pending changes are written before the given table replaces it """
+			self.flush_storage()
+			self.load_storage(kbuckets_full_path)
+
+		await self.start()
+		log.info("Running node %s on UDP port %d", self.node['id'], self.socket.getsockname()[1])
+		self.start_bootstrap()
+		self.metrics.observe('startup_seconds', time.monotonic() - self.started, 'serving')
+
+		flusher = asyncio.ensure_future(self.flush_journal())
+		await self.shutdown_event.wait()
+		flusher.cancel()
+		self.flush_storage()
+		self.dump_metrics()
+		self.close()
+
+	def cold_bootstrap(self):
+		""" In background, node serves while seeds are fetched and pinged """
+		asyncio.ensure_future(self.bootstrap_from_source())
+
+	async def bootstrap_from_source(self):
+		loop = asyncio.get_running_loop()
+		try:
+			""" Bootstrap source is blocking, keep it off the loop """
+			node_info = await loop.run_in_executor(None, self.fetch_bootstrap_nodes)
+			return await self.get_bootstrap_routes(node_info)
+		except Exception as e:
+			log.error("Bootstrap failed: %s", e)
+
+	async def flush_journal(self):
+		""" Write buffered routing and topic changes even when node is idle """
+		while True:
+			await asyncio.sleep(journal_flush_interval)
+			self.flush_storage(due_only=True)
+			self.dump_metrics(due_only=True)
+
+	def run(self, kbuckets_full_path=''):
+		try:
+			asyncio.run(self.serve(kbuckets_full_path))
+		except KeyboardInterrupt:
+			""" Clean shutdown """
+			pass
+
+		self.save_node()
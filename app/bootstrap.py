@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import json
+from data.config import bootstrap_source, bootstrap_fetch_timeout
+from app.journal import atomic_dump
+from app.log import get_logger
+
+log = get_logger('node')
+
+def read_seed_source(source=bootstrap_source, timeout=bootstrap_fetch_timeout):
+	""" Bootstrap nodes as ID|IP|PORT strings """
+	""" Source is a list of seeds, an http(s) URL, or a file path, empty for none """
+	if isinstance(source, (list, tuple)):
+		return list(source)
+	if source == '':
+		return list()
+	if source.startswith('http://') or source.startswith('https://'):
+		""" Imported on use, commands that never fetch do not pay for it """
+		import requests
+		text = requests.get(source, timeout=timeout).text
+	else:
+		with open(source) as source_file:
+			text = source_file.read()
+	return split_seeds(text)
+
+def split_seeds(text):
+	""" ID|IP|PORT separated by ; or new lines """
+	return [seed.strip() for seed in text.replace('\n', ';').split(';') if seed.strip() != '']
+
+def load_seed_cache(filepath):
+	""" Seeds that answered last time we ran """
+	try:
+		with open(filepath) as seeds_file:
+			return [str(seed) for seed in json.load(seeds_file)]
+	except (OSError, ValueError, TypeError):
+		return list()
+
+def save_seed_cache(filepath, contacts):
+	try:
+		atomic_dump([str(contact[0]) + '|' + str(contact[1]) + '|' + str(contact[2]) for contact in contacts], filepath)
+	except OSError:
+		log.error("Could not save seed cache", exc_info=True)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import time
+import collections
+
+class TTLCache:
+	""" Bounded cache, least recently used entries are evicted first """
+	""" Each entry expires after its own time to live """
+	def __init__(self, max_entries, ttl):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		""" key -> (expires_at, value) """
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		""" Returns (hit, value), value may be None for a cached negative result """
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses = self.misses + 1
+			return False, None
+		if entry[0] < time.monotonic():
+			del self.entries[key]
+			self.misses = self.misses + 1
+			return False, None
+		self.entries.move_to_end(key)
+		self.hits = self.hits + 1
+		return True, entry[1]
+
+	def put(self, key, value, ttl=None):
+		if ttl is None:
+			ttl = self.ttl
+		self.entries[key] = (time.monotonic() + ttl, value)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def discard(self, key):
+		self.entries.pop(key, None)
+
+	def stats(self):
+		return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import time
+import struct
+from data.config import chunk_size, chunk_window, chunk_rto, chunk_max_retries
+
+""" Missing chunks listed in an ACK """
+MAX_MISSING = 64
+
+def pack_missing(seqs):
+	return struct.pack('!%dI' % len(seqs), *seqs)
+
+def unpack_missing(data):
+	return struct.unpack('!%dI' % (len(data) // 4), data)
+
+def chunk_count(total, size=chunk_size):
+	""" Empty value still needs one chunk """
+	return max(1, (total + size - 1) // size)
+
+class OutgoingTransfer:
+	""" Sender side of a chunked transfer """
+	""" At most window chunks are in flight, and never past receiver credit """
+	def __init__(self, transfer_id, target, topic, data, size=chunk_size, window=chunk_window):
+		self.transfer_id = transfer_id
+		self.target = target
+		self.topic = topic
+		self.view = memoryview(data)
+		self.total = len(data)
+		self.size = size
+		self.window = window
+		self.count = chunk_count(self.total, size)
+		""" Every chunk below acked was received """
+		self.acked = 0
+		""" Chunks below credit may be sent """
+		self.credit = window
+		""" Next chunk never sent """
+		self.next_seq = 0
+		""" seq -> time sent, chunks in flight """
+		self.in_flight = {}
+		self.retries = 0
+		self.retransmits = 0
+		self.last_ack = time.monotonic()
+
+	def chunk(self, seq):
+		""" Slice of value, no copy """
+		return self.view[seq * self.size:(seq + 1) * self.size]
+
+	def due(self, now):
+		""" Chunks to send now: timed out ones first, then new ones inside window """
+		seqs = list()
+		for seq, sent_at in self.in_flight.items():
+			if now - sent_at >= chunk_rto:
+				seqs.append(seq)
+		if len(seqs) > 0:
+			self.retransmits = self.retransmits + len(seqs)
+			if now - self.last_ack >= chunk_rto:
+				""" Nothing heard since last retransmit round """
+				self.retries = self.retries + 1
+				self.last_ack = now
+
+		limit = min(self.count, self.credit, self.acked + self.window)
+		while self.next_seq < limit:
+			seqs.append(self.next_seq)
+			self.next_seq = self.next_seq + 1
+
+		for seq in seqs:
+			self.in_flight[seq] = now
+		return seqs
+
+	def on_ack(self, next_expected, credit, missing):
+		now = time.monotonic()
+		self.last_ack = now
+		self.retries = 0
+		if next_expected > self.acked:
+			self.acked = min(next_expected, self.count)
+		self.credit = max(self.credit, credit)
+		for seq in list(self.in_flight):
+			if seq < self.acked:
+				del self.in_flight[seq]
+		for seq in missing:
+			if seq in self.in_flight:
+				""" Receiver saw a gap, resend on next poll """
+				self.in_flight[seq] = 0.0
+
+	def done(self):
+		return self.acked >= self.count
+
+	def failed(self):
+		return self.retries > chunk_max_retries
+
+class IncomingTransfer:
+	""" Receiver side of a chunked transfer """
+	""" Chunks are written once, from the datagram, into a preallocated buffer """
+	""" Whole value: buffer holds total bytes """
+	""" Streaming: buffer holds window chunks, a slot is reused once consumer read it """
+	def __init__(self, transfer_id, sender, topic, total, size=chunk_size, window=chunk_window, streaming=False):
+		self.transfer_id = transfer_id
+		self.sender = sender
+		self.topic = topic
+		self.total = total
+		self.size = size
+		self.window = window
+		self.streaming = streaming
+		self.count = chunk_count(total, size)
+		if streaming:
+			self.buffer = bytearray(min(window, self.count) * size)
+		else:
+			self.buffer = bytearray(total)
+		self.view = memoryview(self.buffer)
+		self.received = bytearray(self.count)
+		""" Every chunk below next_expected was received """
+		self.next_expected = 0
+		""" Chunks handed to a streaming consumer """
+		self.consumed = 0
+		self.highest = -1
+		self.duplicates = 0
+		self.last_activity = time.monotonic()
+		""" Called on new data, set by node """
+		self.on_progress = None
+
+	def credit(self):
+		if self.streaming:
+			return self.consumed + self.window
+		return self.count
+
+	def offset(self, seq):
+		if self.streaming:
+			return (seq % self.window) * self.size
+		return seq * self.size
+
+	def chunk_length(self, seq):
+		return min(self.size, self.total - seq * self.size)
+
+	def on_chunk(self, seq, payload):
+		""" Store chunk, returns True when an ACK should be sent """
+		self.last_activity = time.monotonic()
+		if seq >= self.count or seq >= self.credit() or len(payload) != self.chunk_length(seq):
+			return True
+		if seq < self.next_expected or self.received[seq]:
+			""" Our ACK was lost """
+			self.duplicates = self.duplicates + 1
+			return True
+
+		offset = self.offset(seq)
+		self.view[offset:offset + len(payload)] = payload
+		self.received[seq] = 1
+		gap = seq > self.next_expected
+		self.highest = max(self.highest, seq)
+		while self.next_expected < self.count and self.received[self.next_expected]:
+			self.next_expected = self.next_expected + 1
+
+		if self.on_progress is not None:
+			self.on_progress()
+		""" Ack on gap, on completion, and every quarter window """
+		return gap or self.complete() or self.next_expected % max(1, self.window // 4) == 0
+
+	def missing(self):
+		""" Holes between contiguous prefix and highest received chunk """
+		seqs = list()
+		for seq in range(self.next_expected, self.highest):
+			if not self.received[seq]:
+				seqs.append(seq)
+				if len(seqs) >= MAX_MISSING:
+					break
+		return seqs
+
+	def complete(self):
+		return self.next_expected >= self.count
+
+	def finished(self):
+		""" Every chunk received and, when streaming, read """
+		if self.streaming:
+			return self.consumed >= self.count
+		return self.complete()
+
+	def next_block(self):
+		""" Streaming: next chunk in order, None until it arrives """
+		if self.consumed >= self.next_expected:
+			return None
+		offset = self.offset(self.consumed)
+		return self.view[offset:offset + self.chunk_length(self.consumed)]
+
+	def consume(self):
+		""" Streaming: slot of last block may be reused """
+		self.consumed = self.consumed + 1
+
+	def value(self):
+		return bytes(self.buffer)
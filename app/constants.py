@@ -4,3 +4,6 @@
 ANSWER_PING_NEVER = 0
 ANSWER_PING_TRUSTED = 1
 ANSWER_PING_ALWAYS = 2
+
+WIRE_TEXT = 0
+WIRE_BINARY = 1
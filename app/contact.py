@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import socket
+from data.config import rtt_initial_timeout, rtt_min_timeout, rtt_max_timeout
+
+class Contact:
+	""" Routing table entry, reads like an (id, ip, port) tuple """
+	""" ID is kept as raw bytes, an IPv4 address and port are packed in one integer """
+	""" Round trip time is smoothed as TCP does, None until first measured """
+	__slots__ = ('raw', 'endpoint', 'seen', 'srtt', 'rttvar')
+
+	def __init__(self, contact_id, address, port, seen=0.0):
+		self.raw = bytes.fromhex(contact_id)
+		self.endpoint = pack_endpoint(address, int(port))
+		""" Monotonic time contact was last heard of """
+		self.seen = seen
+		self.srtt = None
+		self.rttvar = None
+
+	@property
+	def key(self):
+		""" Integer ID, XOR distance is computed on it """
+		return int.from_bytes(self.raw, 'big')
+
+	def __len__(self):
+		return 3
+
+	def __getitem__(self, index):
+		if index == 0 or index == -3:
+			return self.raw.hex()
+		if isinstance(self.endpoint, int):
+			if index == 1 or index == -2:
+				return socket.inet_ntoa((self.endpoint >> 16).to_bytes(4, 'big'))
+			if index == 2 or index == -1:
+				return self.endpoint & 0xFFFF
+		elif index in (1, 2):
+			return self.endpoint[index - 1]
+		elif index in (-1, -2):
+			return self.endpoint[index]
+		raise IndexError('Contact index out of range')
+
+	def __eq__(self, other):
+		if isinstance(other, (Contact, tuple, list)):
+			return tuple(self) == tuple(other)
+		return NotImplemented
+
+	def __hash__(self):
+		return hash(tuple(self))
+
+	def __repr__(self):
+		return repr(tuple(self))
+
+	def observe_rtt(self, sample):
+		""" New round trip sample (seconds), RFC 6298 gains """
+		if self.srtt is None:
+			self.srtt = sample
+			self.rttvar = sample / 2
+		else:
+			self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+			self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+	def timeout(self):
+		""" Seconds to wait for an answer before sending again """
+		if self.srtt is None:
+			return rtt_initial_timeout
+		return min(rtt_max_timeout, max(rtt_min_timeout, self.srtt + 4 * self.rttvar))
+
+	def latency(self):
+		""" Expected round trip, contacts never measured come last """
+		return self.srtt if self.srtt is not None else rtt_max_timeout
+
+	def to_list(self):
+		""" JSON form, as stored in snapshot and journal """
+		return [self[0], self[1], self[2]]
+
+def pack_endpoint(address, port):
+	""" IPv4 and port as one integer, anything else (IPv6, host name) as a tuple """
+	""" Raises ValueError for a port no datagram can be sent to """
+	if not 0 <= port <= 0xFFFF:
+		raise ValueError("Port out of range " + str(port))
+	try:
+		return (int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big') << 16) | port
+	except (OSError, TypeError):
+		pass
+	return (str(address), port)
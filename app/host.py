@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import asyncio
+from data.config import id_length, ip_address, journal_flush_interval
+from app.async_node import AsyncNode
+from app.log import get_logger
+
+log = get_logger('node')
+
+""" Addresses a local node may be reached at """
+LOCAL_ADDRESSES = ('127.0.0.1', 'localhost', ip_address)
+
+class VirtualHost:
+	""" Many node identities in one process, on one event loop """
+	""" Each node keeps its own UDP socket for remote peers, the loop multiplexes them all """
+	""" Datagrams between nodes of the host are handed over directly, without a syscall """
+	def __init__(self, count=0, port=0):
+		self.nodes = list()
+		""" Port -> node """
+		self.ports = {}
+		""" Datagrams that skipped the network """
+		self.delivered = 0
+		self.shutdown_event = None
+		for index in range(count):
+			self.add_node(port=int(port) + index if int(port) > 0 else 0)
+
+	def add_node(self, node_id='', port=0):
+		if node_id == '':
+			node_id = os.urandom(id_length).hex()
+		node = AsyncNode(node_id=node_id, port=port)
+		node.host = self
+		self.nodes.append(node)
+		self.ports[int(node.node['port'])] = node
+		return node
+
+	def local_node(self, target):
+		if target[0] not in LOCAL_ADDRESSES:
+			return None
+		return self.ports.get(int(target[1]))
+
+	def deliver(self, encoded, target, sender_node):
+		""" Returns False when target is not a started node of this host """
+		node = self.local_node(target)
+		if node is None or node.transport is None:
+			return False
+		sender = ('127.0.0.1', int(sender_node.node['port']))
+		asyncio.get_running_loop().call_soon(self.receive, node, encoded, sender)
+		self.delivered = self.delivered + 1
+		return True
+
+	def receive(self, node, encoded, sender):
+		try:
+			node.handle_message(encoded, sender)
+		except Exception as e:
+			""" Same as a datagram from the socket, must not stop the loop """
+			log.exception("receive:: %s", e)
+
+	async def start(self):
+		for node in self.nodes:
+			await node.start()
+
+	def close(self):
+		for node in self.nodes:
+			node.close()
+
+	async def bootstrap(self, bootstrap_nodes):
+		""" Every node pings seeds, and first node of the host so local nodes know each other """
+		""" Returns one report per node """
+		seeds = list(bootstrap_nodes)
+		if len(self.nodes) > 0:
+			first = self.nodes[0]
+			seeds.append(str(first.node['id']) + '|127.0.0.1|' + str(first.node['port']))
+		return await asyncio.gather(*[node.get_bootstrap_routes([seed for seed in seeds if not seed.startswith(str(node.node['id']) + '|')]) for node in self.nodes])
+
+	async def serve(self):
+		""" Run every node until stop() is called """
+		loop = asyncio.get_running_loop()
+		self.shutdown_event = asyncio.Event()
+		await self.start()
+		log.info("Running %d nodes on UDP ports %s", len(self.nodes), ', '.join(str(port) for port in self.ports))
+		try:
+			""" Bootstrap source is fetched once for the whole host """
+			bootstrap_nodes = await loop.run_in_executor(None, self.nodes[0].fetch_bootstrap_nodes)
+		except Exception as e:
+			log.error("Could not fetch bootstrap nodes: %s", e)
+			bootstrap_nodes = list()
+		await self.bootstrap(bootstrap_nodes)
+
+		flusher = asyncio.ensure_future(self.flush_journal())
+		await self.shutdown_event.wait()
+		flusher.cancel()
+		for node in self.nodes:
+			node.flush_storage()
+			node.dump_metrics()
+		self.close()
+
+	async def flush_journal(self):
+		while True:
+			await asyncio.sleep(journal_flush_interval)
+			for node in self.nodes:
+				node.flush_storage(due_only=True)
+				node.dump_metrics(due_only=True)
+
+	def stop(self):
+		if self.shutdown_event is not None:
+			self.shutdown_event.set()
+
+	def run(self):
+		try:
+			asyncio.run(self.serve())
+		except KeyboardInterrupt:
+			""" Clean shutdown """
+			pass
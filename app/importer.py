@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import csv
+import json
+from app.log import get_logger
+
+log = get_logger('store')
+
+def read_records(filepath, fields):
+	""" Stream records of a file as tuples of fields """
+	""" .csv: one record per row, optional header naming the fields """
+	""" Anything else: JSON lines, an object with the field names or an array in field order """
+	""" Malformed records are logged and skipped """
+	if filepath.lower().endswith('.csv'):
+		return read_csv(filepath, fields)
+	return read_json_lines(filepath, fields)
+
+def read_csv(filepath, fields):
+	with open(filepath, newline='') as records_file:
+		for line_number, row in enumerate(csv.reader(records_file), 1):
+			if line_number == 1 and [column.strip().lower() for column in row] == list(fields):
+				continue
+			if len(row) != len(fields):
+				log.warning("read_records:: Skipping line %d of %s, %d fields expected", line_number, filepath, len(fields))
+				continue
+			yield tuple(column.strip() for column in row)
+
+def read_json_lines(filepath, fields):
+	with open(filepath) as records_file:
+		for line_number, line in enumerate(records_file, 1):
+			if line.strip() == '':
+				continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				log.warning("read_records:: Skipping line %d of %s, not JSON", line_number, filepath)
+				continue
+			if isinstance(record, dict):
+				yield tuple(record.get(field) for field in fields)
+			elif isinstance(record, list) and len(record) == len(fields):
+				yield tuple(record)
+			else:
+				log.warning("read_records:: Skipping line %d of %s, %d fields expected", line_number, filepath, len(fields))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from data.config import ingest_chunk_bytes, ingest_threads, id_length
+
+""" Hashing threads shared by every ingestion, started on first use """
+executor = None
+executor_lock = threading.Lock()
+
+def hashing_executor():
+	global executor
+	with executor_lock:
+		if executor is None:
+			executor = ThreadPoolExecutor(max_workers=ingest_threads, thread_name_prefix='ingest')
+		return executor
+
+def read_chunks(source, chunk_size=ingest_chunk_bytes):
+	""" Bytes of a file path, a file object (binary or text) or an iterable of bytes / str chunks """
+	""" Text is UTF-8 encoded, as topiquify_data does, so a file and the same text argument hash alike """
+	if isinstance(source, (str, os.PathLike)):
+		with open(source, 'rb') as source_file:
+			yield from read_chunks(source_file, chunk_size)
+		return
+	if hasattr(source, 'read'):
+		chunks = iter(lambda: source.read(chunk_size), source.read(0))
+	else:
+		chunks = source
+	for chunk in chunks:
+		yield chunk.encode('UTF-8') if isinstance(chunk, str) else chunk
+
+class Digest:
+	""" SHA-256 of an ingested stream, its size and time taken """
+	__slots__ = ('sha256', 'size', 'seconds')
+
+	def __init__(self, sha256, size, seconds):
+		self.sha256 = sha256
+		self.size = size
+		self.seconds = seconds
+
+	def topic_id(self):
+		""" Content addressed topic ID, hash prefix of node ID length """
+		return self.sha256[:id_length * 2]
+
+	def mb_per_second(self):
+		return self.size / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+def digest(source, chunk_size=ingest_chunk_bytes):
+	""" Hash source chunk by chunk, memory stays at two chunks whatever the size """
+	""" A chunk is hashed on a pool thread while the next one is read, both release the GIL """
+	hasher = hashlib.sha256()
+	size = 0
+	hashing = None
+	started = time.perf_counter()
+	for chunk in read_chunks(source, chunk_size):
+		if hashing is not None:
+			""" Updates of one hash must keep their order """
+			hashing.result()
+		hashing = hashing_executor().submit(hasher.update, chunk)
+		size = size + len(chunk)
+	if hashing is not None:
+		hashing.result()
+	return Digest(hasher.hexdigest(), size, time.perf_counter() - started)
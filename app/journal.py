@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import json
+import time
+from data.config import journal_flush_count, journal_flush_interval
+from app.log import get_logger
+
+log = get_logger('journal')
+
+class Journal:
+	""" Append-only change journal, one JSON record per line """
+	""" Records are buffered and written when count or age threshold is reached """
+	def __init__(self, filepath, flush_count=journal_flush_count, flush_interval=journal_flush_interval):
+		self.filepath = filepath
+		self.flush_count = flush_count
+		self.flush_interval = flush_interval
+		self.pending = list()
+		self.last_flush = time.monotonic()
+		""" Records on disk since last compaction """
+		self.records = 0
+
+	def append(self, record):
+		self.pending.append(record)
+		if len(self.pending) >= self.flush_count \
+		or time.monotonic() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	def extend(self, records):
+		""" Bulk change, written with a single flush """
+		self.pending.extend(records)
+		self.flush()
+
+	def flush(self):
+		""" Write pending records and sync them to disk """
+		self.last_flush = time.monotonic()
+		if len(self.pending) == 0:
+			return
+		lines = ''.join(json.dumps(record) + '\n' for record in self.pending)
+		try:
+			os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+			with open(self.filepath, 'a') as journal_file:
+				journal_file.write(lines)
+				journal_file.flush()
+				os.fsync(journal_file.fileno())
+			self.records = self.records + len(self.pending)
+			self.pending = list()
+		except OSError as e:
+			""" Keep records, next flush will retry """
+			log.error("Could not write journal on disk: %s", e)
+
+	def replay(self):
+		""" Yield records on disk, a torn last line (crash during write) is ignored """
+		self.records = 0
+		try:
+			with open(self.filepath) as journal_file:
+				for line in journal_file:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						break
+					self.records = self.records + 1
+					yield record
+		except FileNotFoundError:
+			return
+
+	def reset(self):
+		""" Drop journal once its records are part of a snapshot """
+		try:
+			os.remove(self.filepath)
+		except FileNotFoundError:
+			pass
+		self.records = 0
+
+def atomic_dump(obj, filepath):
+	""" Write JSON to a temporary file then rename it over target """
+	os.makedirs(os.path.dirname(filepath), exist_ok=True)
+	tmp_filepath = filepath + '.tmp'
+	with open(tmp_filepath, 'w') as tmp_file:
+		json.dump(obj, tmp_file)
+		tmp_file.flush()
+		os.fsync(tmp_file.fileno())
+	os.replace(tmp_filepath, filepath)
@@ -2,32 +2,166 @@
 #encoding: utf-8
 import os
 import json
-from data.config import id_length, group_prefix, max_contact, min_contact, ip_address, answer_ping_behavior, interest_radius
+import time
+import random
+from data.config import id_length, group_prefix, max_contact, min_contact, ip_address, answer_ping_behavior, interest_radius, journal_compact_records, replacement_cache_size, bucket_refresh_interval, contact_stale_after, contact_max_failures, rtt_initial_timeout, rtt_tie_candidates
+from app.trie import XorTrie
+from app.contact import Contact
+from app.journal import Journal, atomic_dump
+from app.metrics import NULL_METRICS
+from app.log import get_logger
 
-class Kbucket:
-	__structure = {}
-	__current_node_id = ''
-	__id_length = 8
+log = get_logger('kbucket')
+
+def contact_key(contact):
+	return contact.key
 
-	def __init__(self, node_id = '', id_length = 8):
+class Kbucket:
+	def __init__(self, node_id = '', id_length = 8, metrics = NULL_METRICS):
+		""" Per instance, several routing tables may live in one process """
+		""" Bucket distance (int) -> contacts, in arrival order """
+		self.__structure = {}
+		self.metrics = metrics
 		self.__current_node_id = node_id
 		self.__id_length = id_length
+		""" XOR index over every contact of the structure, keyed by integer ID """
+		self.__index = XorTrie(key=contact_key)
+		""" Changes since last snapshot, in memory structure is the source of truth """
+		self.__journal = Journal(self.data_path('kbuckets.journal'))
+		""" Workers sharing a node: only one writes to disk, every change is published to others """
+		self.persist = True
+		self.replicate = None
+		""" Bucket distance -> contacts met while bucket was full, most recent last """
+		self.replacements = {}
+		""" Contact ID -> queries left unanswered since last heard """
+		self.failures = {}
+		""" Bucket distance -> monotonic time of last activity """
+		self.bucket_activity = {}
+		""" (id, value) data topics found in files written by older versions """
+		self.data_topics = list()
+		""" Records of a bulk change, persisted once when it ends """
+		self.__batch = None
+
+	def data_path(self, filename):
+		return 'data/' + self.__current_node_id + '/' + filename
 
 	def load_kbuckets(self, filepath=''):
-		""" Load kbuckets from file """
+		""" Load kbuckets snapshot from file, then replay journal """
+		replay_journal = filepath == ''
 		if filepath == '':
-			filepath = 'data/' + self.__current_node_id + '/kbuckets.json'
+			filepath = self.data_path('kbuckets.json')
+		self.__structure = {}
+		self.__index = XorTrie(key=contact_key)
+		self.data_topics = list()
+		self.failures = {}
+		""" Loaded contacts count as just seen """
+		now = time.monotonic()
 		try:
 			with open(filepath) as kbuckets_file:
-				self.__structure = json.load(kbuckets_file)
-				kbuckets_loaded = 1
-		except:
-			""" Init empty kbuckets """
-			for distance in range(0, self.__id_length*8 + 1):
-				self.__structure[distance] = list()
-			pass
+				snapshot = json.load(kbuckets_file)
+		except (OSError, ValueError):
+			""" Empty kbuckets """
+			snapshot = {}
+		for entries in snapshot.values():
+			for entry in entries:
+				self.load_entry(entry, now)
+
+		if replay_journal:
+			for record in self.__journal.replay():
+				self.apply_record(record, now)
+
+		log.info("Kbuckets reloaded, %d entries", len(self.__index))
+
+	def load_entry(self, entry, now):
+		""" Snapshot or journal entry, [id, ip, port] or legacy [id, value] data topic """
+		if len(entry) == 2:
+			self.data_topics.append(tuple(entry))
+			return
+		contact = self.parse(entry[0], entry[1], entry[2])
+		if contact is None:
+			return
+		contact.seen = now
+		existing = self.__index.get(contact.key)
+		if existing is not None:
+			existing.endpoint = contact.endpoint
+			return
+		self.__structure.setdefault(self.distance_from_me(entry[0]), list()).append(contact)
+		self.__index.insert(contact.key, contact)
+
+	def apply_record(self, record, now=None):
+		""" Replay one journal record, replaying twice gives the same membership """
+		if record['op'] == 'add':
+			self.load_entry(record['entry'], time.monotonic() if now is None else now)
+		else:
+			self.remove(record['id'])
 
-		print("Kbuckets reloaded")
+	def journal(self, record):
+		if self.replicate is not None:
+			self.replicate(record)
+		if self.__batch is not None:
+			self.__batch.append(record)
+		else:
+			self.persist_record(record)
+
+	def persist_records(self, records):
+		""" Bulk change: one journal write, or one snapshot when journal would need compaction anyway """
+		if not self.persist or len(records) == 0:
+			return
+		if self.__journal.records + len(self.__journal.pending) + len(records) >= journal_compact_records:
+			self.save()
+		else:
+			self.__journal.extend(records)
+
+	def persist_record(self, record):
+		if not self.persist:
+			return
+		self.__journal.append(record)
+		if self.__journal.records >= journal_compact_records:
+			self.save()
+
+	def apply_update(self, record):
+		""" Change published by another worker, applied without publishing it back """
+		self.apply_record(record)
+		self.persist_record(record)
+
+	def pop_data_topics(self):
+		""" Remove data topics (id, value) stored by older versions, routing table holds peers only """
+		data_topics, self.data_topics = self.data_topics, list()
+		return data_topics
+
+	def parse(self, contact_id, contact_address, contact_port):
+		""" Contact with a hex ID of id_length bytes and a valid port, None if malformed """
+		contact_id = str(contact_id).lower()
+		if len(contact_id) != self.__id_length * 2:
+			return None
+		try:
+			return Contact(contact_id, contact_address, contact_port)
+		except (TypeError, ValueError):
+			return None
+
+	def find(self, contact_id):
+		""" Contact in table, None if unknown """
+		try:
+			return self.__index.get(int(contact_id, 16))
+		except (TypeError, ValueError):
+			return None
+
+	def remove(self, contact_id):
+		""" Drop contact from bucket and index, returns it or None """
+		contact = self.find(contact_id)
+		if contact is None:
+			return None
+		self.__index.remove(contact.key)
+		bucket = self.__structure.get(self.distance_from_me(contact_id))
+		if bucket is not None:
+			bucket.remove(contact)
+			if len(bucket) == 0:
+				del self.__structure[self.distance_from_me(contact_id)]
+		return contact
+
+	def bucket_sizes(self):
+		""" Entries per bucket distance, keys are metric labels """
+		return {str(distance): len(bucket) for distance, bucket in self.__structure.items() if len(bucket) > 0}
 
 	""" Returns distance from current node """
 	def distance_from_me(self, target_id):
@@ -36,53 +170,32 @@ class Kbucket:
 	""" Flatten kbuckets """
 	def get_all_known_nodes(self):
 		all_node = list()
-		for i in self.__structure:
-			for node in self.__structure[i]:
-				all_node.append(node)
-
+		for distance in self.__structure:
+			all_node.extend(self.__structure[distance])
 		return all_node
 
-	""" Get closest node to target node id """
+	def __len__(self):
+		return len(self.__index)
+
+	""" Get closest node to target node id, or a faster one as close in XOR prefix length """
 	""" Returns full node description (id, ip, port) """
 	def get_closest_known_node(self, target_id, allow_matching_exact=True):
-		""" Check if kbuckets exists """
-		if len(self.__structure) == 0:
-			default_path = 'data/' + self.__current_node_id + '/kbuckets.json'
-
-		distance = self.distance_from_me(target_id)
-		""" Get corresponding bucket """
-		if distance in self.__structure:
-			kbucket = self.__structure[distance]
-		else:
-			""" Empty """
-			kbucket = list()
-
-		""" Init to max distance """
-		min = self.__id_length * 8 + 1
-		closest_node = None
-
-		if len(kbucket) > 0:
-			for _node in kbucket:
-				tmp = compute_distance(_node[0], target_id, self.__id_length)
-				if tmp < min:
-					min = tmp
-					closest_node = _node
-		else:
-			""" Check for closest node, without filtering bucket """
-			all_nodes = self.get_all_known_nodes()
-			for _node in all_nodes:
-				tmp = compute_distance(_node[0], target_id, self.__id_length)
-				#print("get_closest_known_node:: Node [" + str(_node[0]) + "] distance: " + str(tmp) + " from destination [" + str(target_id) +  "]")
-				if tmp < min and allow_matching_exact:
-					min = tmp
-					closest_node = _node
-				elif tmp < min and not allow_matching_exact:
-					if tmp == 0:
-						continue
-					else:
-						min = tmp
-						closest_node = _node
-		return closest_node
+		closest = self.get_k_closest(target_id, rtt_tie_candidates, allow_matching_exact)
+		if len(closest) == 0:
+			return None
+		target = int(target_id, 16)
+		prefix = (closest[0].key ^ target).bit_length()
+		""" Stable, closest wins when nothing was measured """
+		return min([contact for contact in closest if (contact.key ^ target).bit_length() == prefix], key=Contact.latency)
+
+	""" Get k closest entries to target id, by increasing XOR distance """
+	def get_k_closest(self, target_id, k, allow_matching_exact=True):
+		closest = self.__index.closest(int(target_id, 16), k, exclude_exact=not allow_matching_exact)
+		return [entry for _, entry in closest]
+
+	""" Get k closest contacts (id, ip, port) to target id """
+	def get_k_closest_contacts(self, target_id, k):
+		return self.get_k_closest(target_id, k)
 
 	def is_contact_node(node_id):
 		return len(node_id) == self.__id_length
@@ -91,75 +204,202 @@ class Kbucket:
 	def is_of_interest(self, topic_id):
 		return self.distance_from_me(topic_id) <= interest_radius
 
-	""" Check if contact exists and return index """
-	def topic_exists(self, contact_id, distance):
-		index = 0
-		kbucket = self.__structure[distance]
-		print("topic_exists:: Loading kbuckets " + str(distance))
-		for contact in kbucket:
-			if contact[0] == contact_id:
-				return index
-			index = index + 1
-
-		return -1
-
 	def register_topic(self, topic_id, data):
+		""" Add or refresh contact, least recently seen contacts are kept when bucket is full """
+		""" Returns least recently seen contact of a full bucket, caller should check it is alive """
 		if topic_id == self.__current_node_id:
-			return
-
-		""" Refresh kbuckets """
-		self.load_kbuckets()
+			return None
+		contact = data if isinstance(data, Contact) else self.parse(*data)
+		if contact is None:
+			log.debug("register_topic:: Ignoring malformed contact %s", data)
+			return None
+		topic_id = contact[0]
 
 		""" Compute distance between nodes (XOR) """
 		distance = self.distance_from_me(topic_id)
-		contact_limit = get_max_bucket_peers(distance, self.__id_length)
-		distance = str(distance)
-		if distance not in self.__structure:
-			print("register_topic:: New bucket for ditance: " + str(distance))
-			self.__structure[distance] = list()
-
-		""" Contact already exists """
-		topic_index = self.topic_exists(topic_id, distance)
-		if topic_index > -1:
-			""" Delete it, it will be added at the end of the list during next step """
-			del self.__structure[distance][topic_index]
-
-		""" We have more than max contact count """
-		if len(self.__structure[distance]) >= contact_limit:
-				del self.__structure[distance][0]
-				self.__structure[distance].append(data)
-		else:
-			self.__structure[distance].append(data)
-
-		print("register_topic:: Registered [" + topic_id + "] - [" + str(data) + "] in kbucket " + str(distance))
-
-		self.save()
+		now = time.monotonic()
+		self.failures.pop(topic_id, None)
+		self.bucket_activity[distance] = now
+
+		existing = self.__index.get(contact.key)
+		if existing is not None:
+			""" Contact already exists, refresh it """
+			existing.seen = now
+			if existing.endpoint != contact.endpoint:
+				existing.endpoint = contact.endpoint
+				""" Measured on another path """
+				existing.srtt = existing.rttvar = None
+				self.journal({'op': 'add', 'bucket': distance, 'entry': existing.to_list()})
+			return None
+
+		bucket = self.__structure.setdefault(distance, list())
+		contact.seen = now
+		if len(bucket) >= get_max_bucket_peers(distance, self.__id_length):
+			""" Bucket is full, long lived contacts are the most likely to stay: new one waits """
+			self.add_replacement(distance, contact)
+			return self.least_recently_seen(distance)
+
+		bucket.append(contact)
+		self.__index.insert(contact.key, contact)
+		self.journal({'op': 'add', 'bucket': distance, 'entry': contact.to_list()})
+
+		log.debug("register_topic:: Registered [%s] in kbucket %d", contact, distance)
+		return None
+
+	def add_replacement(self, distance, contact):
+		replacements = self.replacements.setdefault(distance, list())
+		replacements[:] = [entry for entry in replacements if entry.raw != contact.raw]
+		replacements.append(contact)
+		if len(replacements) > replacement_cache_size:
+			del replacements[0]
+
+	def observe_rtt(self, contact_id, sample):
+		""" Round trip seconds measured on an answer """
+		contact = self.find(contact_id)
+		if contact is not None:
+			contact.observe_rtt(sample)
+
+	def timeout_for(self, contact_id):
+		""" Seconds to wait for contact answer, contacts out of table were never measured """
+		contact = self.find(contact_id)
+		return rtt_initial_timeout if contact is None else contact.timeout()
+
+	def mark_failed(self, contact_id):
+		""" Contact did not answer, evicted after too many failures """
+		""" Returns True when evicted """
+		if self.find(contact_id) is None:
+			""" Not in table, e.g. learned from a lookup answer """
+			return False
+		self.failures[contact_id] = self.failures.get(contact_id, 0) + 1
+		if self.failures[contact_id] >= contact_max_failures:
+			return self.evict_contact(contact_id)
+		return False
+
+	def evict_contact(self, contact_id):
+		""" Drop dead contact, most recently met replacement takes its place """
+		""" Returns True when contact was in table """
+		self.failures.pop(contact_id, None)
+		if self.find(contact_id) is None:
+			return False
+		distance = self.distance_from_me(contact_id)
+		self.try_delete_topic(contact_id)
+		self.metrics.inc('kbucket_evictions')
+		log.debug("evict_contact:: Evicted [%s] from kbucket %d", contact_id, distance)
+		replacements = self.replacements.get(distance)
+		if replacements:
+			replacement = replacements.pop()
+			self.register_topic(replacement[0], replacement)
+			self.metrics.inc('kbucket_replacements')
+		return True
+
+	def is_stale(self, contact_id):
+		""" Contact missed queries, or was not heard of for a long time """
+		if self.failures.get(contact_id, 0) > 0:
+			return True
+		contact = self.find(contact_id)
+		return contact is not None and time.monotonic() - contact.seen > contact_stale_after
+
+	def idle_buckets(self, idle_after=bucket_refresh_interval):
+		""" Distances of non empty buckets without activity for idle_after seconds """
+		now = time.monotonic()
+		idle = list()
+		for distance, bucket in self.__structure.items():
+			if len(bucket) == 0:
+				continue
+			last_activity = self.bucket_activity.setdefault(distance, now)
+			if now - last_activity >= idle_after:
+				idle.append(distance)
+		return idle
+
+	def recently_seen(self, count):
+		""" Responsive contacts, most recently heard of first """
+		contacts = [contact for contact in self.get_all_known_nodes() if contact[0] not in self.failures]
+		contacts.sort(key=lambda contact: contact.seen, reverse=True)
+		now = time.monotonic()
+		return [contact for contact in contacts[:count] if now - contact.seen <= contact_stale_after]
+
+	def least_recently_seen(self, distance):
+		bucket = self.__structure.get(int(distance))
+		if not bucket:
+			return None
+		return min(bucket, key=lambda contact: contact.seen)
+
+	def mark_refreshed(self, distance):
+		self.bucket_activity[int(distance)] = time.monotonic()
+
+	def random_id_in_bucket(self, distance):
+		""" Random ID at given distance from us, to look up when refreshing a bucket """
+		distance = int(distance)
+		if distance == 0:
+			return self.__current_node_id
+		xor = (1 << (distance - 1)) | random.getrandbits(distance - 1) if distance > 1 else 1
+		return format(int(self.__current_node_id, 16) ^ xor, '0' + str(self.__id_length * 2) + 'x')
+
+	def flush(self):
+		""" Write buffered journal records """
+		self.__journal.flush()
+
+	def flush_if_due(self):
+		""" Write buffered journal records older than flush interval """
+		if time.monotonic() - self.__journal.last_flush >= self.__journal.flush_interval:
+			self.flush()
 
 	def save(self):
-		""" Save kbuckets on disk """
+		""" Compact kbuckets into snapshot on disk, atomically replacing previous one """
+		if not self.persist:
+			return
+		self.metrics.inc('kbucket_saves')
 		try:
-			filename = 'data/' + self.__current_node_id + '/kbuckets.json'
-			os.makedirs(os.path.dirname(filename), exist_ok=True)
-			with open(filename, 'w+') as kbuckets_file:
-				json.dump(self.__structure, kbuckets_file)
+			snapshot = {distance: [contact.to_list() for contact in bucket] for distance, bucket in self.__structure.items()}
+			atomic_dump(snapshot, self.data_path('kbuckets.json'))
+			""" Snapshot holds every change, journal can start over """
+			self.__journal.pending = list()
+			self.__journal.reset()
 		except:
-			print("Could not save kbuckets on disk.")
+			log.error("Could not save kbuckets on disk.", exc_info=True)
 			pass
 
 	def try_delete_topic(self, topic_id):
-		distance = self.distance_from_me(topic_id)
-		if distance not in self.__structure:
-			self.__structure[distance] = list()
-		""" Topic already exists """
-		topic_index = self.topic_exists(topic_id, distance)
-		if topic_index > -1:
-			""" Delete it, it will be added at the end of the list during next step """
-			del self.__structure[distance][topic_index]
+		contact = self.remove(topic_id)
+		if contact is not None:
+			self.journal({'op': 'del', 'bucket': self.distance_from_me(topic_id), 'id': contact[0]})
 
 	def register_contact(self, contact_id, contact_address, contact_port):
-		""" Add sender address and port """
+		""" Add sender address and port, returns contact to check as register_topic """
 		contact_info = (contact_id, contact_address, contact_port)
-		self.register_topic(contact_id, contact_info)
+		return self.register_topic(contact_id, contact_info)
+
+	def register_contacts(self, contacts):
+		""" Bulk register_contact, (id, ip, port) entries, invalid ones are skipped """
+		""" Persisted once, contacts of full buckets wait in replacement cache """
+		""" Returns contacts registered """
+		registered = 0
+		self.__batch = list()
+		try:
+			for contact in contacts:
+				contact = parse_contact(contact, self.__id_length)
+				if contact is None:
+					continue
+				if self.register_topic(contact[0], contact) is None and contact[0] != self.__current_node_id:
+					registered = registered + 1
+		finally:
+			records, self.__batch = self.__batch, None
+			self.persist_records(records)
+		log.info("register_contacts:: Registered %d contacts", registered)
+		return registered
+
+def parse_contact(contact, id_length):
+	""" (id, ip, port) with a hex ID of id_length bytes and a valid port, None if malformed """
+	try:
+		contact_id, contact_address, contact_port = contact
+		contact_id = str(contact_id).lower()
+		int(contact_id, 16)
+		contact_port = int(contact_port)
+	except (TypeError, ValueError):
+		return None
+	if len(contact_id) != id_length * 2 or not contact_address or not 0 < contact_port < 65536:
+		return None
+	return (contact_id, str(contact_address), contact_port)
 
 """ Returns max contact per bucket according to distance """
 def get_max_bucket_peers(distance, id_length):
@@ -178,22 +418,7 @@ def get_max_bucket_peers(distance, id_length):
 	return limit
 
 """ Compute distance using integer XOR """
+""" Distance is id bit length minus common prefix length, i.e. bit length of XOR """
 def compute_distance(node1_id, node2_id, id_length):
-	int_node1 = int(node1_id, 16)
-	int_node2 = int(node2_id, 16)
-	int_distance = int_node1 ^ int_node2
-
-	str_distance = "{0:b}".format(int_distance)
-	""" If we don't have bit length, we pad """
-	str_distance = str_distance.zfill(id_length * 8)
-
-	common_prefix_length = 0
-
-	for char in str_distance:
-		if char == '0':
-			common_prefix_length = common_prefix_length + 1
-		else:
-			break
-
-	distance = (id_length * 8) - common_prefix_length
-	return distance
+	int_distance = int(node1_id, 16) ^ int(node2_id, 16)
+	return min(int_distance.bit_length(), id_length * 8)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import sys
+import queue
+import atexit
+import logging
+import itertools
+import logging.handlers
+from data.config import log_level, log_levels, log_sample_rates, log_format
+
+""" Parent of every category logger """
+ROOT = 'kademlia'
+
+""" Background writer, None until setup_logging """
+listener = None
+
+def get_logger(category):
+	""" Category logger, e.g. message, kbucket, transfer """
+	""" Call as log.debug("Sent %s to %s", message, target): arguments are only formatted when record is kept """
+	return logging.getLogger(ROOT + '.' + category)
+
+class SamplingFilter(logging.Filter):
+	""" Keep one record out of rate, warnings and errors always pass """
+	def __init__(self, rate):
+		super().__init__()
+		self.rate = rate
+		self.counter = itertools.count()
+
+	def filter(self, record):
+		return record.levelno >= logging.WARNING or next(self.counter) % self.rate == 0
+
+def setup_logging(level=log_level, levels=log_levels, sample_rates=log_sample_rates, stream=None):
+	""" Caller only queues records, a background thread formats and writes them """
+	""" Records under level, or dropped by sampling, are never formatted """
+	global listener
+	stop_logging()
+	root = logging.getLogger(ROOT)
+	root.setLevel(level)
+	root.propagate = False
+	for category, category_level in levels.items():
+		get_logger(category).setLevel(category_level)
+	for category, rate in sample_rates.items():
+		if rate > 1:
+			get_logger(category).addFilter(SamplingFilter(rate))
+
+	records = queue.SimpleQueue()
+	writer = logging.StreamHandler(stream if stream is not None else sys.stdout)
+	writer.setFormatter(logging.Formatter(log_format))
+	root.addHandler(QueueHandler(records))
+	listener = logging.handlers.QueueListener(records, writer)
+	listener.start()
+	atexit.register(stop_logging)
+	return listener
+
+def stop_logging():
+	""" Write queued records and stop background thread """
+	global listener
+	if listener is None:
+		return
+	listener.stop()
+	listener = None
+	root = logging.getLogger(ROOT)
+	for handler in list(root.handlers):
+		if isinstance(handler, QueueHandler):
+			root.removeHandler(handler)
+	for logger in logging.Logger.manager.loggerDict.values():
+		if isinstance(logger, logging.Logger) and logger.name.startswith(ROOT + '.'):
+			logger.filters = [entry for entry in logger.filters if not isinstance(entry, SamplingFilter)]
+
+class QueueHandler(logging.handlers.QueueHandler):
+	""" Message is assembled in writer thread, arguments are turned to text first as objects may change once queued """
+	def prepare(self, record):
+		if isinstance(record.args, tuple):
+			record.args = tuple(arg if isinstance(arg, (int, float, str)) else str(arg) for arg in record.args)
+		if record.exc_info:
+			""" Traceback objects do not outlive the handler call """
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		return record
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import time
+import asyncio
+from data.config import lookup_alpha, lookup_k, rtt_max_timeout
+
+class LookupResult:
+	""" Value found (None if not found) and lookup statistics """
+	__slots__ = ('topic', 'value', 'found', 'cached', 'holder', 'path', 'closest', 'hops', 'messages', 'responses', 'timeouts', 'elapsed')
+
+	def __init__(self, topic):
+		self.topic = topic
+		self.value = None
+		self.found = False
+		""" Answered from lookup cache """
+		self.cached = False
+		""" Contact that answered with the value """
+		self.holder = None
+		""" Contacts that answered with closer contacts instead of the value """
+		self.path = list()
+		""" k closest contacts that answered """
+		self.closest = list()
+		""" Query rounds """
+		self.hops = 0
+		""" Queries sent """
+		self.messages = 0
+		self.responses = 0
+		self.timeouts = 0
+		""" Seconds """
+		self.elapsed = 0.0
+
+	def stats(self):
+		return {
+			'topic': self.topic,
+			'found': self.found,
+			'cached': self.cached,
+			'hops': self.hops,
+			'messages': self.messages,
+			'responses': self.responses,
+			'timeouts': self.timeouts,
+			'elapsed': self.elapsed,
+		}
+
+class Lookup:
+	""" Client driven iterative lookup """
+	""" Keep k closest known contacts, query alpha of them at once, merge closer contacts """
+	""" they return, stop when a round brings no closer contact and k closest were asked """
+	def __init__(self, node, topic, alpha=lookup_alpha, k=lookup_k, request_timeout=None, streaming=False, find_value=True):
+		self.node = node
+		""" Node lookup only: a value answer does not end it """
+		self.find_value = find_value
+		""" Large values are handed over as a streaming transfer """
+		self.streaming = streaming
+		self.topic = topic
+		self.target = int(topic, 16)
+		self.alpha = alpha
+		self.k = k
+		""" Seconds a peer has to answer, None to derive it from peer round trip time """
+		self.request_timeout = request_timeout
+		""" Contact ID -> contact """
+		self.shortlist = {}
+		self.queried = set()
+		""" Contact ID -> contact, for contacts that answered """
+		self.responsive = {}
+		self.result = LookupResult(topic)
+
+	def distance(self, contact_id):
+		return int(contact_id, 16) ^ self.target
+
+	def merge(self, contacts):
+		for contact in contacts:
+			if contact[0] != self.node.node['id'] and contact[0] not in self.shortlist:
+				self.shortlist[contact[0]] = contact
+
+	def closest(self):
+		""" k closest known contacts """
+		return sorted(self.shortlist.values(), key=lambda contact: self.distance(contact[0]))[:self.k]
+
+	def best_distance(self):
+		closest = self.closest()
+		return self.distance(closest[0][0]) if len(closest) > 0 else None
+
+	def priority(self, contact):
+		known = self.node.kbuckets.find(contact[0])
+		latency = known.latency() if known is not None else rtt_max_timeout
+		return (self.node.kbuckets.is_stale(contact[0]), self.distance(contact[0]).bit_length(), latency)
+
+	async def query(self, contact):
+		self.queried.add(contact[0])
+		self.result.messages = self.result.messages + 1
+		answer = await self.node.query_peer(contact, self.topic, self.request_timeout, self.streaming)
+		if answer is None:
+			self.result.timeouts = self.result.timeouts + 1
+			self.node.kbuckets.mark_failed(contact[0])
+		else:
+			self.result.responses = self.result.responses + 1
+			self.responsive[contact[0]] = contact
+		return contact, answer
+
+	async def run(self):
+		started = time.monotonic()
+		self.merge(self.node.kbuckets.get_k_closest_contacts(self.topic, self.k))
+		progress = True
+
+		while not self.result.found:
+			candidates = [contact for contact in self.closest() if contact[0] not in self.queried]
+			if len(candidates) == 0:
+				break
+			if progress:
+				""" Recently responsive contacts first, stale ones when nothing else is left """
+				""" Among contacts sharing XOR prefix length with the target, fastest first """
+				candidates = sorted(candidates, key=self.priority)[:self.alpha]
+			""" Else previous round brought nothing closer, ask every remaining k closest """
+
+			best = self.best_distance()
+			self.result.hops = self.result.hops + 1
+			answers = await asyncio.gather(*[self.query(contact) for contact in candidates])
+
+			for contact, answer in answers:
+				if answer is None:
+					continue
+				kind, payload = answer
+				if kind in ('value', 'transfer'):
+					if self.find_value and not self.result.found:
+						""" Transfer is completed by caller """
+						self.result.value = payload
+						self.result.found = True
+						self.result.holder = contact
+				else:
+					self.result.path.append(contact)
+					self.merge(payload)
+			progress = self.best_distance() < best
+
+		self.result.closest = sorted(self.responsive.values(), key=lambda contact: self.distance(contact[0]))[:self.k]
+		self.result.elapsed = time.monotonic() - started
+		return self.result
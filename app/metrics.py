@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import bisect
+import collections
+from data.config import metrics_enabled
+
+""" Prometheus metric name prefix """
+PREFIX = 'kademlia_'
+""" Label name per metric, 'label' when not listed """
+LABEL_NAMES = {
+	'messages_received': 'op',
+	'messages_sent': 'op',
+	'handler_seconds': 'op',
+	'lookup_seconds': 'result',
+	'routing_table_contacts': 'distance',
+	'inbound_rate_limited': 'op',
+	'inbound_queue_dropped': 'op',
+	'request_retries': 'op',
+}
+""" Seconds, upper bounds of histogram buckets """
+SECONDS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class Histogram:
+	""" Observation count per bucket, bucket i counts values <= bounds[i], last one the rest """
+	__slots__ = ('bounds', 'counts', 'sum', 'count')
+
+	def __init__(self, bounds=SECONDS_BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.sum = self.sum + value
+		self.count = self.count + 1
+
+	def snapshot(self):
+		return {'bounds': list(self.bounds), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+class Metrics:
+	""" Counters, histograms and gauges of one node """
+	""" Disabled metrics return on first line, gauges are only read on snapshot """
+	def __init__(self, enabled=metrics_enabled):
+		self.enabled = enabled
+		""" (name, label) -> value """
+		self.counters = collections.defaultdict(int)
+		""" (name, label) -> Histogram """
+		self.histograms = {}
+		""" name -> function returning {label: value} """
+		self.gauges = {}
+
+	def inc(self, name, label='', amount=1):
+		if not self.enabled:
+			return
+		self.counters[(name, label)] += amount
+
+	def observe(self, name, value, label=''):
+		if not self.enabled:
+			return
+		histogram = self.histograms.get((name, label))
+		if histogram is None:
+			histogram = self.histograms[(name, label)] = Histogram()
+		histogram.observe(value)
+
+	def gauge(self, name, function):
+		self.gauges[name] = function
+
+	def snapshot(self):
+		""" JSON friendly, name -> label -> value """
+		snapshot = {'counters': {}, 'histograms': {}, 'gauges': {}}
+		for (name, label), value in self.counters.items():
+			snapshot['counters'].setdefault(name, {})[label] = value
+		for (name, label), histogram in self.histograms.items():
+			snapshot['histograms'].setdefault(name, {})[label] = histogram.snapshot()
+		if self.enabled:
+			for name, function in self.gauges.items():
+				snapshot['gauges'][name] = {str(label): value for label, value in function().items() if isinstance(value, (int, float))}
+		return snapshot
+
+""" Shared by components created without node metrics """
+NULL_METRICS = Metrics(enabled=False)
+
+def prometheus_text(snapshot):
+	""" Snapshot in Prometheus text exposition format """
+	lines = list()
+	for name, values in sorted(snapshot['counters'].items()):
+		lines.append('# TYPE ' + PREFIX + name + '_total counter')
+		for label, value in sorted(values.items()):
+			lines.append(PREFIX + name + '_total' + labels(name, label) + ' ' + str(value))
+	for name, values in sorted(snapshot['histograms'].items()):
+		lines.append('# TYPE ' + PREFIX + name + ' histogram')
+		for label, histogram in sorted(values.items()):
+			cumulative = 0
+			for bound, count in zip(histogram['bounds'] + ['+Inf'], histogram['counts']):
+				cumulative = cumulative + count
+				lines.append(PREFIX + name + '_bucket' + labels(name, label, ('le', str(bound))) + ' ' + str(cumulative))
+			lines.append(PREFIX + name + '_sum' + labels(name, label) + ' ' + repr(histogram['sum']))
+			lines.append(PREFIX + name + '_count' + labels(name, label) + ' ' + str(histogram['count']))
+	for name, values in sorted(snapshot['gauges'].items()):
+		lines.append('# TYPE ' + PREFIX + name + ' gauge')
+		for label, value in sorted(values.items()):
+			lines.append(PREFIX + name + labels(name, label) + ' ' + str(value))
+	return '\n'.join(lines) + '\n'
+
+def labels(name, label, extra=None):
+	pairs = list()
+	if label != '':
+		pairs.append((LABEL_NAMES.get(name, 'label'), label))
+	if extra is not None:
+		pairs.append(extra)
+	if len(pairs) == 0:
+		return ''
+	return '{' + ','.join(key + '="' + value + '"' for key, value in pairs) + '}'
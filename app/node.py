@@ -6,25 +6,44 @@ import os
 import errno
 import socket
 import select
-import base64
+import time
+import struct
+import random
 import hashlib
-import requests
+import itertools
 from typing import List
-from data.config import id_length, group_prefix, max_contact, min_contact, ip_address, answer_ping_behavior, interest_radius
+from data.config import receive_batch_size, rate_limit_key, id_length, group_prefix, max_contact, min_contact, ip_address, answer_ping_behavior, interest_radius, send_batch_size, journal_flush_interval, default_wire_format, lookup_k, lookup_cache_size, lookup_cache_ttl, lookup_negative_ttl, chunk_threshold, chunk_rto, contact_check_timeout, replication_factor, topic_expiry, republish_interval, metrics_file, metrics_dump_interval, stats_allowed_addresses, bootstrap_source, seed_cache_size, warm_start_checks, forward_timeout_factor
 from app.kbucket import Kbucket
+from app.transport import SendQueue, ReceiveQueue, RateLimiter, is_address
+from app.protocol import *
+from app.cache import TTLCache
+from app.store import TopicStore
+from app.chunk import OutgoingTransfer, pack_missing, unpack_missing
+from app.retry import Retry
+from app import ingest
+from app.metrics import Metrics, prometheus_text
+from app.bootstrap import read_seed_source, load_seed_cache, save_seed_cache
+from app.log import get_logger
 from app.constants import *
 
+log = get_logger('node')
+message_log = get_logger('message')
+lookup_log = get_logger('lookup')
+transfer_log = get_logger('transfer')
+
 class Node:
 	""" Try load node and context """
 	node_loaded = 0
 	kbuckets_loaded = 0
 	socket = None
+	send_queue = None
+	""" When set, queued datagrams are flushed by the run loop """
+	batching = False
 
-	kbuckets = Kbucket(node_id='', id_length=id_length)
-	node = {}
-
-	def __init__(self, node_id='', port=0):
+	def __init__(self, node_id='', port=0, reuse_port=False):
 		""" Load node configuration from file """
+		""" Per instance, several nodes may live in one process """
+		self.node = {}
 		if node_id == '':
 			try:
 				with open('data/node.json') as node_file:
@@ -47,13 +66,80 @@ class Node:
 			port = int(self.node['port'])
 
 		""" Initialize socket """
+		self.bind(port, reuse_port)
+
+		""" Outbound datagrams go through the bound socket """
+		self.send_queue = SendQueue(self.socket.sendto)
+		""" Inbound datagrams from the socket are rate limited per peer and queued """
+		self.receive_queue = ReceiveQueue()
+		self.rate_limiter = RateLimiter()
+
+		""" Wire format per peer address """
+		self.peer_formats = {}
+		""" Request IDs, echoed by peers in their answers """
+		self.request_ids = itertools.count(random.getrandbits(32))
+		""" Recent lookup results, None for not found """
+		self.lookup_cache = TTLCache(lookup_cache_size, lookup_cache_ttl)
+		""" Opcode dispatch table """
+		self.handlers = {
+			OP_WHO: self.handle_who,
+			OP_PING: self.send_pong,
+			OP_PONG: self.handle_pong,
+			OP_GET: self.send_topic,
+			OP_TOP: self.handle_found,
+			OP_NOP: self.handle_nop,
+			OP_ROUT: self.handle_route_information,
+			OP_INFO: self.handle_topic_information,
+			OP_FIND: self.handle_find,
+			OP_PEERS: self.handle_peers,
+			OP_CHUNK: self.handle_chunk,
+			OP_ACK: self.handle_ack,
+			OP_STATS: self.handle_stats,
+			OP_STORE: self.handle_store,
+		}
+		""" Chunked transfers we send, (address, request ID) -> transfer """
+		self.outgoing_transfers = {}
+		""" Contacts pinged before eviction, contact ID -> Retry """
+		self.liveness_checks = {}
+		""" Forwarded GETs we sent, request ID -> Retry """
+		self.pending_gets = {}
+		self.last_republish = time.monotonic()
+		""" Startup timing, reported once the first request is served """
+		self.started = time.monotonic()
+		self.first_request = None
+		""" Warm start: when validation pings are over, empty table falls back to bootstrap source """
+		self.bootstrap_deadline = None
+		""" Liveness checks answered during warm start, loaded contacts count as seen so they cannot tell """
+		self.warm_start_answers = 0
+
+		""" Counters and histograms, shared with routing table and topic store """
+		self.metrics = Metrics()
+		self.last_metrics_dump = time.monotonic()
+
+		""" Initialize kbucket and topic store """
+		self.kbuckets = Kbucket(node_id=self.node['id'], id_length=id_length, metrics=self.metrics)
+		self.topics = TopicStore(node_id=self.node['id'], metrics=self.metrics)
+		self.load_storage()
+
+		self.metrics.gauge('routing_table_contacts', self.kbuckets.bucket_sizes)
+		self.metrics.gauge('topic_store', self.topics.stats)
+		self.metrics.gauge('send_queue', self.send_queue.stats)
+		self.metrics.gauge('receive_queue', self.receive_queue.stats)
+		self.metrics.gauge('rate_limiter', self.rate_limiter.stats)
+		self.metrics.gauge('lookup_cache', self.lookup_cache.stats)
+
+	def bind(self, port, reuse_port=False):
+		""" Open node UDP socket, random port when port is 0 """
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+		if reuse_port:
+			""" Several worker processes bind the same port, kernel spreads datagrams between them """
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
 		try:
 			self.socket.bind((ip_address,port))
 		except socket.error as e:
 			if e.errno == errno.EADDRINUSE:
-				print("Port is already in use, getting random available port.")
+				log.warning("Port is already in use, getting random available port.")
 				self.socket.bind((ip_address,0))
 			pass
 
@@ -63,106 +149,365 @@ class Node:
 		if port == 0:
 			self.node['port'] = int(self.socket.getsockname()[1])
 
-		""" Initialize kbucket """
-		self.kbuckets = Kbucket(node_id=self.node['id'], id_length=id_length)
-		self.kbuckets.load_kbuckets()
+	def load_storage(self, kbuckets_full_path=''):
+		""" Load routing table and topics """
+		if len(kbuckets_full_path) > 0:
+			self.kbuckets.load_kbuckets(kbuckets_full_path)
+		else:
+			self.kbuckets.load_kbuckets()
+		self.topics.load()
+
+		""" Move data topics stored in kbuckets by older versions """
+		data_topics = self.kbuckets.pop_data_topics()
+		for topic_id, value in data_topics:
+			self.topics.put(topic_id, value)
+		if len(data_topics) > 0:
+			self.kbuckets.save()
+			self.topics.flush()
+
+	def flush_storage(self, due_only=False):
+		""" Write buffered routing table and topic changes """
+		if due_only:
+			self.kbuckets.flush_if_due()
+			self.topics.flush_if_due()
+		else:
+			self.kbuckets.flush()
+			self.topics.flush()
+			if self.kbuckets.persist:
+				save_seed_cache(self.kbuckets.data_path('seeds.json'), self.kbuckets.recently_seen(seed_cache_size))
 
 	""" Main entry point for message coming into UDP socket """
 	def handle_message(self, message, sender):
 		""" Handle incomming message """
-		""" Message header should be "ID|XXXXXXXXXXXXXXXXXXXXX|AT|XXXXXX" """
-		message = base64.b64decode(message).decode('ASCII')
-		print("handle_message:: Received " + message + " from " + str(sender[0]))
+		""" Message is decoded once, text (base64) or binary format """
+		message = self.decode_message(message, sender)
+		if message is not None:
+			self.handle_decoded(message, sender)
 
-		if 'ID' in message:
+	def decode_message(self, datagram, sender):
+		""" Returns None for a malformed datagram """
+		try:
+			message = decode(datagram)
+		except (ValueError, IndexError, struct.error) as e:
+			message_log.info("handle_message:: Dropping malformed message from %s: %s", sender[0], e)
+			self.metrics.inc('messages_malformed')
+			return None
+		self.metrics.inc('messages_received', OP_LABELS[message.op])
+		return message
+
+	def receive(self, datagram, sender):
+		""" Datagram from the socket: rate limited then queued, handled by process_inbound """
+		""" Datagrams delivered in process (virtual host, simulation) skip admission and go to handle_message """
+		message = self.decode_message(datagram, sender)
+		if message is None:
+			return
+		is_request = not is_response(message)
+		if is_request and not self.rate_limiter.allow(self.rate_limit_peer(sender, message), message.op):
+			self.metrics.inc('inbound_rate_limited', OP_LABELS[message.op])
+			message_log.debug("receive:: Rate limited %s from %s", OP_LABELS[message.op], sender[0])
+			return
+		dropped = self.receive_queue.enqueue(message, sender, is_request)
+		if dropped is not None:
+			self.metrics.inc('inbound_queue_dropped', OP_LABELS[dropped.op])
+
+	def rate_limit_peer(self, sender, message):
+		if rate_limit_key == 'id' and message.sender_id != '':
+			return message.sender_id
+		if rate_limit_key == 'address':
+			return sender
+		return sender[0]
+
+	def process_inbound(self, limit=send_batch_size):
+		""" Handle queued messages, answers first, returns handled count """
+		handled = 0
+		while handled < limit:
+			item = self.receive_queue.pop()
+			if item is None:
+				break
+			try:
+				self.handle_decoded(item[0], item[1])
+			except Exception as e:
+				""" A well formed message with bad content must not stop the node """
+				message_log.info("process_inbound:: Dropping %s from %s: %r", OP_LABELS[item[0].op], item[1][0], e)
+				self.metrics.inc('messages_malformed')
+			handled = handled + 1
+		return handled
+
+	def handle_decoded(self, message, sender):
+		""" Answer in the format peer talks """
+		self.peer_formats[sender] = message.wire
+		message_log.debug("handle_message:: Received %s from %s", message, sender[0])
+
+		if message.sender_id != '':
 			self.register_sender(sender, message)
-		if 'WHO' in message:
-			self.send_presentation(sender)
-		if 'PING' in message:
-			self.send_pong(sender, message)
-		if 'GET' in message:
-			""" Get topic """
-			""" GET|XXXXXX|FOR|XXXXXX """
-			self.send_topic(sender, message)
-		if 'TOP' in message:
-			""" Found topic """
-			if 'FOR' in message:
-				""" Forward """
-				self.handle_forward(sender, message)
-			else:
-				print("handle_message:: Found: " + str(message))
-				self.add_received_topic(sender, message)
-		if 'NOP' in message:
-			""" Not found """
-			if 'FOR' in message:
-				""" Forward """
-				self.handle_forward(sender, message)
-			else:
-				print("handle_message:: Not found: "+ str(message))
-		if 'ROUT' in message:
-			""" Route information """
-			""" ROUT|[NODE ID]|[IP]|[PORT] """
-			self.handle_route_information(message)
-		if 'INFO' in message:
-			""" A peer is informing of a new topic """
-			self.handle_topic_information(message)
-
-	def handle_route_information(self, message):
-		new_contact = message.split('|')[1:-1]
-		print(new_contact)
+		self.dispatch(sender, message)
+
+	def dispatch(self, sender, message):
+		""" Call handler registered for message opcode """
+		handler = self.handlers.get(message.op)
+		if handler is None:
+			return
+		if self.first_request is None and message.op in REQUEST_OPS and not is_response(message):
+			self.first_request = time.monotonic() - self.started
+			self.metrics.observe('startup_seconds', self.first_request, 'first_request')
+			log.info("First request served %.3fs after start", self.first_request)
+		if self.metrics.enabled:
+			started = time.perf_counter()
+			handler(sender, message)
+			self.metrics.observe('handler_seconds', time.perf_counter() - started, OP_LABELS[message.op])
+		else:
+			handler(sender, message)
+
+	def handle_who(self, sender, message):
+		self.send_presentation(sender)
+
+	def handle_found(self, sender, message):
+		""" Found topic """
+		if message.origin is not None:
+			""" Forward """
+			self.handle_forward(sender, message)
+		else:
+			lookup_log.debug("handle_message:: Found: %s", message)
+			self.add_received_topic(sender, message)
+
+	def handle_nop(self, sender, message):
+		""" Not found """
+		if message.origin is not None:
+			""" Forward """
+			self.handle_forward(sender, message)
+		else:
+			self.handle_not_found(sender, message)
+
+	def handle_route_information(self, sender, message):
+		""" Route information """
+		""" ROUT|[NODE ID]|[IP]|[PORT] """
+		log.info("handle_route_information:: %s at %s", message.topic, message.data)
 
 	def handle_forward(self, sender, message):
-		if 'FOR' in message:
-			destination_node_id = message.split('|')[-1]
-			""" Check that it's for us """
-			if destination_node_id == self.node['id']:
-				""" Remove forward flag, resend to self """
-				message = message.replace('|FOR|' + str(destination_node_id), '')
-				print("handle_forward:: Is for me " + str(message))
-				self.send_payload(message, self.node['id'])
-			else:
-				""" Forward """
-				print("handle_forward:: Forward " + str(message))
-				self.send_payload(message, destination_node_id)
+		destination_node_id = message.origin
+		""" Check that it's for us """
+		if destination_node_id == self.node['id']:
+			""" Remove forward flag, handle it """
+			message.origin = None
+			message_log.debug("handle_forward:: Is for me %s", message)
+			self.dispatch(sender, message)
+		else:
+			""" Forward """
+			message_log.debug("handle_forward:: Forward %s", message)
+			self.metrics.inc('forwards')
+			self.send_message(message, destination_node_id)
 
-	def get_topic(self, topic):
-		payload = self.build_presentation() + "|GET|" + str(topic) + "|FOR|" + self.node['id']
+	def get_topic(self, topic, request_id=None):
+		""" Answer from cache, or send lookup """
+		hit, value = self.lookup_cache.get(topic)
+		if hit:
+			lookup_log.debug("get_topic:: Cached [%s]: %s", topic, value)
+			return value
+		if request_id is None:
+			request_id = self.next_request_id()
+		request = self.build_message(OP_GET, topic=str(topic), origin=self.node['id'], request_id=request_id)
+		""" Answer may take several hops, sent again if it does not come """
+		first_hop = self.kbuckets.get_closest_known_node(str(topic))
+		timeout = self.kbuckets.timeout_for(first_hop[0] if first_hop is not None else '') * forward_timeout_factor
+		self.pending_gets[request_id] = Retry(timeout, self.now(), request=request, target=('127.0.0.1', self.node['port']))
 		""" Send to ourself """
-		self.send_topic(('127.0.0.1', self.node['port']), payload)
+		self.send_topic(('127.0.0.1', self.node['port']), request)
 
-	def handle_topic_information(self, message):
-		""" Handle topic information """
-		sender_id, sender_port = self.process_message(message)
-		""" Remove header """
-		message = message.replace('ID|' + str(sender_id) + '|AT|' + str(sender_port) + '|', '')
+	def now(self):
+		""" Clock of request timeouts and round trip samples """
+		return time.monotonic()
+
+	def next_request_id(self):
+		return next(self.request_ids) & 0xFFFFFFFF
+
+	def handle_topic_information(self, sender, message):
+		""" A peer is informing of a new topic """
 		""" INFO|493b1310|AT|87f1640e """
-		""" Extract topic_id """
-		topic_id, sender_id = message.split('|')[1], message.split('|')[3]
+		topic_id, holder_id = message.topic, message.origin
 		if self.kbuckets.is_of_interest(topic_id):
-			payload = self.build_presentation() + "|GET|" + str(topic_id) + "|FOR|" + self.node['id']
-			self.send_topic(sender_id, payload)
+			request = self.build_message(OP_GET, topic=topic_id, origin=self.node['id'])
+			self.send_topic(holder_id, request)
 		else:
-			print("handle_topic_information:: Skipping, out of radius")
+			lookup_log.debug("handle_topic_information:: Skipping [%s], out of radius", topic_id)
 
 	def add_received_topic(self, sender, message):
-		sender_id, sender_port = self.process_message(message)
-		stripped_message = self.strip_out_message_header(message)
-		topic_id, topic_data = stripped_message.split('|')[1], stripped_message.split('|')[2]
-		self.add_topic(topic_id, topic_data)
+		self.settle_get(message)
+		topic_id, topic_data = message.topic, message.data
+		if topic_id is None:
+			""" Legacy contact answer, no topic ID to register it under """
+			lookup_log.debug("add_received_topic:: Contact %s", topic_data)
+		elif message.contact:
+			""" Contact topic, IP:PORT """
+			contact_address, _, contact_port = topic_data.rpartition(':')
+			self.kbuckets.register_contact(topic_id, contact_address, contact_port)
+		else:
+			""" Copy of someone else's topic, kept until it expires """
+			self.topics.put(topic_id, topic_data, topic_expiry)
+		if topic_id is not None:
+			self.lookup_cache.put(topic_id, topic_data)
+
+	def handle_not_found(self, sender, message):
+		""" Lookup came back empty """
+		lookup_log.debug("handle_message:: Not found: %s", message)
+		self.settle_get(message)
+		self.lookup_cache.put(message.topic, None, lookup_negative_ttl)
 
-	def strip_out_message_header(self, message):
-		id, port = self.process_message(message)
-		return message.replace('ID|' + str(id) + '|AT|' + str(port) + '|', '')
+	def settle_get(self, message):
+		""" Forwarded GET answered, legacy peers do not echo request ID so match on topic """
+		if message.request_id is not None:
+			self.pending_gets.pop(message.request_id, None)
+			return
+		for request_id in [request_id for request_id, retry in self.pending_gets.items() if retry.request.topic == message.topic]:
+			del self.pending_gets[request_id]
+
+	def handle_pong(self, sender, message):
+		""" Pong received on main socket, synchronous ping uses its own listener """
+		pass
 
 	def add_topic(self, topic_id, data):
 		""" Add topic to known topics """
-		data = topiquify_data(data)
-		data = (topic_id, data)
-		""" Delete for update """
-		self.kbuckets.try_delete_topic(topic_id)
+		self.publish_value(topic_id, self.topic_value(data))
+
+	def publish_value(self, topic_id, value):
+		""" Store value of a topic of ours and announce it """
+		self.lookup_cache.discard(topic_id)
 
+		self.topics.put(topic_id, value)
+		""" INFO for peers that only fetch, STORE for the ones that replicate """
 		self.inform_topic(topic_id)
-		self.kbuckets.register_topic(topic_id, data)
+		self.replicate_topic(topic_id, value)
+
+	def add_file(self, source, topic_id=None):
+		""" Publish SHA-256 of a file path, file object or chunk iterable, read and hashed in chunks """
+		""" Topic ID defaults to hash prefix, returns the Digest """
+		return self.publish_digest(ingest.digest(source), topic_id)
+
+	def publish_digest(self, digest, topic_id=None):
+		if topic_id is None:
+			topic_id = digest.topic_id()
+		self.publish_value(topic_id, digest.sha256)
+		log.info("add_file:: Topic %s, %d bytes hashed at %.1f MB/s", topic_id, digest.size, digest.mb_per_second())
+		return digest
+
+	def add_topics(self, topics):
+		""" Bulk add_topic, (topic_id, data) pairs, entries without a hex topic ID or data are skipped """
+		""" Topics are stored with one journal write, announcements are sent peer by peer """
+		""" Returns topics added """
+		added = list()
+		for topic in topics:
+			try:
+				topic_id, data = topic
+				topic_id = str(topic_id).lower()
+				int(topic_id, 16)
+			except (TypeError, ValueError):
+				continue
+			if data is None or len(topic_id) > 255:
+				continue
+			added.append((topic_id, self.topic_value(str(data))))
+		self.topics.put_many(added)
+		for topic_id, _ in added:
+			self.lookup_cache.discard(topic_id)
+		self.announce_topics(added)
+		log.info("add_topics:: Added %d topics", len(added))
+		return len(added)
+
+	def topic_value(self, data):
+		""" Value kept for published data: content itself on a segment store, else its SHA-256 """
+		return data if self.topics.segments is not None else topiquify_data(data)
+
+	def announce_topics(self, topics):
+		""" INFO to closest node and STORE to closest nodes of every topic, grouped by destination """
+		""" Replicas go to routing table closest nodes, no lookup per topic """
+		""" Contact ID -> [contact, [(topic_id, data to store or None to inform)]] """
+		announcements = {}
+		for topic_id, data in topics:
+			closest_node = self.kbuckets.get_closest_known_node(topic_id, allow_matching_exact=False)
+			if closest_node is not None and self.not_self(closest_node):
+				announcements.setdefault(closest_node[0], [closest_node, []])[1].append((topic_id, None))
+			if len(data) > chunk_threshold:
+				continue
+			for contact in self.kbuckets.get_k_closest_contacts(topic_id, replication_factor):
+				if self.not_self(contact):
+					announcements.setdefault(contact[0], [contact, []])[1].append((topic_id, data))
+
+		sent = 0
+		for contact, peer_topics in announcements.values():
+			target = (contact[1], int(contact[2]))
+			for topic_id, data in peer_topics:
+				if data is None:
+					message = self.build_message(OP_INFO, topic=str(topic_id), origin=self.node['id'])
+				else:
+					message = self.build_message(OP_STORE, topic=str(topic_id), data=data, ttl=int(topic_expiry))
+				self.send_message(message, target)
+				sent = sent + 1
+				if sent % send_batch_size == 0:
+					""" Keep send queue under its bound """
+					self.drain_send_queue()
+		self.drain_send_queue()
+		return sent
+
+	def drain_send_queue(self):
+		""" Bulk sends: write queued datagrams, waiting for the socket while kernel buffer is full """
+		""" so that nothing is dropped, gives up after chunk_rto without progress """
+		self.send_queue.flush()
+		while self.send_queue.depth() > 0 and len(select.select([], [self.socket], [], chunk_rto)[1]) > 0:
+			self.send_queue.flush()
+
+	def get_topics(self, topic_ids):
+		""" Bulk find_local, topic_id -> value (or IP:PORT for contacts), None if unknown """
+		""" Local only: topics we hold and contacts we know, nothing is asked on the network, see AsyncNode.lookup """
+		return {topic_id: self.find_local(topic_id) for topic_id in topic_ids}
+
+	def replicate_topic(self, topic_id, data, contacts=None):
+		""" Store topic at the closest known nodes """
+		""" Large values stay with us, they are fetched with a chunked transfer """
+		if len(data) > chunk_threshold:
+			return 0
+		if contacts is None:
+			contacts = self.kbuckets.get_k_closest_contacts(topic_id, replication_factor)
+		sent = 0
+		for contact in contacts[:replication_factor]:
+			if self.not_self(contact) and self.send_store(contact, topic_id, data, topic_expiry):
+				sent = sent + 1
+		self.metrics.inc('replicas_sent', amount=sent)
+		return sent
+
+	def send_store(self, contact, topic_id, data, ttl):
+		message = self.build_message(OP_STORE, topic=str(topic_id), data=data, ttl=int(ttl))
+		return self.send_message(message, (contact[1], int(contact[2])))
+
+	def handle_store(self, sender, message):
+		""" Peer asks us to keep a replica """
+		if message.topic is None or message.data is None:
+			return
+		ttl = message.ttl if message.ttl is not None else topic_expiry
+		self.topics.put(message.topic, message.data, min(ttl, topic_expiry))
+		self.lookup_cache.discard(message.topic)
+		self.metrics.inc('replicas_stored')
+
+	def maintain_topics(self):
+		""" Drop expired replicas, compact segment store, republish our own topics """
+		self.topics.expire()
+		self.topics.compact()
+		if time.monotonic() - self.last_republish < republish_interval:
+			return
+		self.last_republish = time.monotonic()
+		for topic_id, data in self.topics.own_items():
+			self.replicate_topic(topic_id, data)
+			if self.send_queue.depth() >= send_batch_size:
+				""" Keep send queue under its bound, as announce_topics """
+				self.drain_send_queue()
+		self.drain_send_queue()
+
+	def find_local(self, topic):
+		""" Topic value, or IP:PORT if topic is a known contact, None if unknown """
+		value = self.topics.get(topic)
+		if value is not None:
+			return value
+		closest_node = self.kbuckets.get_closest_known_node(topic)
+		if closest_node is not None and closest_node[0] == topic:
+			return str(closest_node[1]) + ":" + str(closest_node[2])
+		return None
 
 	def inform_topic(self, topic_id):
 		""" Inform network of a new available topic """
@@ -171,58 +516,166 @@ class Node:
 		if closest_node is not None and self.not_self(closest_node) :
 			self.send_inform_topic(closest_node[0], topic_id)
 		else:
-			print("inform_topic:: No nodes.")
+			lookup_log.debug("inform_topic:: No nodes.")
 
 	def send_inform_topic(self, target, topic_id):
 		""" Send topic id """
-		payload = self.build_presentation() + "|INFO|" + str(topic_id) + "|AT|" + self.node['id']
-		self.send_payload(payload, target)
+		message = self.build_message(OP_INFO, topic=str(topic_id), origin=self.node['id'])
+		self.send_message(message, target)
 
 	""" Lookup topic and send response """
 	""" If topic is found in known object, return response to original sender """
 	""" Else, forward to closest node """
 	def send_topic(self, sender, message):
-		payload = self.build_presentation()
-		sender_id, _ = self.process_message(message)
-		node_origin_id = message.split('|')[-1]
-		topic = message.split('|')[-3]
+		sender_id = message.sender_id
+		node_origin_id = message.origin
+		topic = message.topic
+		lookup_log.debug("send_topic:: Looking for [%s]", topic)
+		value = self.topics.get(topic)
+		if value is not None:
+			""" Data topic """
+			response = self.build_message(OP_TOP, topic=topic, data=value, origin=node_origin_id, request_id=message.request_id)
+			lookup_log.debug("send_topic:: Found, data topic, send response to original sender")
+			self.send_message(response, node_origin_id)
+			return
+
 		closest_node = self.kbuckets.get_closest_known_node(topic)
-		print("send_topic:: Looking for [" + str(topic) + "]")
 		if closest_node is None:
-			print("send_topic:: Nothing found.")
-			payload = payload + "|NOP|" + str(topic) + "|FOR|" + node_origin_id
-			self.send_payload(payload, node_origin_id)
+			lookup_log.debug("send_topic:: Nothing found.")
+			self.send_not_found(topic, node_origin_id, message.request_id)
 		elif closest_node[0] == self.node['id'] and topic != self.node['id']:
 			""" We are the closest we know, and we didn't found topic """
 			""" Send not found """
-			payload = payload + "|NOP|" + str(topic) + "|FOR|" + node_origin_id
-			self.send_payload(payload, node_origin_id)
-		elif len(closest_node) == 3:
-			if closest_node[0] == topic:
-				""" We found requested node, send contact information """
-				payload = payload + "|TOP|" + closest_node[1] + ":" + closest_node[2]  + "|FOR|" + node_origin_id
-				print("send_topic:: Found, send response to original sender")
-				self.send_payload(payload, node_origin_id)
-			elif closest_node[0] != node_origin_id and closest_node[0] != sender_id:
-				""" Didn't found requested node, forward to closest that is not sender nor original sender """
-				payload = self.build_presentation() + "|GET|" + topic + "|FOR|" + node_origin_id
-				print("send_topic:: Topic not known, sending to closest: " + str(closest_node))
-				self.send_payload(payload, (closest_node[1], int(closest_node[2])))
+			self.send_not_found(topic, node_origin_id, message.request_id)
+		elif closest_node[0] == topic:
+			""" We found requested node, send contact information """
+			response = self.build_message(OP_TOP, topic=topic, data=str(closest_node[1]) + ":" + str(closest_node[2]), origin=node_origin_id, request_id=message.request_id, contact=True)
+			lookup_log.debug("send_topic:: Found, send response to original sender")
+			self.send_message(response, node_origin_id)
+		elif closest_node[0] != node_origin_id and closest_node[0] != sender_id:
+			""" Didn't found requested node, forward to closest that is not sender nor original sender """
+			request = self.build_message(OP_GET, topic=topic, origin=node_origin_id, request_id=message.request_id)
+			lookup_log.debug("send_topic:: Topic not known, sending to closest: %s", closest_node)
+			self.metrics.inc('forwards')
+			self.send_message(request, (closest_node[1], int(closest_node[2])))
+		else:
+			lookup_log.debug("send_topic:: Nothing found.")
+			self.send_not_found(topic, node_origin_id, message.request_id)
+
+	def send_not_found(self, topic, node_origin_id, request_id):
+		self.metrics.inc('nops')
+		response = self.build_message(OP_NOP, topic=topic, origin=node_origin_id, request_id=request_id)
+		self.send_message(response, node_origin_id)
+
+	""" Iterative lookup step, answer value or our closest contacts, never forward """
+	def handle_find(self, sender, message):
+		topic = message.topic
+		value = self.topics.get_buffer(topic)
+		if value is not None and len(value) > chunk_threshold:
+			""" Too large for one datagram, chunks are sliced from store buffer """
+			self.start_transfer(sender, topic, value, message.request_id)
+			return
+		if isinstance(value, memoryview):
+			value = str(value, 'UTF-8')
+		elif value is None:
+			value = self.find_local(topic)
+		if value is not None:
+			response = self.build_message(OP_TOP, topic=topic, data=value, request_id=message.request_id)
+		else:
+			""" Requester knows itself """
+			contacts = [contact for contact in self.kbuckets.get_k_closest_contacts(topic, lookup_k + 1) if contact[0] != message.sender_id]
+			response = self.build_message(OP_PEERS, topic=topic, data=encode_contacts(contacts[:lookup_k]), request_id=message.request_id)
+		self.send_message(response, sender)
+
+	def handle_peers(self, sender, message):
+		""" Closest contacts answer, only expected by iterative lookups """
+		lookup_log.debug("handle_peers:: Unexpected peers from %s", sender[0])
+
+	def start_transfer(self, target, topic, value, request_id):
+		""" Send value as sequenced chunks, first window goes now """
+		if isinstance(value, str):
+			value = value.encode('UTF-8')
+		transfer = OutgoingTransfer(request_id, target, topic, value)
+		self.outgoing_transfers[(target, request_id)] = transfer
+		self.send_due_chunks(transfer)
+
+	def send_due_chunks(self, transfer):
+		for seq in transfer.due(time.monotonic()):
+			chunk = self.build_message(OP_CHUNK, topic=transfer.topic, data=transfer.chunk(seq), request_id=transfer.transfer_id, seq=seq, total=transfer.total)
+			self.send_datagram(encode(chunk), transfer.target)
+			self.metrics.inc('messages_sent', 'CHUNK')
+
+	def handle_ack(self, sender, message):
+		transfer = self.outgoing_transfers.get((sender, message.request_id))
+		if transfer is None:
+			return
+		transfer.on_ack(message.seq, message.total, unpack_missing(message.data))
+		if transfer.done():
+			del self.outgoing_transfers[(sender, message.request_id)]
+		else:
+			self.send_due_chunks(transfer)
+
+	def handle_chunk(self, sender, message):
+		""" Chunks are only expected by lookups we started """
+		pass
+
+	def send_ack(self, transfer):
+		ack = self.build_message(OP_ACK, data=pack_missing(transfer.missing()), request_id=transfer.transfer_id, seq=transfer.next_expected, total=transfer.credit())
+		self.send_datagram(encode(ack), transfer.sender)
+		self.metrics.inc('messages_sent', 'ACK')
+
+	def poll_transfers(self):
+		""" Retransmit timed out chunks, drop finished or dead transfers """
+		for key, transfer in list(self.outgoing_transfers.items()):
+			if transfer.done():
+				del self.outgoing_transfers[key]
+			elif transfer.failed():
+				transfer_log.warning("poll_transfers:: Giving up transfer of [%s] to %s", transfer.topic, transfer.target)
+				del self.outgoing_transfers[key]
 			else:
-				print("send_topic:: Nothing found.")
-				payload = payload + "|NOP|" + str(topic) + "|FOR|" + node_origin_id
-				self.send_payload(payload, node_origin_id)
-		elif len(closest_node) == 2:
-			""" Data topic """
-			payload = payload + "|TOP|" + closest_node[0] + "|" + closest_node[1] + "|FOR|" + node_origin_id
-			print("send_topic:: Found, data topic, send response to original sender")
-			self.send_payload(payload, node_origin_id)
+				self.send_due_chunks(transfer)
+
+	def handle_stats(self, sender, message):
+		""" Answer metrics snapshot to local peers """
+		if message.data is not None:
+			""" Answers are only expected by stats queries """
+			return
+		if sender[0] not in stats_allowed_addresses:
+			log.warning("handle_stats:: Refusing stats to %s", sender[0])
+			return
+		value = json.dumps(self.metrics_snapshot(), separators=(',', ':'))
+		if len(value) > chunk_threshold:
+			self.start_transfer(sender, None, value, message.request_id)
 		else:
-			print("send_topic:: Not connected to py2py network.")
+			self.send_message(self.build_message(OP_STATS, data=value, request_id=message.request_id), sender)
+
+	def metrics_snapshot(self):
+		snapshot = self.metrics.snapshot()
+		snapshot['node'] = {'id': self.node['id'], 'port': int(self.node['port'])}
+		return snapshot
+
+	def dump_metrics(self, due_only=False):
+		""" Write Prometheus text file, when configured """
+		if metrics_file == '' or not self.metrics.enabled:
+			return
+		if due_only and time.monotonic() - self.last_metrics_dump < metrics_dump_interval:
+			return
+		self.last_metrics_dump = time.monotonic()
+		filename = metrics_file.replace('{id}', str(self.node['id']))
+		try:
+			with open(filename + '.tmp', 'w') as dump_file:
+				dump_file.write(prometheus_text(self.metrics_snapshot()))
+			os.replace(filename + '.tmp', filename)
+		except OSError as e:
+			log.error("Could not write metrics: %s", e)
+
+	""" Return message with header containing our ID and UDP port """
+	def build_message(self, op, topic=None, data=None, origin=None, ping_port=None, request_id=None, seq=None, total=None, ttl=None, contact=False):
+		return Message(op, self.node['id'], int(self.node['port']), topic=topic, data=data, origin=origin, ping_port=ping_port, request_id=request_id, seq=seq, total=total, ttl=ttl, contact=contact)
 
-	""" Return header or presentation message containing ID and UDP port """
+	""" Return presentation message containing ID and UDP port """
 	def build_presentation(self):
-		return "ID|" + str(self.node['id']) + "|AT|" + str(self.node['port'])
+		return self.build_message(OP_PRESENT)
 
 	""" Respond to ping request """
 	def send_pong(self, target, message):
@@ -230,150 +683,344 @@ class Node:
 		or answer_ping_behavior == ANSWER_PING_TRUSTED:
 			if answer_ping_behavior == ANSWER_PING_TRUSTED:
 				if self.is_trusted(target):
-					ping_port = int(message.split('|')[-1])
-					payload = self.build_presentation() + "|" + "PONG"
-					print("send_pong:: Sending pong to " + str(target[0]) + ":" + str(ping_port))
-					self.send_payload(payload=payload, target=(target[0], int(ping_port)))
+					ping_port = int(message.ping_port)
+					response = self.build_message(OP_PONG, request_id=message.request_id)
+					message_log.debug("send_pong:: Sending pong to %s:%d", target[0], ping_port)
+					self.send_message(response, (target[0], ping_port))
 			else:
-				ping_port = int(message.split('|')[-1])
-				payload = self.build_presentation() + "|" + "PONG"
-				print("send_pong:: Sending pong to " + str(target[0]) + ":" + str(ping_port))
-				self.send_payload(payload=payload, target=(target[0], int(ping_port)))
+				ping_port = int(message.ping_port)
+				response = self.build_message(OP_PONG, request_id=message.request_id)
+				message_log.debug("send_pong:: Sending pong to %s:%d", target[0], ping_port)
+				self.send_message(response, (target[0], ping_port))
 
 	def is_trusted(self, node):
 		return False
 
-	""" Send payload converted to base64 """
-	def send_payload(self, payload, target):
-		encoded = base64.b64encode(bytes(payload, "ASCII"))
+	""" Send message encoded in the format target talks """
+	""" Returns False when it could not be queued """
+	def send_message(self, message, target):
+		target = self.resolve_target(target)
+		if target is None:
+			message_log.info("send_message:: No address to send [%s] to", message)
+			return False
+		encoded = encode(message, self.peer_formats.get(target, default_wire_format))
 
+		message_log.debug("send_message:: Sending [%s] to: %s", message, target)
+		if not self.send_datagram(encoded, target):
+			return False
+		self.metrics.inc('messages_sent', OP_LABELS[message.op])
+		return True
+
+	def resolve_target(self, target):
 		""" If target is node Id, get corresponding node or closest """
+		""" None when there is none, or target is not an (IP, port) address """
 		if isinstance(target, str):
 			if target == self.node['id']:
 				target = ('127.0.0.1', int(self.node['port']))
 			else:
 				closest_node = self.kbuckets.get_closest_known_node(target)
 				""" Extract IP / Port """
-				print("send_payload:: Node ID [" + target + "] not known, sending to closest: " + str(closest_node))
+				message_log.debug("send_message:: Node ID [%s] not known, sending to closest: %s", target, closest_node)
+				if closest_node is None:
+					return None
 				target = (closest_node[1], int(closest_node[2]))
+		if not is_address(target):
+			return None
+		return target
+
+	def send_datagram(self, encoded, target):
+		""" Queue encoded datagram, written on next flush, returns False when queue is full """
+		if not self.send_queue.enqueue(encoded, target):
+			return False
+		if not self.batching:
+			self.send_queue.flush()
+		return True
 
-		print("send_payload:: Sending [" + str(payload) + "] to: " + str(target))
-		with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-			sock.sendto(encoded, target)
+	def transport_stats(self):
+		""" Send queue depth and drop counters """
+		return self.send_queue.stats()
+
+	def receive_batch(self):
+		""" Queue pending datagrams, run loop handles one batch per iteration """
+		""" Reading ahead of handling is what lets a flood be shed instead of delaying everyone """
+		for _ in range(receive_batch_size):
+			try:
+				msg, sender = self.socket.recvfrom(2048)
+			except (BlockingIOError, InterruptedError):
+				break
+			self.receive(msg, sender)
 
 	""" Sending node information """
 	def send_presentation(self, target):
 		presentation = self.build_presentation()
-		self.send_payload(presentation, target)
+		self.send_message(presentation, target)
 
 	""" Requesting node information """
 	def send_presentation_request(self, target):
-		presentation_request = self.build_presentation() + "|" + "WHO"
-		self.send_payload(presentation_request, target)
-
-	""" Handle incomming presentation message """
-	def process_message(self, message):
-		properties = message.split('|')
-		sender_id = ''
-		sender_port = ''
-		""" Static search for parameters """
-		if properties[0] == "ID":
-			sender_id = properties[1]
-
-		if properties[2] == "AT":
-			sender_port = properties[3]
-
-		return sender_id, sender_port
+		presentation_request = self.build_message(OP_WHO)
+		self.send_message(presentation_request, target)
 
 	def not_self(self, node):
 		return node[0] != self.node['id']
 
-	def ping(self, node_info):
-		""" Try reach node, timeout 500 ms """
+	def ping(self, node_info, timeout=None):
+		""" Try reach node, timeout derived from its round trip time when not given """
 		""" Returns 0 on success """
+		return 0 if self.ping_many([node_info], timeout)[0] else -1
+
+	def ping_many(self, nodes_info, timeout=None):
+		""" Ping every node at once, pongs come on one listener and are matched by nonce """
+		""" Unanswered pings are sent again with backoff, timeout caps the whole wait when given """
+		""" Returns reached flags, in nodes_info order """
+		reached = [False] * len(nodes_info)
 		""" Setup listenning socket for pong """
-		status = -1
 		listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 		listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		listener.bind(('0.0.0.0',0))
+		listener.setblocking(0)
 
 		""" Get binded port """
 		listening_port = int(listener.getsockname()[1])
-		""" Send ping request """
-		payload = self.build_presentation() + "|PING|" + str(listening_port)
-		self.send_payload(payload, (node_info[1], int(node_info[2])))
+		""" nonce -> index, and (ip, port) -> index for peers not echoing nonce """
+		nonces = {}
+		addresses = {}
+		""" index -> Retry, for nodes still to answer """
+		pending = {}
+		now = self.now()
+		for index, node_info in enumerate(nodes_info):
+			nonce = self.next_request_id()
+			target = (node_info[1], int(node_info[2]))
+			nonces[nonce] = index
+			addresses[target] = index
+			request = self.build_message(OP_PING, ping_port=listening_port, request_id=nonce)
+			pending[index] = Retry(self.kbuckets.timeout_for(node_info[0]), now, timeout, request, target)
+			self.send_message(request, target)
+		self.send_queue.flush()
 
-		listener.setblocking(0)
-		""" Check if there is a response """
-		""" Let receiver 500ms to respond """
-		try:
-			result = select.select([listener],[],[], 0.5)
-			message, sender = result[0][0].recvfrom(2048)
-			message = base64.b64decode(message).decode('ASCII')
-			""" Check that response comes from target """
-			if sender[0] == node_info[1]:
-				if "PONG" in message:
-					self.register_sender(sender, message)
-					""" OK """
-					status = 0
-		except socket.error as e:
-			print(str(e))
-			pass
-		except IndexError as ei:
-			""" Did not respond """
-			print("No response from " + str(node_info[1]) + ":" + str(node_info[2]))
-			pass
-		""" Something went wrong """
+		""" Let receivers respond, all together """
+		while len(pending) > 0:
+			now = self.now()
+			for index, retry in list(pending.items()):
+				if not retry.due(now):
+					continue
+				if retry.next(now):
+					self.metrics.inc('request_retries', 'PING')
+					self.send_message(retry.request, retry.target)
+				else:
+					del pending[index]
+			self.send_queue.flush()
+			if len(pending) == 0:
+				break
+			wait = min(retry.deadline for retry in pending.values()) - now
+			if len(select.select([listener],[],[], max(0, wait))[0]) == 0:
+				continue
+			try:
+				datagram, sender = listener.recvfrom(2048)
+				message = decode(datagram)
+			except (socket.error, ValueError, IndexError, struct.error) as e:
+				log.info("Malformed response: %s", e)
+				continue
+			if message.op != OP_PONG:
+				continue
+			if message.request_id is not None:
+				index = nonces.get(message.request_id)
+			else:
+				index = addresses.get((sender[0], int(message.sender_port)))
+			if index is None or reached[index]:
+				continue
+			reached[index] = True
+			retry = pending.pop(index, None)
+			self.register_sender(sender, message)
+			if retry is not None:
+				self.observe_rtt(message.sender_id, retry, 'ping')
 		listener.close()
-		return status
 
-	def get_bootstrap_routes(self, bootstrap_nodes:List[str]):
-		""" Register bootstrap nodes """
+		for index, node_info in enumerate(nodes_info):
+			if not reached[index]:
+				""" Did not respond """
+				log.info("No response from %s:%s", node_info[1], node_info[2])
+		return reached
+
+	def observe_rtt(self, contact_id, retry, kind):
+		""" Answer to a request sent once is a round trip sample for contact timeouts """
+		sample = retry.sample(self.now())
+		if sample is None:
+			return
+		self.kbuckets.observe_rtt(contact_id, sample)
+		if kind == 'ping':
+			self.metrics.observe('ping_rtt_seconds', sample)
+
+	def get_bootstrap_routes(self, bootstrap_nodes:List[str], timeout=None):
+		""" Register bootstrap nodes, all pinged at once """
 		""" Format is ID|IP|PORT """
-		for node in bootstrap_nodes:
-			node_info = node.split('|')
-			self.ping(node_info)
+		""" Returns seeds count, reached count and elapsed seconds """
+		started = time.monotonic()
+		nodes_info = parse_bootstrap_nodes(bootstrap_nodes)
+		reached = self.ping_many(nodes_info, timeout)
+		return self.bootstrap_report(nodes_info, reached.count(True), started)
+
+	def bootstrap_report(self, nodes_info, reached, started):
+		report = {'seeds': len(nodes_info), 'reached': reached, 'elapsed': time.monotonic() - started}
+		log.info("Bootstrap:: Reached %d/%d seeds in %.3fs", reached, len(nodes_info), report['elapsed'])
+		return report
 
 	""" Register sender in corresponding kbucket """
 	def register_sender(self, sender, message):
-		sender_id = ''
-		sender_port = 0
-
-		sender_id, sender_port = self.process_message(message)
 		""" Add sender address and port """
-		sender_info = (sender_id, sender[0], sender_port)
-		self.kbuckets.register_contact(sender_id, sender[0], sender_port)
+		""" Any message proves sender alive """
+		check = self.liveness_checks.pop(message.sender_id, None)
+		if check is not None and self.bootstrap_deadline is not None:
+			self.warm_start_answers = self.warm_start_answers + 1
+		candidate = self.kbuckets.register_contact(message.sender_id, sender[0], message.sender_port)
+		if check is not None and message.op == OP_PONG and message.request_id == check.request.request_id:
+			self.observe_rtt(message.sender_id, check, 'ping')
+		if candidate is not None:
+			""" Bucket is full, sender replaces its oldest contact only if that one is gone """
+			self.check_contact(candidate)
 
-	def run(self, kbuckets_full_path=''):
-		must_shutdown = False
-		if len(kbuckets_full_path) > 0:
-			self.kbuckets.load_kbuckets(kbuckets_full_path)
+	def check_contact(self, contact):
+		""" Ping contact, evicted by maintain_routes if nothing comes back in time """
+		if contact[0] in self.liveness_checks:
+			return
+		self.metrics.inc('contact_checks')
+		request = self.build_message(OP_PING, ping_port=self.node['port'], request_id=self.next_request_id())
+		target = (contact[1], int(contact[2]))
+		self.liveness_checks[contact[0]] = Retry(self.kbuckets.timeout_for(contact[0]), self.now(), contact_check_timeout, request, target)
+		self.send_message(request, target)
+
+	def maintain_routes(self):
+		""" Ping again or evict contacts that missed their liveness ping, refresh idle buckets """
+		now = self.now()
+		for contact_id, check in list(self.liveness_checks.items()):
+			if not check.due(now):
+				continue
+			if check.next(now):
+				self.metrics.inc('request_retries', 'PING')
+				self.send_message(check.request, check.target)
+			else:
+				del self.liveness_checks[contact_id]
+				self.kbuckets.evict_contact(contact_id)
+		for distance in self.kbuckets.idle_buckets():
+			self.refresh_bucket(distance)
+		if self.bootstrap_deadline is not None and now >= self.bootstrap_deadline:
+			self.bootstrap_deadline = None
+			if self.warm_start_answers == 0:
+				log.info("Bootstrap:: No persisted contact answered, using bootstrap source")
+				self.cold_bootstrap()
+
+	def maintain_requests(self):
+		""" Forwarded GETs left unanswered are sent again, then given up """
+		now = self.now()
+		for request_id, retry in list(self.pending_gets.items()):
+			if not retry.due(now):
+				continue
+			if retry.next(now):
+				self.metrics.inc('request_retries', 'GET')
+				self.send_topic(retry.target, retry.request)
+			else:
+				del self.pending_gets[request_id]
+				lookup_log.info("get_topic:: No answer for [%s]", retry.request.topic)
+
+	def start_bootstrap(self):
+		""" Warm start from persisted contacts and seed cache when there are any, else bootstrap source """
+		self.warm_start_answers = 0
+		if self.warm_start() > 0:
+			self.bootstrap_deadline = self.now() + contact_check_timeout
 		else:
-			self.kbuckets.load_kbuckets()
+			self.cold_bootstrap()
+
+	def warm_start(self):
+		""" Serve right away, persisted contacts are validated by liveness pings """
+		""" Returns contacts being checked """
+		for node_info in parse_bootstrap_nodes(load_seed_cache(self.kbuckets.data_path('seeds.json'))):
+			if self.not_self(node_info):
+				self.kbuckets.register_contact(*node_info)
+		contacts = self.kbuckets.recently_seen(warm_start_checks)
+		for contact in contacts:
+			self.check_contact(contact)
+		if len(contacts) > 0:
+			log.info("Bootstrap:: Warm start, checking %d persisted contacts", len(contacts))
+		return len(contacts)
 
+	def cold_bootstrap(self):
+		""" Blocking, seeds are fetched then pinged """
 		try:
-			print("Running node " + str(self.node['id']) + " on UDP port " + str(int(self.socket.getsockname()[1])))
-			""" Write a function to generate random node information """
+			self.get_bootstrap_routes(self.fetch_bootstrap_nodes())
+		except Exception as e:
+			log.error("Bootstrap failed: %s", e)
+
+	def refresh_bucket(self, distance):
+		""" Make sure idle bucket oldest contact is still there """
+		self.kbuckets.mark_refreshed(distance)
+		contact = self.kbuckets.least_recently_seen(distance)
+		if contact is not None:
+			self.check_contact(contact)
 
-			r = requests.get("https://pastebin.com/raw/WLSsLHfh")
-			raw_result = r.text
-			node_info = raw_result.split(';')
+	def run(self, kbuckets_full_path=''):
+		must_shutdown = False
+		if len(kbuckets_full_path) > 0:
+			""" Storage was loaded at init, pending changes are written before the given table replaces it """
+			self.flush_storage()
+			self.load_storage(kbuckets_full_path)
 
-			self.get_bootstrap_routes(node_info)
+		try:
+			log.info("Running node %s on UDP port %d", self.node['id'], self.socket.getsockname()[1])
+			self.start_bootstrap()
+			self.metrics.observe('startup_seconds', time.monotonic() - self.started, 'serving')
+			self.batching = True
 			while not must_shutdown:
-					result = select.select([self.socket],[],[])
-					""" Receive on first and only listening socket """
-					msg, sender = result[0][0].recvfrom(2048)
-					self.handle_message(msg, sender)
+					self.poll()
 		except KeyboardInterrupt:
 			""" Clean shutdown """
 			must_shutdown = True
 			pass
 		except Exception as e:
 			""" Something went wrong, log it """
-			print(str(e))
+			log.exception("Node stopped: %s", e)
 			pass
 
+		self.batching = False
+		self.send_queue.flush()
+		self.flush_storage()
+		self.dump_metrics()
+		self.save_node()
+
+	def poll(self):
+		""" One run loop iteration """
+		""" Wait for writability only when datagrams are pending """
+		writers = [self.socket] if self.send_queue.depth() > 0 else []
+		timeout = chunk_rto if len(self.outgoing_transfers) > 0 else journal_flush_interval
+		retries = [retry.deadline for retry in itertools.chain(self.liveness_checks.values(), self.pending_gets.values())]
+		if len(retries) > 0:
+			""" Wake up for the next request to send again """
+			timeout = min(timeout, max(0, min(retries) - self.now()))
+		if self.receive_queue.depth() > 0:
+			""" Messages left from previous batch """
+			timeout = 0
+		readable, _, _ = select.select(self.readers(), writers, [], timeout)
+		for reader in readable:
+			self.handle_readable(reader)
+		self.process_inbound()
+		self.poll_transfers()
+		self.maintain_routes()
+		self.maintain_requests()
+		self.maintain_topics()
+		self.send_queue.flush()
+		self.flush_storage(due_only=True)
+		self.dump_metrics(due_only=True)
+
+	def readers(self):
+		""" Files the run loop waits on """
+		return [self.socket]
+
+	def handle_readable(self, reader):
+		self.receive_batch()
+
+	def fetch_bootstrap_nodes(self):
+		""" Get bootstrap nodes list, ID|IP|PORT strings """
+		return read_seed_source(bootstrap_source)
+
+	def save_node(self):
 		""" Save node on disk """
 		try:
 			filename = 'data/node.json'
@@ -381,8 +1028,17 @@ class Node:
 			with open(filename, 'w+') as node_file:
 				json.dump(self.node, node_file)
 		except:
-			print("Could not save node configuration")
+			log.error("Could not save node configuration", exc_info=True)
 			pass
 
+def parse_bootstrap_nodes(bootstrap_nodes):
+	""" ID|IP|PORT strings to (id, ip, port), malformed entries are skipped """
+	nodes_info = list()
+	for node in bootstrap_nodes:
+		node_info = node.strip().split('|')
+		if len(node_info) == 3 and node_info[2].isdigit():
+			nodes_info.append((node_info[0], node_info[1], int(node_info[2])))
+	return nodes_info
+
 def topiquify_data(data):
 	return hashlib.sha256(data.encode('UTF-8')).hexdigest()
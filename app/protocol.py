@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import base64
+import struct
+from app.constants import *
+
+""" Message opcodes """
+OP_PRESENT = 0
+OP_WHO = 1
+OP_PING = 2
+OP_PONG = 3
+OP_GET = 4
+OP_TOP = 5
+OP_NOP = 6
+OP_ROUT = 7
+OP_INFO = 8
+""" Iterative lookup: ask value or closest contacts, answer is TOP or PEERS """
+OP_FIND = 9
+OP_PEERS = 10
+""" Chunked transfer of large values, binary format only """
+""" CHUNK: seq, total bytes, raw payload """
+""" ACK: seq = next expected chunk, total = credit (chunks below it may be sent), data = missing seqs """
+OP_CHUNK = 11
+OP_ACK = 12
+RAW_DATA_OPS = (OP_CHUNK, OP_ACK)
+""" Metrics query, request has no data, answer data is a JSON snapshot (chunked when large) """
+OP_STATS = 13
+""" Replication: keep topic value for ttl seconds """
+OP_STORE = 14
+""" Requests a peer expects an answer to """
+REQUEST_OPS = (OP_WHO, OP_PING, OP_GET, OP_FIND, OP_STATS)
+""" Answers and transfer traffic, handled before new requests under load """
+""" PRESENT answers WHO, a STATS answer is told from the query by its data, see is_response """
+""" STORE and INFO are unsolicited, they are admitted and rate limited as requests """
+RESPONSE_OPS = (OP_PRESENT, OP_PONG, OP_TOP, OP_NOP, OP_ROUT, OP_PEERS, OP_CHUNK, OP_ACK)
+
+""" Text format keywords """
+OP_NAMES = {
+	OP_WHO: 'WHO',
+	OP_PING: 'PING',
+	OP_PONG: 'PONG',
+	OP_GET: 'GET',
+	OP_TOP: 'TOP',
+	OP_NOP: 'NOP',
+	OP_ROUT: 'ROUT',
+	OP_INFO: 'INFO',
+	OP_FIND: 'FIND',
+	OP_PEERS: 'PEERS',
+	OP_STATS: 'STATS',
+	OP_STORE: 'STORE',
+}
+OP_CODES = {name: op for op, name in OP_NAMES.items()}
+""" Every opcode name, for logs and metrics """
+OP_LABELS = {**OP_NAMES, OP_PRESENT: 'PRESENT', OP_CHUNK: 'CHUNK', OP_ACK: 'ACK'}
+
+""" Binary format """
+""" Header: magic, version, opcode, flags, sender port, then sender ID """
+""" Body: optional fields in flag order """
+MAGIC = 0xB2
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBBH')
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+SEQ = struct.Struct('!II')
+
+FLAG_TOPIC = 0x01
+FLAG_DATA = 0x02
+FLAG_ORIGIN = 0x04
+FLAG_PING_PORT = 0x08
+FLAG_REQUEST_ID = 0x10
+FLAG_SEQ = 0x20
+FLAG_TTL = 0x40
+FLAG_CONTACT = 0x80
+
+""" Text format: a value that would not survive as a plain token (non-ASCII, separator, colon) """
+""" is sent as this marker followed by base64 of its UTF-8 bytes, other values stay plain for legacy peers """
+TEXT_ESCAPE = '~'
+
+class Message:
+	""" Decoded message, parsed once and handed to handlers """
+	__slots__ = ('op', 'sender_id', 'sender_port', 'topic', 'data', 'origin', 'ping_port', 'request_id', 'seq', 'total', 'ttl', 'contact', 'wire')
+
+	def __init__(self, op, sender_id='', sender_port=0, topic=None, data=None, origin=None, ping_port=None, request_id=None, seq=None, total=None, ttl=None, contact=False):
+		self.op = op
+		self.sender_id = sender_id
+		self.sender_port = sender_port
+		""" Requested, found or announced topic ID """
+		self.topic = topic
+		""" Topic value or IP:PORT for contacts """
+		self.data = data
+		""" Node the answer is for (FOR), or topic holder for INFO """
+		self.origin = origin
+		""" Port waiting for PONG """
+		self.ping_port = ping_port
+		""" Set by requester, echoed in answers, 32 bits """
+		self.request_id = request_id
+		""" Chunked transfer sequence number and size """
+		self.seq = seq
+		self.total = total
+		""" Seconds a stored value is kept """
+		self.ttl = ttl
+		""" TOP answer data is IP:PORT of the node with requested ID, not a topic value """
+		self.contact = contact
+		""" Format message was received in """
+		self.wire = WIRE_TEXT
+
+	def __repr__(self):
+		if self.op in RAW_DATA_OPS:
+			return OP_LABELS[self.op] + "|" + str(self.request_id) + "|" + str(self.seq) + "|" + str(self.total) + "|" + str(len(self.data)) + " bytes"
+		return encode_text_message(self)
+
+def is_response(message):
+	""" Answer to one of our requests, or transfer traffic """
+	return message.op in RESPONSE_OPS or (message.op == OP_STATS and message.data is not None)
+
+""" Encode message for the wire in requested format """
+def encode(message, wire=WIRE_TEXT):
+	if wire == WIRE_BINARY or message.op in RAW_DATA_OPS:
+		return encode_binary(message)
+	return encode_text(message)
+
+""" Decode datagram, format is detected from first byte """
+def decode(datagram):
+	if len(datagram) > 0 and datagram[0] == MAGIC:
+		return decode_binary(datagram)
+	return decode_text(datagram)
+
+def encode_text_message(message):
+	""" ID|XXXXXXXX|AT|XXXX|OP|... """
+	if message.op == OP_ROUT:
+		return "ROUT|" + str(message.topic) + "|" + message.data.replace(':', '|')
+
+	tokens = ["ID", str(message.sender_id), "AT", str(message.sender_port)]
+	if message.op == OP_PRESENT:
+		return '|'.join(tokens)
+
+	if message.request_id is not None:
+		""" Right after header, where legacy parsers do not look """
+		tokens.extend(["RQ", str(message.request_id)])
+
+	tokens.append(OP_NAMES[message.op])
+	if message.op == OP_PING:
+		tokens.append(str(message.ping_port))
+	elif message.op == OP_INFO:
+		tokens.extend([str(message.topic), "AT", str(message.origin)])
+	elif message.op == OP_STORE:
+		tokens.extend([str(message.topic), escape_value(message.data)])
+		if message.ttl is not None:
+			tokens.append(str(message.ttl))
+	else:
+		if message.topic is not None:
+			tokens.append(str(message.topic))
+		if message.data is not None:
+			tokens.append(escape_value(message.data) if message.op == OP_TOP and not message.contact else str(message.data))
+		if message.origin is not None:
+			tokens.extend(["FOR", str(message.origin)])
+	return '|'.join(tokens)
+
+def escape_value(value):
+	value = str(value)
+	if value.isascii() and '|' not in value and ':' not in value and not value.startswith(TEXT_ESCAPE):
+		return value
+	return TEXT_ESCAPE + base64.b64encode(value.encode('UTF-8')).decode('ASCII')
+
+def unescape_value(token):
+	if token.startswith(TEXT_ESCAPE):
+		return base64.b64decode(token[1:], validate=True).decode('UTF-8')
+	return token
+
+def encode_text(message):
+	return base64.b64encode(bytes(encode_text_message(message), "ASCII"))
+
+def decode_text(datagram):
+	""" Single split, tokens are read in order """
+	tokens = base64.b64decode(datagram).decode('ASCII').split('|')
+	message = Message(OP_PRESENT)
+	index = 0
+	if tokens[0] == "ID" and len(tokens) >= 4 and tokens[2] == "AT":
+		message.sender_id = tokens[1]
+		message.sender_port = parse_port(tokens[3])
+		index = 4
+
+	if index >= len(tokens):
+		return message
+
+	if tokens[index] == "RQ":
+		message.request_id = int(tokens[index + 1])
+		index = index + 2
+
+	if tokens[index] not in OP_CODES:
+		raise ValueError("Unknown message type " + tokens[index])
+	message.op = OP_CODES[tokens[index]]
+	args = tokens[index + 1:]
+
+	if message.op == OP_PING:
+		message.ping_port = parse_port(args[0])
+	elif message.op == OP_ROUT:
+		""" ROUT|[NODE ID]|[IP]|[PORT] """
+		message.topic = args[0]
+		message.data = args[1] + ':' + args[2]
+	elif message.op == OP_INFO:
+		""" INFO|[TOPIC]|AT|[HOLDER] """
+		message.topic = args[0]
+		message.origin = args[2]
+	elif message.op == OP_STORE:
+		""" STORE|[TOPIC]|[DATA]|[TTL] """
+		message.topic = args[0]
+		message.data = unescape_value(args[1])
+		if len(args) > 2:
+			message.ttl = int(args[2])
+	elif message.op == OP_STATS:
+		if len(args) > 0:
+			""" JSON may hold separator """
+			message.data = '|'.join(args)
+	elif message.op in (OP_GET, OP_TOP, OP_NOP, OP_FIND, OP_PEERS):
+		if len(args) >= 2 and args[-2] == "FOR":
+			message.origin = args[-1]
+			args = args[:-2]
+		if message.op == OP_TOP and len(args) == 1:
+			""" Legacy contact answer, TOP|IP:PORT without topic ID """
+			message.data = args[0]
+			message.contact = True
+		else:
+			if len(args) > 0:
+				message.topic = args[0]
+			if len(args) > 1:
+				message.data = args[1]
+		if message.op == OP_TOP and message.data is not None and not message.contact:
+			""" Values with a colon are escaped, a plain one is IP:PORT """
+			message.contact = ':' in message.data
+			message.data = unescape_value(message.data)
+	return check_message(message)
+
+def parse_port(token):
+	port = int(token)
+	if not 0 <= port <= 65535:
+		raise ValueError("Port out of range " + str(token))
+	return port
+
+def check_message(message):
+	""" Reject what handlers could not answer or forward """
+	""" GET is answered to its origin, TOP / NOP are forwarded to it unless they answer a FIND """
+	if message.origin is None:
+		if message.op == OP_GET or (message.op in (OP_TOP, OP_NOP) and message.request_id is None):
+			raise ValueError(OP_LABELS[message.op] + " without origin")
+	return message
+
+""" PEERS data, ID:IP:PORT,ID:IP:PORT """
+def encode_contacts(contacts):
+	return ','.join(str(contact[0]) + ':' + str(contact[1]) + ':' + str(contact[2]) for contact in contacts)
+
+def decode_contacts(data):
+	contacts = list()
+	for contact in data.split(','):
+		if contact != '':
+			contact_id, contact_address, contact_port = contact.split(':')
+			contacts.append((contact_id, contact_address, parse_port(contact_port)))
+	return contacts
+
+def pack_id(hex_id):
+	""" Hex ID as length (hex chars) and raw bytes """
+	hex_id = str(hex_id)
+	raw = bytes.fromhex(hex_id if len(hex_id) % 2 == 0 else '0' + hex_id)
+	return bytes([len(hex_id)]) + raw
+
+def unpack_id(datagram, offset):
+	length = datagram[offset]
+	end = offset + 1 + ((length + 1) >> 1)
+	hex_id = datagram[offset + 1:end].hex()
+	if length & 1:
+		hex_id = hex_id[1:]
+	return hex_id, end
+
+def encode_binary(message):
+	flags = 0
+	body = list()
+	if message.topic is not None:
+		flags = flags | FLAG_TOPIC
+		body.append(pack_id(message.topic))
+	if message.data is not None:
+		flags = flags | FLAG_DATA
+		if message.op in RAW_DATA_OPS:
+			data = message.data
+		else:
+			data = str(message.data).encode('UTF-8')
+		body.append(UINT16.pack(len(data)))
+		body.append(data)
+	if message.origin is not None:
+		flags = flags | FLAG_ORIGIN
+		body.append(pack_id(message.origin))
+	if message.ping_port is not None:
+		flags = flags | FLAG_PING_PORT
+		body.append(UINT16.pack(int(message.ping_port)))
+	if message.request_id is not None:
+		flags = flags | FLAG_REQUEST_ID
+		body.append(UINT32.pack(message.request_id))
+	if message.seq is not None:
+		flags = flags | FLAG_SEQ
+		body.append(SEQ.pack(message.seq, message.total))
+	if message.ttl is not None:
+		flags = flags | FLAG_TTL
+		body.append(UINT32.pack(int(message.ttl)))
+	if message.contact:
+		flags = flags | FLAG_CONTACT
+
+	header = HEADER.pack(MAGIC, PROTOCOL_VERSION, message.op, flags, int(message.sender_port))
+	return header + pack_id(message.sender_id) + b''.join(body)
+
+def decode_binary(datagram):
+	_, version, op, flags, sender_port = HEADER.unpack_from(datagram, 0)
+	if version > PROTOCOL_VERSION:
+		raise ValueError("Unsupported protocol version " + str(version))
+	if op > OP_STORE:
+		raise ValueError("Unknown opcode " + str(op))
+
+	message = Message(op)
+	message.wire = WIRE_BINARY
+	message.sender_port = sender_port
+	message.contact = bool(flags & FLAG_CONTACT)
+	message.sender_id, offset = unpack_id(datagram, HEADER.size)
+	if flags & FLAG_TOPIC:
+		message.topic, offset = unpack_id(datagram, offset)
+	if flags & FLAG_DATA:
+		end = offset + 2 + ((datagram[offset] << 8) | datagram[offset + 1])
+		if op in RAW_DATA_OPS:
+			""" No copy, payload is written once into transfer buffer """
+			message.data = memoryview(datagram)[offset + 2:end]
+		else:
+			message.data = datagram[offset + 2:end].decode('UTF-8')
+		offset = end
+	if flags & FLAG_ORIGIN:
+		message.origin, offset = unpack_id(datagram, offset)
+	if flags & FLAG_PING_PORT:
+		message.ping_port = UINT16.unpack_from(datagram, offset)[0]
+		offset = offset + UINT16.size
+	if flags & FLAG_REQUEST_ID:
+		message.request_id = UINT32.unpack_from(datagram, offset)[0]
+		offset = offset + UINT32.size
+	if flags & FLAG_SEQ:
+		message.seq, message.total = SEQ.unpack_from(datagram, offset)
+		offset = offset + SEQ.size
+	if flags & FLAG_TTL:
+		message.ttl = UINT32.unpack_from(datagram, offset)[0]
+	return check_message(message)
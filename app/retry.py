@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+from data.config import rtt_max_timeout, request_retries
+
+def backoff(timeout, attempt):
+	""" Timeout of a request sent attempt times already, doubled each time, capped """
+	return min(rtt_max_timeout, timeout * (1 << attempt))
+
+def retry_budget(timeout, retries=request_retries):
+	""" Seconds before a request answered by nobody is given up """
+	return sum(backoff(timeout, attempt) for attempt in range(retries + 1))
+
+class Retry:
+	""" Request waiting for its answer, sent again with exponential backoff """
+	""" Same request ID on every attempt: an answer is accepted whichever attempt it is for, """
+	""" so only a request sent once gives a round trip sample (Karn) """
+	__slots__ = ('request', 'target', 'timeout', 'attempt', 'sent_at', 'deadline', 'expires')
+
+	def __init__(self, timeout, now, budget=None, request=None, target=None):
+		self.request = request
+		self.target = target
+		self.timeout = timeout
+		self.attempt = 0
+		self.sent_at = now
+		""" Whole request gives up at expires, every attempt included """
+		self.expires = now + (retry_budget(timeout) if budget is None else budget)
+		self.deadline = min(self.expires, now + timeout)
+
+	def due(self, now):
+		return now >= self.deadline
+
+	def next(self, now):
+		""" Attempt timed out, returns True when request should be sent again, False when given up """
+		self.attempt = self.attempt + 1
+		if self.attempt > request_retries or now >= self.expires:
+			return False
+		self.sent_at = now
+		self.deadline = min(self.expires, now + backoff(self.timeout, self.attempt))
+		return True
+
+	def sample(self, now):
+		""" Round trip seconds, None when request was sent more than once """
+		return now - self.sent_at if self.attempt == 0 else None
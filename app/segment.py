@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import mmap
+import time
+import struct
+from data.config import segment_max_bytes, segment_garbage_ratio, journal_flush_interval
+from app.log import get_logger
+
+log = get_logger('store')
+
+""" Record header: op, topic ID length, value length, wall clock expiry (0 = never) """
+RECORD = struct.Struct('>BHId')
+RECORD_PUT = 1
+RECORD_DEL = 2
+SEGMENT_SUFFIX = '.seg'
+
+""" Index entry, segment number, offset and value length packed in one integer """
+OFFSET_BITS = 40
+LENGTH_BITS = 32
+
+def pack_location(segment, offset, length):
+	return (((segment << OFFSET_BITS) | offset) << LENGTH_BITS) | length
+
+def unpack_location(location):
+	length = location & ((1 << LENGTH_BITS) - 1)
+	location = location >> LENGTH_BITS
+	return location >> OFFSET_BITS, location & ((1 << OFFSET_BITS) - 1), length
+
+class Segment:
+	""" One append-only file, mapped for reads """
+	__slots__ = ('number', 'path', 'size', 'live', 'map')
+
+	def __init__(self, number, path, size=0):
+		self.number = number
+		self.path = path
+		""" Bytes written, and bytes of records still in index """
+		self.size = size
+		self.live = 0
+		""" Read only mapping, replaced when file grew past it """
+		self.map = None
+
+	def view(self, offset, length):
+		""" Slice of file, no copy """
+		if self.map is None or offset + length > len(self.map):
+			""" A previous mapping is freed once no slice of it is left """
+			with open(self.path, 'rb') as segment_file:
+				self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+		return memoryview(self.map)[offset:offset + length]
+
+	def garbage(self):
+		return self.size - self.live
+
+class SegmentStore:
+	""" Values in append-only segment files, located through an in memory index """
+	""" A write appends a record, a delete appends a tombstone, overwritten records become garbage """
+	""" Reads are slices of mapped files, compaction copies live records of the most wasteful segment """
+	""" into the active one then drops it; restart rebuilds index from record headers only """
+	def __init__(self, directory, max_segment_bytes=segment_max_bytes, garbage_ratio=segment_garbage_ratio):
+		self.directory = directory
+		self.max_segment_bytes = max_segment_bytes
+		self.garbage_ratio = garbage_ratio
+		""" topic_id -> packed location """
+		self.index = {}
+		""" Segment number -> Segment, active one is the last """
+		self.segments = {}
+		self.active = None
+		self.writer = None
+		self.last_flush = time.monotonic()
+		""" Segment being compacted and next record offset in it """
+		self.compacting = None
+		self.compactions = 0
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self, topic_id):
+		return topic_id in self.index
+
+	def segment_path(self, number):
+		return os.path.join(self.directory, '%08d' % number + SEGMENT_SUFFIX)
+
+	def load(self, repair=True):
+		""" Rebuild index from segment files, record headers and IDs are read, values are skipped """
+		""" Without repair, files are another process's: torn records are left alone and every segment """
+		""" is mapped now, a file compacted away later stays readable through its mapping """
+		""" Returns topic_id -> expiry, for live records that expire """
+		self.close()
+		self.index = {}
+		self.segments = {}
+		expires = {}
+		try:
+			filenames = sorted(os.listdir(self.directory))
+		except FileNotFoundError:
+			filenames = list()
+		for filename in filenames:
+			if filename.endswith(SEGMENT_SUFFIX) and filename[:-len(SEGMENT_SUFFIX)].isdigit():
+				self.scan(int(filename[:-len(SEGMENT_SUFFIX)]), expires, repair)
+		if len(self.segments) > 0:
+			self.active = self.segments[max(self.segments)]
+		return expires
+
+	def scan(self, number, expires, repair):
+		path = self.segment_path(number)
+		segment = Segment(number, path)
+		self.segments[number] = segment
+		file_size = os.path.getsize(path)
+		offset = 0
+		with open(path, 'rb') as segment_file:
+			while offset + RECORD.size <= file_size:
+				header = segment_file.read(RECORD.size)
+				op, key_length, value_length, expiry = RECORD.unpack(header)
+				end = offset + RECORD.size + key_length + value_length
+				if op not in (RECORD_PUT, RECORD_DEL) or end > file_size:
+					break
+				try:
+					topic_id = segment_file.read(key_length).decode('UTF-8')
+				except UnicodeDecodeError:
+					break
+				segment_file.seek(value_length, os.SEEK_CUR)
+				self.forget(topic_id)
+				expires.pop(topic_id, None)
+				segment.live = segment.live + end - offset
+				if op == RECORD_PUT:
+					self.index[topic_id] = pack_location(number, offset, value_length)
+					if expiry > 0:
+						expires[topic_id] = expiry
+				offset = end
+		if offset < file_size and repair:
+			""" Torn record written during a crash """
+			log.warning("Segment %s: dropping %d bytes of incomplete record", path, file_size - offset)
+			os.truncate(path, offset)
+		segment.size = offset
+		if not repair and offset > 0:
+			segment.view(0, offset).release()
+
+	def get(self, topic_id):
+		""" Value as a memoryview on the mapped segment, None if unknown """
+		location = self.index.get(topic_id)
+		if location is None:
+			return None
+		number, offset, length = unpack_location(location)
+		if self.active is not None and number == self.active.number:
+			""" Mapping must see what is still in write buffer """
+			self.flush_writer()
+		start = offset + RECORD.size + len(topic_id.encode('UTF-8'))
+		return self.segments[number].view(start, length)
+
+	def size_of(self, topic_id):
+		""" Value bytes, None if unknown """
+		location = self.index.get(topic_id)
+		return None if location is None else location & ((1 << LENGTH_BITS) - 1)
+
+	def put(self, topic_id, value, expires=None):
+		""" value is str or bytes-like, expires a wall clock time or None """
+		if isinstance(value, str):
+			value = value.encode('UTF-8')
+		self.forget(topic_id)
+		self.index[topic_id] = self.append(RECORD_PUT, topic_id, value, expires)
+
+	def delete(self, topic_id):
+		""" Returns True when topic was stored """
+		if not self.forget(topic_id):
+			return False
+		self.append(RECORD_DEL, topic_id, b'', None)
+		return True
+
+	def forget(self, topic_id):
+		""" Drop index entry, its record becomes garbage """
+		location = self.index.pop(topic_id, None)
+		if location is None:
+			return False
+		number, _, length = unpack_location(location)
+		segment = self.segments[number]
+		segment.live = segment.live - record_size(topic_id, length)
+		return True
+
+	def append(self, op, topic_id, value, expires):
+		""" Write record to active segment, new segment when it is full, returns packed location """
+		key = topic_id.encode('UTF-8')
+		size = RECORD.size + len(key) + len(value)
+		if self.active is None or (self.active.size > 0 and self.active.size + size > self.max_segment_bytes):
+			self.roll()
+		if self.writer is None:
+			os.makedirs(self.directory, exist_ok=True)
+			self.writer = open(self.active.path, 'ab')
+		self.writer.write(RECORD.pack(op, len(key), len(value), expires or 0.0))
+		self.writer.write(key)
+		self.writer.write(value)
+		offset = self.active.size
+		self.active.size = self.active.size + size
+		""" Tombstone stays live, it hides records of older segments """
+		self.active.live = self.active.live + size
+		return pack_location(self.active.number, offset, len(value))
+
+	def roll(self):
+		""" Seal active segment, start next one """
+		self.flush()
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+		number = max(self.segments) + 1 if len(self.segments) > 0 else 1
+		self.active = Segment(number, self.segment_path(number))
+		self.segments[number] = self.active
+
+	def flush_writer(self):
+		if self.writer is not None:
+			self.writer.flush()
+
+	def flush(self):
+		""" Write buffered records and sync them to disk """
+		self.last_flush = time.monotonic()
+		if self.writer is not None:
+			self.writer.flush()
+			os.fsync(self.writer.fileno())
+
+	def flush_if_due(self):
+		if time.monotonic() - self.last_flush >= journal_flush_interval:
+			self.flush()
+
+	def compact(self, max_bytes):
+		""" Copy up to max_bytes of live records out of the most wasteful sealed segment """
+		""" Called repeatedly from the run loop, returns bytes copied """
+		if self.compacting is None:
+			candidates = [segment for segment in self.segments.values() if segment is not self.active and segment.size > 0 and segment.garbage() >= segment.size * self.garbage_ratio]
+			if len(candidates) == 0:
+				return 0
+			self.compacting = [max(candidates, key=Segment.garbage).number, 0]
+
+		number, offset = self.compacting
+		segment = self.segments[number]
+		""" Older segments may hold records a tombstone hides """
+		keep_tombstones = any(other < number for other in self.segments)
+		copied = 0
+		while offset < segment.size and copied < max_bytes:
+			header = segment.view(offset, RECORD.size)
+			op, key_length, value_length, expiry = RECORD.unpack(header)
+			header.release()
+			key = segment.view(offset + RECORD.size, key_length)
+			topic_id = key.tobytes().decode('UTF-8')
+			key.release()
+			size = RECORD.size + key_length + value_length
+			if op == RECORD_PUT and self.index.get(topic_id) == pack_location(number, offset, value_length):
+				value = segment.view(offset + RECORD.size + key_length, value_length)
+				self.forget(topic_id)
+				self.index[topic_id] = self.append(RECORD_PUT, topic_id, value, expiry or None)
+				value.release()
+				copied = copied + size
+			elif op == RECORD_DEL and keep_tombstones and topic_id not in self.index:
+				self.append(RECORD_DEL, topic_id, b'', None)
+			offset = offset + size
+		self.compacting[1] = offset
+
+		if offset >= segment.size:
+			""" Copies must be on disk before the original goes """
+			self.flush()
+			del self.segments[number]
+			segment.map = None
+			try:
+				os.remove(segment.path)
+			except OSError as e:
+				log.error("Could not remove segment %s: %s", segment.path, e)
+			self.compacting = None
+			self.compactions = self.compactions + 1
+			log.info("compact:: Segment %d dropped", number)
+		return copied
+
+	def close(self):
+		if self.writer is not None:
+			self.flush()
+			self.writer.close()
+			self.writer = None
+		for segment in self.segments.values():
+			segment.map = None
+		self.active = None
+		self.compacting = None
+
+	def stats(self):
+		disk_bytes = sum(segment.size for segment in self.segments.values())
+		live_bytes = sum(segment.live for segment in self.segments.values())
+		return {'segments': len(self.segments), 'disk_bytes': disk_bytes, 'live_bytes': live_bytes, 'compactions': self.compactions}
+
+def record_size(topic_id, length):
+	return RECORD.size + len(topic_id.encode('UTF-8')) + length
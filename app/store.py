@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import json
+import time
+import collections
+from data.config import topic_store_max_bytes, journal_compact_records, topic_segments, segment_store_max_bytes, segment_compact_bytes
+from app.journal import Journal, atomic_dump
+from app.segment import SegmentStore
+from app.metrics import NULL_METRICS
+from app.log import get_logger
+
+log = get_logger('store')
+
+class TopicStore:
+	""" Topic content, kept apart from the routing table """
+	""" O(1) lookup, least recently used topics are evicted above the byte budget """
+	""" With segments, values written by this process live in segment files instead of journal and snapshot """
+	def __init__(self, node_id='', max_bytes=None, metrics=NULL_METRICS, segments=topic_segments):
+		self.__current_node_id = node_id
+		self.metrics = metrics
+		if max_bytes is None:
+			max_bytes = segment_store_max_bytes if segments else topic_store_max_bytes
+		self.max_bytes = max_bytes
+		""" topic_id -> value, or its byte length when value is in segment store, least recently used first """
+		self.__topics = collections.OrderedDict()
+		self.segments = SegmentStore(self.data_path('segments')) if segments else None
+		""" topic_id -> wall clock expiry, topics we published never expire """
+		self.expires = {}
+		self.__journal = Journal(self.data_path('topics.journal'))
+		""" Workers sharing a node: only one writes to disk, every change is published to others """
+		self.persist = True
+		self.replicate = None
+		self.size = 0
+		self.evictions = 0
+
+	def data_path(self, filename):
+		return 'data/' + self.__current_node_id + '/' + filename
+
+	def __len__(self):
+		return len(self.__topics)
+
+	def __contains__(self, topic_id):
+		return topic_id in self.__topics
+
+	def load(self):
+		""" Load snapshot then replay journal """
+		""" With segments, index is rebuilt from segment files, a snapshot or journal left is moved into them """
+		self.__topics = collections.OrderedDict()
+		self.expires = {}
+		self.size = 0
+		if self.segments is not None:
+			self.expires = self.segments.load(repair=self.persist)
+			for topic_id in list(self.segments.index):
+				self.insert(topic_id, self.segments.size_of(topic_id), self.expires.get(topic_id))
+		legacy = len(self.__topics)
+		try:
+			with open(self.data_path('topics.json')) as topics_file:
+				snapshot = json.load(topics_file)
+			if isinstance(snapshot.get('topics'), dict):
+				expires = snapshot.get('expires', {})
+				for topic_id, value in snapshot['topics'].items():
+					self.insert(topic_id, value, expires.get(topic_id))
+			else:
+				""" Older snapshot, topic_id -> value """
+				for topic_id, value in snapshot.items():
+					self.insert(topic_id, value)
+		except (OSError, ValueError, AttributeError):
+			pass
+
+		for record in self.__journal.replay():
+			if record['op'] == 'put':
+				self.insert(record['id'], record['value'], record.get('expires'))
+			else:
+				self.remove(record['id'])
+		if self.segments is not None and self.persist and len(self.__topics) > legacy:
+			self.move_to_segments()
+		self.expire()
+		self.evict()
+
+	def move_to_segments(self):
+		""" Topics of snapshot and journal written by a store without segments """
+		for topic_id, value in list(self.__topics.items()):
+			if isinstance(value, str):
+				self.store_record({'op': 'put', 'id': topic_id, 'value': value, 'expires': self.expires.get(topic_id)})
+		self.segments.flush()
+		try:
+			os.remove(self.data_path('topics.json'))
+		except FileNotFoundError:
+			pass
+		self.__journal.reset()
+
+	def get(self, topic_id):
+		""" Returns value or None, refreshes topic recency """
+		value = self.get_buffer(topic_id)
+		if isinstance(value, memoryview):
+			return str(value, 'UTF-8')
+		return value
+
+	def get_buffer(self, topic_id):
+		""" Value without decoding: a slice of mapped segment file (no copy), or str when kept in memory """
+		value = self.__topics.get(topic_id)
+		if value is not None:
+			expires = self.expires.get(topic_id)
+			if expires is not None and expires <= time.time():
+				self.delete(topic_id)
+				return None
+			self.__topics.move_to_end(topic_id)
+			if isinstance(value, int):
+				return self.segments.get(topic_id)
+		return value
+
+	def put(self, topic_id, value, ttl=None):
+		""" Without ttl, topic is ours and never expires """
+		""" With ttl, topic is a replica or cached copy, kept until latest expiry it was given """
+		expires = None
+		if ttl is not None:
+			if topic_id in self.__topics and topic_id not in self.expires:
+				""" Our own topic stays ours """
+				return
+			expires = max(time.time() + ttl, self.expires.get(topic_id, 0))
+		self.insert(topic_id, value, expires)
+		record = {'op': 'put', 'id': topic_id, 'value': value}
+		if expires is not None:
+			record['expires'] = expires
+		self.journal(record)
+		self.evict()
+
+	def put_many(self, topics):
+		""" Bulk put of our own topics, (topic_id, value) pairs, journal written once """
+		records = list()
+		for topic_id, value in topics:
+			self.insert(topic_id, value)
+			record = {'op': 'put', 'id': topic_id, 'value': value}
+			if self.replicate is not None:
+				self.replicate(record)
+			records.append(record)
+		self.persist_records(records)
+		self.evict()
+		return len(records)
+
+	def get_many(self, topic_ids):
+		""" topic_id -> value, None for unknown topics """
+		return {topic_id: self.get(topic_id) for topic_id in topic_ids}
+
+	def delete(self, topic_id):
+		if self.remove(topic_id):
+			self.journal({'op': 'del', 'id': topic_id})
+
+	def insert(self, topic_id, value, expires=None):
+		self.remove(topic_id)
+		self.__topics[topic_id] = value
+		if expires is not None:
+			self.expires[topic_id] = expires
+		self.size = self.size + entry_size(topic_id, value)
+
+	def remove(self, topic_id):
+		value = self.__topics.pop(topic_id, None)
+		if value is None:
+			return False
+		self.expires.pop(topic_id, None)
+		self.size = self.size - entry_size(topic_id, value)
+		return True
+
+	def expire(self):
+		""" Drop replicas and cached copies past their expiry, returns count """
+		now = time.time()
+		expired = [topic_id for topic_id, expires in self.expires.items() if expires <= now]
+		for topic_id in expired:
+			self.delete(topic_id)
+		return len(expired)
+
+	def own_items(self):
+		""" Topics we published, to republish """
+		return [(topic_id, self.value_of(topic_id, value)) for topic_id, value in self.__topics.items() if topic_id not in self.expires]
+
+	def evict(self):
+		""" Drop least recently used topics until under budget """
+		while self.size > self.max_bytes and len(self.__topics) > 0:
+			topic_id = next(iter(self.__topics))
+			self.delete(topic_id)
+			self.evictions = self.evictions + 1
+
+	def items(self):
+		for topic_id, value in self.__topics.items():
+			yield topic_id, self.value_of(topic_id, value)
+
+	def value_of(self, topic_id, value):
+		if isinstance(value, int):
+			return str(self.segments.get(topic_id), 'UTF-8')
+		return value
+
+	def journal(self, record):
+		if self.replicate is not None:
+			self.replicate(record)
+		self.persist_record(record)
+
+	def persist_record(self, record):
+		if not self.persist:
+			return
+		if self.segments is not None:
+			self.store_record(record)
+			return
+		self.__journal.append(record)
+		if self.__journal.records >= journal_compact_records:
+			self.save()
+
+	def persist_records(self, records):
+		""" Bulk change: one journal write, or one snapshot when journal would need compaction anyway """
+		if not self.persist or len(records) == 0:
+			return
+		if self.segments is not None:
+			for record in records:
+				self.store_record(record)
+			return
+		if self.__journal.records + len(self.__journal.pending) + len(records) >= journal_compact_records:
+			self.save()
+		else:
+			self.__journal.extend(records)
+
+	def store_record(self, record):
+		""" Segment store: value goes to disk, memory keeps its byte length """
+		topic_id = record['id']
+		if record['op'] != 'put':
+			self.segments.delete(topic_id)
+			return
+		self.segments.put(topic_id, record['value'], record.get('expires'))
+		value = self.__topics.get(topic_id)
+		if isinstance(value, str):
+			length = self.segments.size_of(topic_id)
+			self.size = self.size + length - len(value)
+			self.__topics[topic_id] = length
+
+	def compact(self, max_bytes=segment_compact_bytes):
+		""" Step of segment compaction, returns bytes copied """
+		if self.segments is None or not self.persist:
+			return 0
+		return self.segments.compact(max_bytes)
+
+	def apply_update(self, record):
+		""" Change published by another worker, applied without publishing it back """
+		if record['op'] == 'put':
+			self.insert(record['id'], record['value'], record.get('expires'))
+		elif not self.remove(record['id']):
+			return
+		self.persist_record(record)
+		self.evict()
+
+	def flush(self):
+		if self.segments is not None:
+			self.segments.flush()
+		self.__journal.flush()
+
+	def flush_if_due(self):
+		if self.segments is not None:
+			self.segments.flush_if_due()
+		if time.monotonic() - self.__journal.last_flush >= self.__journal.flush_interval:
+			self.flush()
+
+	def save(self):
+		""" Compact store into snapshot on disk """
+		if not self.persist:
+			return
+		if self.segments is not None:
+			""" Segment files are the store """
+			self.segments.flush()
+			return
+		self.metrics.inc('topic_store_saves')
+		try:
+			atomic_dump({'topics': self.__topics, 'expires': self.expires}, self.data_path('topics.json'))
+			self.__journal.pending = list()
+			self.__journal.reset()
+		except OSError:
+			log.error("Could not save topics on disk.", exc_info=True)
+
+	def stats(self):
+		stats = {'topics': len(self.__topics), 'bytes': self.size, 'max_bytes': self.max_bytes, 'evictions': self.evictions}
+		if self.segments is not None:
+			stats.update(self.segments.stats())
+		return stats
+
+def entry_size(topic_id, value):
+	""" value is a str, or byte length of a value in segment store """
+	return len(topic_id) + (value if isinstance(value, int) else len(value))
@@ -0,0 +1,353 @@
+import asyncio
+import pytest
+
+from app.node import Node, topiquify_data
+from app.async_node import AsyncNode
+from app.protocol import OP_PING
+
+def test_concurrent_pings(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		results = await asyncio.gather(*[my_node.ping(('', '127.0.0.1', my_node.node['port'])) for _ in range(10)])
+		unreachable = await my_node.ping(('', '127.0.0.1', 9), timeout=0.1)
+		my_node.close()
+		return results, unreachable
+
+	results, unreachable = asyncio.run(scenario())
+	assert results == [0] * 10
+	assert unreachable == -1
+
+def test_serve_keeps_changes_made_before_it(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		my_node.add_topic('11223344', 'hello')
+		my_node.kbuckets.register_contact('aabbcc01', '127.0.0.1', 9)
+		server = asyncio.ensure_future(my_node.serve())
+		await asyncio.sleep(0.05)
+		value = my_node.topics.get('11223344')
+		contact = my_node.kbuckets.find('aabbcc01')
+		my_node.stop()
+		await server
+		return value, contact
+
+	value, contact = asyncio.run(scenario())
+	assert value == topiquify_data('hello')
+	assert contact is not None
+
+def test_bulk_announcements_are_not_dropped(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		my_node.kbuckets.register_contact('aabbcc01', '127.0.0.1', 9)
+		""" INFO and STORE to the only contact for each topic, more than send queue holds """
+		sent = my_node.announce_topics([('%08x' % index, 'value') for index in range(3000)])
+		stats = my_node.transport_stats()
+		my_node.close()
+		return sent, stats
+
+	sent, stats = asyncio.run(scenario())
+	assert sent == 6000
+	assert stats['dropped'] == 0 and stats['sent'] >= 6000
+
+def test_add_file_off_the_loop(workdir):
+	with open('large.bin', 'wb') as large_file:
+		large_file.write(b'x' * 8 * 1024 * 1024)
+
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		""" Loop answers a ping while file is hashed """
+		digest, reached = await asyncio.gather(my_node.add_file('large.bin'), my_node.ping(('', '127.0.0.1', my_node.node['port'])))
+		value = my_node.topics.get(digest.topic_id())
+		my_node.close()
+		return digest, reached, value
+
+	digest, reached, value = asyncio.run(scenario())
+	assert reached == 0
+	assert digest.size == 8 * 1024 * 1024 and value == digest.sha256
+
+def test_ping_retries_and_rtt(workdir):
+	async def scenario():
+		responder = AsyncNode(node_id='10000000', port=0)
+		await responder.start()
+		answer = responder.send_pong
+		dropped = list()
+		def lossy_pong(target, message):
+			""" First ping is lost """
+			if len(dropped) == 0:
+				dropped.append(message)
+				return
+			answer(target, message)
+		responder.handlers[OP_PING] = lossy_pong
+
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		my_node.kbuckets.register_contact('10000000', '127.0.0.1', responder.node['port'])
+		node_info = ('10000000', '127.0.0.1', responder.node['port'])
+		retried = await my_node.ping(node_info)
+		measured_after_retry = my_node.kbuckets.find('10000000').srtt
+		reached = await my_node.ping(node_info)
+		timeout = my_node.kbuckets.timeout_for('10000000')
+		retries = my_node.metrics_snapshot()['counters']['request_retries']
+		my_node.close()
+		responder.close()
+		return retried, measured_after_retry, reached, timeout, retries
+
+	retried, measured_after_retry, reached, timeout, retries = asyncio.run(scenario())
+	assert retried == 0 and reached == 0
+	assert measured_after_retry is None
+	""" Loopback round trip, down to the lower bound """
+	assert timeout == 0.05
+	assert retries == {'PING': 1}
+
+def test_forwarded_get_retries(workdir):
+	my_node = Node(node_id='aabbccdd', port=0)
+	clock = [0.0]
+	my_node.now = lambda: clock[0]
+	""" First hop never answers, measured on loopback """
+	my_node.kbuckets.register_contact('10000000', '127.0.0.1', 9)
+	my_node.kbuckets.observe_rtt('10000000', 0.001)
+	my_node.get_topic('10000001')
+	retry = next(iter(my_node.pending_gets.values()))
+	assert retry.deadline == pytest.approx(0.2)
+
+	sent = list()
+	my_node.send_topic = lambda target, request: sent.append(request.request_id)
+	for clock[0] in (0.1, 0.2, 0.7, 1.5):
+		my_node.maintain_requests()
+	my_node.socket.close()
+	assert sent == [retry.request.request_id] * 2
+	assert len(my_node.pending_gets) == 0
+	assert my_node.metrics.counters[('request_retries', 'GET')] == 2
+
+def test_bootstrap_report(workdir):
+	async def scenario():
+		seeds = [AsyncNode(node_id='1000000' + str(i), port=0) for i in range(3)]
+		for seed in seeds:
+			await seed.start()
+		bootstrap_nodes = [seed.node['id'] + '|127.0.0.1|' + str(seed.node['port']) for seed in seeds]
+		bootstrap_nodes.extend(['20000000|127.0.0.1|9', 'malformed'])
+
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		report = await my_node.get_bootstrap_routes(bootstrap_nodes, timeout=0.3)
+
+		""" Blocking engine, one listener for every seed """
+		blocking_node = Node(node_id='aabbccee', port=0)
+		loop = asyncio.get_running_loop()
+		blocking_report = await loop.run_in_executor(None, blocking_node.get_bootstrap_routes, bootstrap_nodes, 0.3)
+		blocking_node.socket.close()
+		for node in seeds + [my_node]:
+			node.close()
+		return report, blocking_report, my_node.kbuckets.get_k_closest_contacts('10000000', 3)
+
+	report, blocking_report, contacts = asyncio.run(scenario())
+	assert (report['seeds'], report['reached']) == (4, 3)
+	assert (blocking_report['seeds'], blocking_report['reached']) == (4, 3)
+	""" Seeds answered together, not one timeout each """
+	assert blocking_report['elapsed'] < 0.6
+	assert len(contacts) == 3
+
+def test_get_local_topic(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		my_node.add_topic('aabbcc00', 'hello')
+		found = await my_node.get_topic('aabbcc00')
+		my_node.close()
+		return found
+
+	assert asyncio.run(scenario()) is not None
+
+def test_send_queue_batches_and_drops(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		my_node.send_queue.max_queue = 3
+		for _ in range(5):
+			my_node.send_presentation(('127.0.0.1', 9))
+		depth = my_node.send_queue.depth()
+		await asyncio.sleep(0)
+		stats = my_node.transport_stats()
+		my_node.close()
+		return depth, stats
+
+	depth, stats = asyncio.run(scenario())
+	assert depth == 3
+	assert stats['depth'] == 0
+	assert stats['sent'] == 3
+	assert stats['dropped'] == 2
+	assert stats['flushes'] == 1
+
+def test_binary_wire_format(workdir, monkeypatch):
+	import app.node
+	from app.constants import WIRE_BINARY
+	monkeypatch.setattr(app.node, 'default_wire_format', WIRE_BINARY)
+
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		await my_node.start()
+		status = await my_node.ping(('', '127.0.0.1', my_node.node['port']))
+		my_node.close()
+		return status, my_node.peer_formats
+
+	status, peer_formats = asyncio.run(scenario())
+	assert status == 0
+	assert set(peer_formats.values()) == {WIRE_BINARY}
+
+def test_iterative_lookup(workdir):
+	async def scenario():
+		my_nodes = [AsyncNode(node_id=node_id, port=0) for node_id in ['f0000000', '80000000', '40000000', '20000000', '10000000']]
+		for my_node in my_nodes:
+			await my_node.start()
+		""" Each node only knows the next one, closer to target """
+		for my_node, next_node in zip(my_nodes, my_nodes[1:]):
+			my_node.kbuckets.register_contact(next_node.node['id'], '127.0.0.1', next_node.node['port'])
+		my_nodes[-1].add_topic('10000001', 'hello')
+
+		result = await my_nodes[0].lookup('10000001')
+		missing = await my_nodes[0].lookup('0000ffff')
+		for my_node in my_nodes:
+			my_node.close()
+		return result, missing
+
+	result, missing = asyncio.run(scenario())
+	assert result.found
+	assert result.hops == 4
+	assert result.messages == 4
+	assert not missing.found
+	assert missing.timeouts == 0
+
+def test_lookup_coalescing_and_cache(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='f0000000', port=0)
+		holder = AsyncNode(node_id='10000000', port=0)
+		await my_node.start()
+		await holder.start()
+		my_node.kbuckets.register_contact(holder.node['id'], '127.0.0.1', holder.node['port'])
+		holder.add_topic('10000001', 'hello')
+
+		results = await asyncio.gather(*[my_node.lookup('10000001') for _ in range(10)])
+		sent = my_node.transport_stats()['sent']
+		cached = await my_node.lookup('10000001')
+		missing = await my_node.lookup('1000ffff')
+		missing_cached = await my_node.lookup('1000ffff')
+		my_node.close()
+		holder.close()
+		return results, sent, cached, missing, missing_cached
+
+	results, sent, cached, missing, missing_cached = asyncio.run(scenario())
+	assert all(result is results[0] for result in results)
+	assert results[0].found and results[0].messages == 1
+	assert sent == 1
+	assert cached.cached and cached.value == results[0].value
+	assert not missing.found and not missing.cached
+	assert not missing_cached.found and missing_cached.cached
+
+def test_chunked_transfer_with_loss(workdir):
+	value = ''.join(chr(65 + index % 26) for index in range(100000))
+
+	async def scenario():
+		my_node = AsyncNode(node_id='f0000000', port=0)
+		holder = AsyncNode(node_id='10000000', port=0)
+		await my_node.start()
+		await holder.start()
+		my_node.kbuckets.register_contact(holder.node['id'], '127.0.0.1', holder.node['port'])
+		holder.topics.put('10000001', value)
+
+		""" Drop every 7th datagram sent by holder """
+		sendto = holder.send_queue.sendto
+		sent = [0]
+		def lossy_sendto(datagram, target):
+			sent[0] = sent[0] + 1
+			if sent[0] % 7 != 0:
+				sendto(datagram, target)
+		holder.send_queue.sendto = lossy_sendto
+
+		result = await my_node.lookup('10000001')
+		my_node.lookup_cache.discard('10000001')
+		blocks = list()
+		async for block in my_node.stream_topic('10000001'):
+			blocks.append(bytes(block))
+		my_node.close()
+		holder.close()
+		return result, blocks
+
+	result, blocks = asyncio.run(scenario())
+	assert result.found and result.value == value
+	assert b''.join(blocks).decode('UTF-8') == value
+	assert max(len(block) for block in blocks) == 1024
+
+def test_oversized_transfer_is_dropped(workdir):
+	from app.protocol import Message, OP_CHUNK
+
+	async def scenario():
+		my_node = AsyncNode(node_id='f0000000', port=0)
+		await my_node.start()
+		my_node.pending_finds[7] = [asyncio.get_running_loop().create_future()]
+		""" First chunk announces 4 GB """
+		my_node.handle_chunk(('127.0.0.1', 9), Message(OP_CHUNK, '10000000', 9, topic='10000001', data=b'x' * 1024, request_id=7, seq=0, total=0xFFFFFFFF))
+		transfers = dict(my_node.incoming_transfers)
+		rejected = my_node.metrics_snapshot()['counters']['transfers_rejected']
+		my_node.close()
+		return transfers, rejected
+
+	transfers, rejected = asyncio.run(scenario())
+	assert transfers == {}
+	assert rejected == {'': 1}
+
+def test_dead_contact_replaced_after_liveness_check(workdir, monkeypatch):
+	monkeypatch.setattr('app.node.contact_check_timeout', 0.1)
+	async def scenario():
+		my_node = AsyncNode(node_id='00000000', port=0)
+		await my_node.start()
+		""" Farthest bucket is full of contacts that never answer """
+		for index in range(5):
+			my_node.kbuckets.register_contact('f000000' + str(index), '127.0.0.1', 9)
+		newcomer = AsyncNode(node_id='f00000ff', port=0)
+		await newcomer.start()
+		assert await newcomer.ping(('', '127.0.0.1', my_node.node['port'])) == 0
+		waiting = 'f00000ff' in [node[0] for node in my_node.kbuckets.get_all_known_nodes()]
+		await asyncio.sleep(0.4)
+		known = [node[0] for node in my_node.kbuckets.get_all_known_nodes()]
+		my_node.close()
+		newcomer.close()
+		return waiting, known
+
+	waiting, known = asyncio.run(scenario())
+	assert not waiting
+	assert 'f00000ff' in known and 'f0000000' not in known
+
+def test_replication_and_path_caching(workdir):
+	async def scenario():
+		my_nodes = [AsyncNode(node_id=node_id, port=0) for node_id in ['f0000000', '80000000', '40000000', '20000000', '10000000']]
+		for my_node in my_nodes:
+			await my_node.start()
+		for my_node, next_node in zip(my_nodes, my_nodes[1:]):
+			my_node.kbuckets.register_contact(next_node.node['id'], '127.0.0.1', next_node.node['port'])
+			next_node.kbuckets.register_contact(my_node.node['id'], '127.0.0.1', my_node.node['port'])
+		holder = my_nodes[-1]
+
+		""" Topic stored without replication, found at the end of the path """
+		holder.topics.put('10000001', 'hello')
+		result = await my_nodes[0].lookup('10000001')
+		await asyncio.sleep(0.1)
+		cached = [my_node.node['id'] for my_node in my_nodes[:-1] if my_node.topics.get('10000001') == 'hello']
+		expires = my_nodes[3].topics.expires.get('10000001')
+
+		""" Holder only knows its neighbour, replicas reach the nodes its lookup finds """
+		holder.add_topic('10000002', 'replicated')
+		await asyncio.sleep(0.3)
+		replicas = [my_node.node['id'] for my_node in my_nodes[:-1] if '10000002' in my_node.topics]
+		for my_node in my_nodes:
+			my_node.close()
+		return result, cached, expires, replicas
+
+	result, cached, expires, replicas = asyncio.run(scenario())
+	assert result.found and result.holder[0] == '10000000'
+	assert [contact[0] for contact in result.path] == ['80000000', '40000000', '20000000']
+	""" Cached at the two path nodes closest to the topic """
+	assert sorted(cached) == ['20000000', '40000000']
+	assert expires is not None
+	assert sorted(replicas) == ['20000000', '40000000', '80000000', 'f0000000']
@@ -0,0 +1,66 @@
+import threading
+import pytest
+
+from app.node import Node
+from app.transport import RateLimiter
+from benchmarks import network_sim, memory_bench, loadgen
+
+def test_simulated_network_is_deterministic(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	first = network_sim.run(nodes=100, lookups=40, topics=20, loss=0.05, seed=3)
+	second = network_sim.run(nodes=100, lookups=40, topics=20, loss=0.05, seed=3)
+	for result in (first, second):
+		del result['build_seconds']
+		del result['wall_seconds']
+	assert first == second
+	assert first['dropped'] > 0
+	assert first['lookup_latency_ms']['p50'] >= 2 * first['latency_ms']
+
+def test_simulated_lookups_find_topics(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	result = network_sim.run(nodes=200, lookups=50, topics=20, seed=3)
+	assert result['found_ratio'] == 1.0
+	assert result['timeouts_per_lookup']['max'] == 0
+	assert result['hops']['mean'] >= 1
+
+def test_memory_bench_loads_every_contact(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	result = memory_bench.run(contacts=3000, seed=3)
+	assert result['contacts'] == 3000
+	assert result['bytes_per_contact'] < result['json_bytes_per_contact']
+
+def test_loadgen_measures_node(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.batching = True
+	keys = loadgen.key_ids(50, seed=3)
+	my_node.topics.put(keys[0], 'value001')
+	stopped = threading.Event()
+
+	def serve():
+		while not stopped.is_set():
+			my_node.poll()
+	server = threading.Thread(target=serve, daemon=True)
+	server.start()
+	port = my_node.socket.getsockname()[1]
+	try:
+		""" Default limits: one IP gets its GET burst then is throttled """
+		limited = loadgen.run('127.0.0.1', port, rates=[1000], duration=0.5, mix='GET=1', keys=50, timeout=0.3, seed=3)['steps'][0]
+		assert limited['sent'] == 500 and limited['lost'] > 0
+		my_node.rate_limiter = RateLimiter({})
+		result = loadgen.run('127.0.0.1', port, rates=[400], duration=0.5, mix='PING=1,GET=3,INFO=1', keys=50, skew='zipf', timeout=0.5, seed=3)['steps'][0]
+	finally:
+		stopped.set()
+		server.join()
+		my_node.socket.close()
+	assert result['sent'] == 200 and result['loss_rate'] == 0.0
+	assert result['answered'] == result['operations']['PING']['answered'] + result['operations']['GET']['answered']
+	assert result['operations']['INFO']['answered'] == 0
+	assert result['operations']['GET']['hits'] + result['operations']['GET']['misses'] == result['operations']['GET']['answered']
+	assert result['latency_ms']['p99'] > 0
+
+def test_zipf_popularity():
+	weights = loadgen.popularity(1000, 'zipf', 1.0)
+	""" Rank 1 weighs 1 / H(1000) """
+	assert weights[0] / weights[-1] == pytest.approx(1 / 7.4855, rel=1e-3)
+	assert loadgen.popularity(4) == [1, 2, 3, 4]
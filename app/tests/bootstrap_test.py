@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+
+from app.async_node import AsyncNode
+from app.bootstrap import read_seed_source
+
+def test_read_seed_source(workdir):
+	with open('seeds.txt', 'w') as seeds_file:
+		seeds_file.write('10000000|127.0.0.1|5000;20000000|127.0.0.1|5001\n30000000|127.0.0.1|5002\n')
+	assert read_seed_source('seeds.txt') == ['10000000|127.0.0.1|5000', '20000000|127.0.0.1|5001', '30000000|127.0.0.1|5002']
+	assert read_seed_source(['10000000|127.0.0.1|5000']) == ['10000000|127.0.0.1|5000']
+	assert read_seed_source('') == []
+
+def test_warm_start_from_persisted_contacts(workdir, monkeypatch):
+	monkeypatch.setattr('app.node.contact_check_timeout', 0.2)
+	async def scenario():
+		peer = AsyncNode(node_id='aabbcc01', port=0)
+		await peer.start()
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		my_node.kbuckets.register_contact('aabbcc01', '127.0.0.1', peer.node['port'])
+		my_node.kbuckets.register_contact('aabbcc02', '127.0.0.1', 9)
+		my_node.flush_storage()
+		my_node.socket.close()
+
+		""" Restart: persisted contacts are pinged, bootstrap source is never read """
+		monkeypatch.setattr('app.node.bootstrap_source', 'missing.txt')
+		restarted = AsyncNode(node_id='aabbccdd', port=0)
+		await restarted.start()
+		restarted.start_bootstrap()
+		await peer.ping(('', '127.0.0.1', restarted.node['port']))
+		await asyncio.sleep(0.4)
+		contacts = [contact[0] for contact in restarted.kbuckets.get_all_known_nodes()]
+		first_request = restarted.first_request
+		for node in (peer, restarted):
+			node.close()
+		return contacts, first_request
+
+	contacts, first_request = asyncio.run(scenario())
+	assert contacts == ['aabbcc01']
+	assert first_request is not None
+
+@pytest.mark.parametrize('dead_contacts', [1, 5])
+def test_cold_start_after_failed_warm_start(workdir, monkeypatch, dead_contacts):
+	monkeypatch.setattr('app.node.contact_check_timeout', 0.2)
+	""" More dead contacts than checks, unchecked ones look recently seen """
+	monkeypatch.setattr('app.node.warm_start_checks', 2)
+	async def scenario():
+		seed = AsyncNode(node_id='aabbcc01', port=0)
+		await seed.start()
+		monkeypatch.setattr('app.node.bootstrap_source', ['aabbcc01|127.0.0.1|' + str(seed.node['port'])])
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		for index in range(dead_contacts):
+			my_node.kbuckets.register_contact('aabbcc1' + str(index), '127.0.0.1', 9)
+		await my_node.start()
+		my_node.start_bootstrap()
+		await asyncio.sleep(0.6)
+		contacts = [contact[0] for contact in my_node.kbuckets.get_all_known_nodes()]
+		for node in (seed, my_node):
+			node.close()
+		return contacts
+
+	contacts = asyncio.run(scenario())
+	""" Checked dead contacts are evicted, seed from bootstrap source is added """
+	assert 'aabbcc01' in contacts
+	assert len(contacts) == 1 + max(0, dead_contacts - 2)
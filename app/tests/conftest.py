@@ -0,0 +1,7 @@
+import pytest
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+	""" Tests write data/ under a scratch directory """
+	monkeypatch.chdir(tmp_path)
+	return tmp_path
@@ -0,0 +1,36 @@
+import asyncio
+
+from app.host import VirtualHost
+from app.kbucket import Kbucket
+from app.node import topiquify_data
+
+def test_routing_tables_are_per_instance(workdir):
+	first = Kbucket(node_id='00000000', id_length=4)
+	second = Kbucket(node_id='11111111', id_length=4)
+	first.load_kbuckets()
+	second.load_kbuckets()
+	first.register_contact('000000ff', '127.0.0.1', 4000)
+	assert second.get_all_known_nodes() == []
+
+def test_local_nodes_skip_network(workdir):
+	async def scenario():
+		host = VirtualHost()
+		for index in range(5):
+			host.add_node(node_id='a000000' + str(index))
+		await host.start()
+		reports = await host.bootstrap(list())
+		host.nodes[1].add_topic('a00000ff', 'hello')
+		value = await host.nodes[4].get_topic('a00000ff')
+		sent = sum(node.send_queue.stats()['sent'] for node in host.nodes)
+		host.close()
+		return host, reports, value, sent
+
+	host, reports, value, sent = asyncio.run(scenario())
+	assert value == topiquify_data('hello')
+	assert [report['reached'] for report in reports] == [0, 1, 1, 1, 1]
+	assert host.delivered > 0
+	""" Nothing went through a socket """
+	assert sent == 0
+	""" Each node has its own identity and table """
+	assert len(set(node.node['id'] for node in host.nodes)) == 5
+	assert host.nodes[0].kbuckets.get_k_closest_contacts('a0000004', 1)[0][0] == 'a0000004'
@@ -0,0 +1,158 @@
+import os
+import random
+import pytest
+
+from app.kbucket import Kbucket, compute_distance
+from app.trie import XorTrie
+
+def test_compute_distance():
+	assert compute_distance('00000000', '00000000', 4) == 0
+	assert compute_distance('00000000', '00000001', 4) == 1
+	assert compute_distance('80000000', '00000000', 4) == 32
+	assert compute_distance('0f000000', '0e000000', 4) == 25
+
+def test_trie_closest_matches_brute_force():
+	rng = random.Random(7)
+	trie = XorTrie()
+	keys = set(rng.getrandbits(32) for _ in range(500))
+	for key in keys:
+		trie.insert(key, key)
+	removed = set(list(keys)[:100])
+	for key in removed:
+		assert trie.remove(key) == key
+	keys = keys - removed
+	assert len(trie) == len(keys)
+
+	for _ in range(50):
+		target = rng.getrandbits(32)
+		expected = sorted(keys, key=lambda key: key ^ target)[:8]
+		assert [key for key, _ in trie.closest(target, 8)] == expected
+
+def test_get_k_closest(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	kbuckets.load_kbuckets()
+	for contact_id in ['000000f0', '000000f1', '0000f000', 'f0000000']:
+		kbuckets.register_contact(contact_id, '127.0.0.1', 5000)
+
+	closest = kbuckets.get_k_closest('000000f3', 2)
+	assert [contact[0] for contact in closest] == ['000000f1', '000000f0']
+	assert kbuckets.get_closest_known_node('000000f1')[0] == '000000f1'
+	assert kbuckets.get_closest_known_node('000000f1', allow_matching_exact=False)[0] == '000000f0'
+	""" No datagram can reach these, they are not stored """
+	kbuckets.register_contact('000000f4', '127.0.0.1', 99999)
+	kbuckets.register_contact('000000f5', 'localhost', -1)
+	assert kbuckets.find('000000f4') is None and kbuckets.find('000000f5') is None
+
+	""" Index is rebuilt from disk """
+	kbuckets.flush()
+	reloaded = Kbucket(node_id='00000000', id_length=4)
+	reloaded.load_kbuckets()
+	assert reloaded.get_closest_known_node('f0000001')[0] == 'f0000000'
+
+def test_rtt_timeouts_and_latency_tie_break(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	for contact_id in ['000000f0', '000000f1', '000000e0']:
+		kbuckets.register_contact(contact_id, '127.0.0.1', 5000)
+	""" Never measured, initial timeout """
+	assert kbuckets.timeout_for('000000f0') == 0.5
+	assert kbuckets.timeout_for('12345678') == 0.5
+
+	kbuckets.observe_rtt('000000f1', 0.2)
+	contact = kbuckets.find('000000f1')
+	assert (contact.srtt, contact.rttvar) == (0.2, 0.1)
+	kbuckets.observe_rtt('000000f1', 0.1)
+	assert contact.srtt == pytest.approx(0.1875)
+	assert contact.rttvar == pytest.approx(0.1)
+	assert kbuckets.timeout_for('000000f1') == pytest.approx(0.5875)
+	""" Loopback peer, bounded below """
+	for _ in range(50):
+		kbuckets.observe_rtt('000000f0', 0.0001)
+	assert kbuckets.timeout_for('000000f0') == 0.05
+
+	""" Same XOR prefix length with target: fastest wins, closer prefix always wins """
+	assert kbuckets.get_closest_known_node('000000f3')[0] == '000000f0'
+	assert kbuckets.get_closest_known_node('000000f1')[0] == '000000f1'
+	assert kbuckets.get_closest_known_node('000000e1')[0] == '000000e0'
+	""" Moved contact is measured again """
+	kbuckets.register_contact('000000f0', '127.0.0.2', 5000)
+	assert kbuckets.timeout_for('000000f0') == 0.5
+
+def test_journal_replay_and_compaction(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	kbuckets.load_kbuckets()
+	for contact_id in ['000000f0', '000000f1', '0000f000']:
+		kbuckets.register_contact(contact_id, '127.0.0.1', 5000)
+	kbuckets.register_contact('000000f1', '127.0.0.2', 5001)
+	kbuckets.try_delete_topic('0000f000')
+	kbuckets.flush()
+
+	assert not os.path.exists('data/00000000/kbuckets.json')
+	assert os.path.exists('data/00000000/kbuckets.journal')
+
+	reloaded = Kbucket(node_id='00000000', id_length=4)
+	reloaded.load_kbuckets()
+	assert sorted(node[0] for node in reloaded.get_all_known_nodes()) == ['000000f0', '000000f1']
+	assert reloaded.get_closest_known_node('000000f1')[1] == '127.0.0.2'
+
+	reloaded.save()
+	assert os.path.exists('data/00000000/kbuckets.json')
+	assert not os.path.exists('data/00000000/kbuckets.journal')
+
+	compacted = Kbucket(node_id='00000000', id_length=4)
+	compacted.load_kbuckets()
+	assert sorted(node[0] for node in compacted.get_all_known_nodes()) == ['000000f0', '000000f1']
+
+def test_full_bucket_keeps_oldest_until_evicted(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	kbuckets.load_kbuckets()
+	""" Farthest bucket holds min_contact contacts """
+	for index in range(5):
+		assert kbuckets.register_contact('f000000' + str(index), '127.0.0.1', 5000 + index) is None
+	candidate = kbuckets.register_contact('f00000ff', '127.0.0.1', 6000)
+	assert candidate[0] == 'f0000000'
+	assert 'f00000ff' not in [node[0] for node in kbuckets.get_all_known_nodes()]
+
+	""" Known contact is refreshed, moves to most recently seen """
+	assert kbuckets.register_contact('f0000000', '127.0.0.1', 5000) is None
+	assert kbuckets.least_recently_seen(32)[0] == 'f0000001'
+
+	assert kbuckets.evict_contact('f0000001')
+	known = [node[0] for node in kbuckets.get_all_known_nodes()]
+	assert 'f0000001' not in known and 'f00000ff' in known
+
+def test_failures_and_refresh(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	kbuckets.load_kbuckets()
+	kbuckets.register_contact('0000f000', '127.0.0.1', 5000)
+	assert not kbuckets.is_stale('0000f000')
+	assert not kbuckets.mark_failed('0000f000')
+	assert kbuckets.is_stale('0000f000')
+	assert not kbuckets.mark_failed('0000f000')
+	assert kbuckets.mark_failed('0000f000')
+	assert kbuckets.get_all_known_nodes() == []
+	""" Unknown contacts are not tracked """
+	assert not kbuckets.mark_failed('0000f001')
+
+	kbuckets.register_contact('0000f000', '127.0.0.1', 5000)
+	assert kbuckets.idle_buckets(idle_after=3600) == []
+	assert kbuckets.idle_buckets(idle_after=0) == [16]
+	for distance in (1, 8, 16, 32):
+		assert compute_distance('00000000', kbuckets.random_id_in_bucket(distance), 4) == distance
+
+def test_register_contacts_bulk(workdir):
+	kbuckets = Kbucket(node_id='00000000', id_length=4)
+	kbuckets.load_kbuckets()
+	rng = random.Random(3)
+	contacts = [('%08x' % rng.getrandbits(32), '10.0.0.1', 5000 + index) for index in range(500)]
+	contacts.extend([('zz', '10.0.0.1', 5000), ('01000001', '10.0.0.1', 'port'), ('0100', '10.0.0.1', 5000), None])
+	registered = kbuckets.register_contacts(contacts)
+	""" Full buckets keep their contacts, the rest waits in replacement cache """
+	assert 20 < registered < 500
+	assert len(kbuckets.get_all_known_nodes()) == registered
+
+	""" Written in one go, nothing left to flush """
+	with open('data/00000000/kbuckets.journal') as journal_file:
+		assert sum(1 for _ in journal_file) == registered
+	reloaded = Kbucket(node_id='00000000', id_length=4)
+	reloaded.load_kbuckets()
+	assert len(reloaded.get_all_known_nodes()) == registered
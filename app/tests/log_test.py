@@ -0,0 +1,38 @@
+import io
+import logging
+
+from app.log import get_logger, setup_logging, stop_logging
+from app.protocol import Message, OP_PING
+
+class Counted:
+	""" Counts how many times it is formatted """
+	formatted = 0
+
+	def __str__(self):
+		Counted.formatted = Counted.formatted + 1
+		return 'counted'
+
+def test_levels_and_sampling():
+	stream = io.StringIO()
+	setup_logging(level='INFO', levels={'kbucket': 'DEBUG'}, sample_rates={'message': 10}, stream=stream)
+	try:
+		message_log = get_logger('message')
+		for _ in range(100):
+			""" Below level, arguments never formatted """
+			message_log.debug("Received %s", Counted())
+		assert Counted.formatted == 0
+
+		for index in range(100):
+			message_log.info("Dropping %d", index)
+		message_log.warning("Always kept")
+		get_logger('kbucket').debug("Registered %s", Message(OP_PING, 'aabbccdd', 5000, ping_port=4000))
+	finally:
+		stop_logging()
+
+	lines = stream.getvalue().splitlines()
+	assert len([line for line in lines if 'Dropping' in line]) == 10
+	assert any('kademlia.message Always kept' in line for line in lines)
+	assert any('ID|aabbccdd|AT|5000|PING|4000' in line for line in lines)
+	""" Sampling is removed with the handler """
+	assert get_logger('message').filters == []
+	assert logging.getLogger('kademlia').handlers == []
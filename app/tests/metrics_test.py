@@ -0,0 +1,54 @@
+import asyncio
+
+from app.async_node import AsyncNode
+from app.metrics import Metrics, prometheus_text
+
+def test_prometheus_text():
+	metrics = Metrics(enabled=True)
+	metrics.inc('messages_received', 'PING')
+	metrics.inc('messages_received', 'PING')
+	metrics.inc('forwards')
+	metrics.observe('handler_seconds', 0.00002, 'PING')
+	metrics.observe('handler_seconds', 2.0, 'PING')
+	metrics.gauge('routing_table_contacts', lambda: {'31': 4})
+
+	text = prometheus_text(metrics.snapshot())
+	assert 'kademlia_messages_received_total{op="PING"} 2' in text
+	assert 'kademlia_forwards_total 1' in text
+	assert 'kademlia_handler_seconds_bucket{op="PING",le="1e-05"} 0' in text
+	assert 'kademlia_handler_seconds_bucket{op="PING",le="5e-05"} 1' in text
+	assert 'kademlia_handler_seconds_bucket{op="PING",le="+Inf"} 2' in text
+	assert 'kademlia_handler_seconds_count{op="PING"} 2' in text
+	assert 'kademlia_routing_table_contacts{distance="31"} 4' in text
+
+def test_disabled_metrics_record_nothing():
+	metrics = Metrics(enabled=False)
+	metrics.inc('forwards')
+	metrics.observe('handler_seconds', 1.0)
+	metrics.gauge('routing_table_contacts', lambda: {'31': 4})
+	assert metrics.snapshot() == {'counters': {}, 'histograms': {}, 'gauges': {}}
+
+def test_stats_query(workdir, monkeypatch):
+	""" Snapshot comes back as a chunked transfer """
+	monkeypatch.setattr('app.node.chunk_threshold', 100)
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		other_node = AsyncNode(node_id='11223344', port=0)
+		await my_node.start()
+		await other_node.start()
+		await other_node.ping(('', '127.0.0.1', my_node.node['port']))
+		client = AsyncNode(node_id='99999999', port=0)
+		await client.start()
+		snapshot = await client.query_stats(('127.0.0.1', my_node.node['port']))
+		for node in (my_node, other_node, client):
+			node.close()
+		return snapshot, other_node.metrics.snapshot()
+
+	snapshot, other_snapshot = asyncio.run(scenario())
+	assert snapshot['node']['id'] == 'aabbccdd'
+	assert snapshot['counters']['messages_received']['PING'] == 1
+	assert snapshot['counters']['messages_sent']['PONG'] == 1
+	assert snapshot['histograms']['handler_seconds']['PING']['count'] == 1
+	""" Client is not registered as a contact """
+	assert snapshot['gauges']['routing_table_contacts'] == {'32': 1}
+	assert other_snapshot['histograms']['ping_rtt_seconds']['']['count'] == 1
@@ -0,0 +1,68 @@
+import base64
+import pytest
+
+from app.constants import WIRE_TEXT, WIRE_BINARY
+from app.protocol import *
+
+MESSAGES = [
+	Message(OP_PRESENT, 'aabbccdd', 5000),
+	Message(OP_WHO, 'aabbccdd', 5000),
+	Message(OP_PING, 'aabbccdd', 5000, ping_port=40000),
+	Message(OP_PONG, 'aabbccdd', 5000),
+	Message(OP_GET, 'aabbccdd', 5000, topic='11223344', origin='55667788'),
+	Message(OP_GET, 'aabbccdd', 5000, topic='11223344', origin='55667788', request_id=4000000000),
+	Message(OP_PEERS, 'aabbccdd', 5000, topic='11223344', data='', request_id=7),
+	Message(OP_TOP, 'aabbccdd', 5000, topic='11223344', data='127.0.0.1:5001', origin='55667788', contact=True),
+	Message(OP_TOP, 'aabbccdd', 5000, topic='abc', data='2cf24dba5fb0a30e', request_id=7),
+	Message(OP_TOP, 'aabbccdd', 5000, topic='abc', data='a|b:c', origin='55667788'),
+	Message(OP_TOP, 'aabbccdd', 5000, topic='abc', data='~héllo wörld', request_id=7),
+	Message(OP_NOP, 'aabbccdd', 5000, topic='11223344', origin='55667788'),
+	Message(OP_INFO, 'aabbccdd', 5000, topic='11223344', origin='aabbccdd'),
+	Message(OP_ROUT, topic='11223344', data='127.0.0.1:5001'),
+	Message(OP_STORE, 'aabbccdd', 5000, topic='11223344', data='2cf24dba5fb0a30e', ttl=86400),
+	Message(OP_STORE, 'aabbccdd', 5000, topic='11223344', data='2cf24dba5fb0a30e'),
+	Message(OP_STORE, 'aabbccdd', 5000, topic='11223344', data='x|y:z', ttl=60),
+]
+
+@pytest.mark.parametrize('wire', [WIRE_TEXT, WIRE_BINARY])
+@pytest.mark.parametrize('message', MESSAGES, ids=repr)
+def test_round_trip(message, wire):
+	decoded = decode(encode(message, wire))
+	assert decoded.wire == wire
+	for field in ('op', 'sender_id', 'sender_port', 'topic', 'data', 'origin', 'ping_port', 'request_id', 'ttl', 'contact'):
+		assert getattr(decoded, field) == getattr(message, field)
+
+def test_legacy_text_messages():
+	legacy = base64.b64encode(b"ID|aabbccdd|AT|5000|TOP|127.0.0.1:5001|FOR|55667788")
+	message = decode(legacy)
+	assert message.op == OP_TOP
+	assert message.topic is None
+	assert message.data == '127.0.0.1:5001' and message.contact
+	assert message.origin == '55667788'
+	""" Plain value, as legacy peers send and read it """
+	assert decode(base64.b64encode(b"ID|aabbccdd|AT|5000|TOP|11223344|2cf24dba|FOR|55667788")).contact is False
+	assert b'|2cf24dba5fb0a30e' in base64.b64decode(encode(MESSAGES[8], WIRE_TEXT))
+
+@pytest.mark.parametrize('wire', [WIRE_TEXT, WIRE_BINARY])
+def test_rejects_unanswerable_messages(wire):
+	""" GET has nowhere to send its answer, TOP / NOP answer neither a GET nor a FIND """
+	for message in (Message(OP_GET, 'aabbccdd', 5000, topic='11223344'), Message(OP_TOP, 'aabbccdd', 5000, topic='11223344', data='x'), Message(OP_NOP, 'aabbccdd', 5000, topic='11223344')):
+		with pytest.raises(ValueError):
+			decode(encode(message, wire))
+
+def test_rejects_out_of_range_ports():
+	for text in (b"ID|aabbccdd|AT|5000|PING|99999", b"ID|aabbccdd|AT|70000|PONG", b"ID|aabbccdd|AT|5000|PING|-1"):
+		with pytest.raises(ValueError):
+			decode(base64.b64encode(text))
+	with pytest.raises(ValueError):
+		decode_contacts('aabbcc01:127.0.0.1:65536')
+
+def test_binary_is_smaller():
+	message = MESSAGES[4]
+	assert len(encode(message, WIRE_BINARY)) < len(encode(message, WIRE_TEXT)) / 2
+
+def test_rejects_newer_version():
+	encoded = bytearray(encode(MESSAGES[1], WIRE_BINARY))
+	encoded[1] = PROTOCOL_VERSION + 1
+	with pytest.raises(ValueError):
+		decode(bytes(encoded))
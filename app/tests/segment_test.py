@@ -0,0 +1,68 @@
+import os
+
+from app.segment import SegmentStore, RECORD, RECORD_PUT
+
+def test_put_get_and_rebuild(workdir):
+	segments = SegmentStore('segments')
+	segments.put('aaaa', 'value001')
+	segments.put('bbbb', b'value002', expires=2000000000.0)
+	segments.put('cccc', 'value003')
+	segments.put('aaaa', 'value004')
+	assert segments.delete('cccc') and not segments.delete('cccc')
+	value = segments.get('aaaa')
+	assert isinstance(value, memoryview) and bytes(value) == b'value004'
+	assert segments.get('cccc') is None
+	segments.close()
+
+	reloaded = SegmentStore('segments')
+	assert reloaded.load() == {'bbbb': 2000000000.0}
+	assert sorted(reloaded.index) == ['aaaa', 'bbbb']
+	assert bytes(reloaded.get('aaaa')) == b'value004'
+	assert reloaded.size_of('bbbb') == 8
+	stats = reloaded.stats()
+	""" Two values and the tombstone of cccc """
+	assert stats['live_bytes'] == 2 * (RECORD.size + 4 + 8) + RECORD.size + 4
+	assert stats['disk_bytes'] > stats['live_bytes']
+
+def test_torn_record_is_dropped(workdir):
+	segments = SegmentStore('segments')
+	segments.put('aaaa', 'value001')
+	segments.close()
+	with open(segments.segment_path(1), 'ab') as segment_file:
+		""" Header of a 100 bytes value, crash before the value was written """
+		segment_file.write(RECORD.pack(RECORD_PUT, 4, 100, 0.0) + b'bbbbval')
+
+	reloaded = SegmentStore('segments')
+	reloaded.load()
+	assert list(reloaded.index) == ['aaaa']
+	assert os.path.getsize(reloaded.segment_path(1)) == RECORD.size + 4 + 8
+	reloaded.put('bbbb', 'value002')
+	assert bytes(reloaded.get('bbbb')) == b'value002'
+
+def test_compaction_keeps_live_values_and_tombstones(workdir):
+	segments = SegmentStore('segments', max_segment_bytes=256)
+	for index in range(20):
+		segments.put('%04d' % index, 'first' + str(index))
+	""" Deleted topic's value is in the oldest segment """
+	segments.delete('0000')
+	for index in range(1, 20):
+		segments.put('%04d' % index, 'second' + str(index))
+	before = segments.stats()
+	""" Slice taken before compaction stays valid """
+	held = segments.get('0001')
+
+	while segments.compact(64) > 0 or segments.compacting is not None:
+		pass
+	after = segments.stats()
+	assert after['compactions'] > 0
+	assert after['disk_bytes'] < before['disk_bytes']
+	assert after['live_bytes'] <= before['live_bytes']
+	assert bytes(held) == b'second1'
+	assert bytes(segments.get('0019')) == b'second19'
+	segments.close()
+
+	reloaded = SegmentStore('segments', max_segment_bytes=256)
+	reloaded.load()
+	assert '0000' not in reloaded
+	assert sorted(reloaded.index) == ['%04d' % index for index in range(1, 20)]
+	assert all(bytes(reloaded.get('%04d' % index)) == b'second' + str(index).encode() for index in range(1, 20))
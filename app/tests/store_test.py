@@ -0,0 +1,211 @@
+import json
+import os
+import mmap
+import select
+
+from app.store import TopicStore
+from app.protocol import Message, OP_FIND
+
+def test_lru_eviction_under_budget(workdir):
+	topics = TopicStore(node_id='00000000', max_bytes=3 * 12)
+	topics.put('aaaa', 'value001')
+	topics.put('bbbb', 'value002')
+	topics.put('cccc', 'value003')
+	""" Touch oldest so second one gets evicted """
+	assert topics.get('aaaa') == 'value001'
+	topics.put('dddd', 'value004')
+
+	assert 'bbbb' not in topics
+	assert 'aaaa' in topics and 'dddd' in topics
+	assert topics.stats() == {'topics': 3, 'bytes': 36, 'max_bytes': 36, 'evictions': 1}
+
+def test_reload_from_journal_and_snapshot(workdir):
+	topics = TopicStore(node_id='00000000')
+	topics.put('aaaa', 'value001')
+	topics.put('bbbb', 'value002')
+	topics.delete('aaaa')
+	topics.flush()
+
+	reloaded = TopicStore(node_id='00000000')
+	reloaded.load()
+	assert list(reloaded.items()) == [('bbbb', 'value002')]
+
+	reloaded.save()
+	compacted = TopicStore(node_id='00000000')
+	compacted.load()
+	assert list(compacted.items()) == [('bbbb', 'value002')]
+
+def test_node_moves_data_topics_out_of_kbuckets(workdir):
+	from app.node import Node
+
+	os.makedirs('data/aabbccdd')
+	with open('data/aabbccdd/kbuckets.json', 'w') as kbuckets_file:
+		json.dump({'3': [['aabbccd0', 'digest'], ['aabbccd1', '127.0.0.1', 5000]]}, kbuckets_file)
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	assert my_node.topics.get('aabbccd0') == 'digest'
+	assert [contact[0] for contact in my_node.kbuckets.get_all_known_nodes()] == ['aabbccd1']
+	my_node.socket.close()
+
+def test_replica_expiry_and_own_topics(workdir, monkeypatch):
+	topics = TopicStore(node_id='00000000')
+	topics.put('aaaa', 'mine')
+	topics.put('bbbb', 'replica', ttl=10)
+	""" A replica never replaces our own topic, a shorter ttl never shortens a replica """
+	topics.put('aaaa', 'other', ttl=10)
+	topics.put('bbbb', 'replica', ttl=5)
+	assert topics.get('aaaa') == 'mine'
+	assert topics.own_items() == [('aaaa', 'mine')]
+	topics.save()
+
+	reloaded = TopicStore(node_id='00000000')
+	reloaded.load()
+	assert reloaded.get('bbbb') == 'replica'
+	assert reloaded.expires == topics.expires
+
+	now = __import__('time').time()
+	monkeypatch.setattr('app.store.time.time', lambda: now + 11)
+	assert reloaded.get('bbbb') is None
+	assert reloaded.expire() == 0 and list(reloaded.items()) == [('aaaa', 'mine')]
+
+def test_found_value_is_kept_as_received(workdir):
+	from app.node import Node
+	from app.protocol import OP_TOP
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.handle_decoded(Message(OP_TOP, '11223300', 9, topic='11223344', data='deadbeef'), ('127.0.0.1', 9))
+	""" Same value as holder serves, as a replica """
+	assert my_node.topics.get('11223344') == 'deadbeef'
+	assert my_node.topics.own_items() == []
+	my_node.socket.close()
+
+def test_load_flat_snapshot(workdir):
+	os.makedirs('data/00000000')
+	with open('data/00000000/topics.json', 'w') as topics_file:
+		json.dump({'aaaa': 'value001'}, topics_file)
+	topics = TopicStore(node_id='00000000')
+	topics.load()
+	assert topics.own_items() == [('aaaa', 'value001')]
+
+def test_bulk_topics_and_import(workdir):
+	from app.node import Node
+	from app.importer import read_records
+
+	with open('topics.csv', 'w') as topics_file:
+		topics_file.write('id,data\n')
+		for index in range(100):
+			topics_file.write('%08x,value %d\n' % (index, index))
+		topics_file.write('not hex,value\nshort row\n')
+	with open('contacts.jsonl', 'w') as contacts_file:
+		contacts_file.write(json.dumps({'id': 'aabbcc01', 'ip': '127.0.0.1', 'port': 9}) + '\n')
+		contacts_file.write(json.dumps(['aabbcc02', '127.0.0.1', 9]) + '\n{broken\n')
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	assert my_node.kbuckets.register_contacts(read_records('contacts.jsonl', ('id', 'ip', 'port'))) == 2
+	sent = my_node.transport_stats()['sent']
+	assert my_node.add_topics(read_records('topics.csv', ('id', 'data'))) == 100
+	""" Each topic: INFO to closest contact, STORE to both """
+	assert my_node.transport_stats()['sent'] - sent == 300
+	values = my_node.get_topics(['00000001', 'ffffffff'])
+	assert values['00000001'] is not None and values['ffffffff'] is None
+	my_node.socket.close()
+
+	with open('data/aabbccdd/topics.journal') as journal_file:
+		assert sum(1 for _ in journal_file) == 100
+
+def test_republish_is_not_dropped(workdir):
+	from app.node import Node
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.kbuckets.register_contacts([('aabbcc0' + str(index), '127.0.0.1', 9) for index in range(8)])
+	for index in range(2000):
+		my_node.topics.put('%08x' % index, 'value')
+	""" STORE to every contact for each topic, more than send queue holds, written by run loop """
+	my_node.batching = True
+	my_node.last_republish = 0.0
+	my_node.maintain_topics()
+	stats = my_node.transport_stats()
+	assert stats['dropped'] == 0 and stats['depth'] == 0
+	assert my_node.metrics_snapshot()['counters']['replicas_sent'] == {'': 16000}
+	my_node.socket.close()
+
+def test_segment_backed_store(workdir):
+	os.makedirs('data/00000000')
+	with open('data/00000000/topics.json', 'w') as topics_file:
+		json.dump({'topics': {'aaaa': 'value001'}, 'expires': {}}, topics_file)
+	topics = TopicStore(node_id='00000000', segments=True)
+	topics.load()
+	""" Snapshot moved into segments """
+	assert not os.path.exists('data/00000000/topics.json')
+	topics.put('bbbb', 'value002')
+	topics.put('cccc', 'replica', ttl=10)
+	topics.delete('aaaa')
+	value = topics.get_buffer('bbbb')
+	assert isinstance(value, memoryview) and bytes(value) == b'value002'
+	assert topics.get('bbbb') == 'value002'
+	topics.flush()
+
+	reloaded = TopicStore(node_id='00000000', segments=True)
+	reloaded.load()
+	assert list(reloaded.items()) == [('bbbb', 'value002'), ('cccc', 'replica')]
+	assert reloaded.own_items() == [('bbbb', 'value002')]
+	assert reloaded.expires == topics.expires
+	assert reloaded.stats()['bytes'] == topics.stats()['bytes'] == 4 + 8 + 4 + 7
+
+def test_large_value_served_from_segments(workdir):
+	from app.node import Node
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.topics = TopicStore(node_id='aabbccdd', segments=True)
+	my_node.topics.load()
+	my_node.add_topic('aabbcc01', 'x' * 5000)
+	""" Content itself is stored, chunks are slices of the mapped segment """
+	assert my_node.topics.get('aabbcc01') == 'x' * 5000
+	my_node.handle_find(('127.0.0.1', 9), Message(OP_FIND, 'aabbcc02', 9, topic='aabbcc01', request_id=1))
+	transfer = next(iter(my_node.outgoing_transfers.values()))
+	assert transfer.total == 5000 and isinstance(transfer.view.obj, mmap.mmap)
+	my_node.socket.close()
+
+def test_content_values_cross_text_format(workdir):
+	from app.node import Node
+	from app.protocol import OP_TOP, encode
+	from app.constants import WIRE_TEXT
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.topics = TopicStore(node_id='aabbccdd', segments=True)
+	my_node.topics.load()
+	replica = Node(node_id='aabbcc00', port=0)
+	my_node.kbuckets.register_contact('aabbcc00', '127.0.0.1', replica.node['port'])
+	""" STORE to replica in text format """
+	my_node.add_topic('aabbcc03', 'héllo|wörld: x')
+	select.select([replica.socket], [], [], 1.0)
+	replica.receive_batch()
+	replica.process_inbound()
+	assert replica.topics.get('aabbcc03') == 'héllo|wörld: x'
+
+	""" A value with a colon is not a contact """
+	my_node.handle_message(encode(Message(OP_TOP, 'aabbcc00', 9, topic='aabbcc04', data='x:y', request_id=1), WIRE_TEXT), ('127.0.0.1', 9))
+	assert my_node.topics.get('aabbcc04') == 'x:y'
+	assert my_node.kbuckets.find('aabbcc04') is None
+	my_node.socket.close()
+	replica.socket.close()
+
+def test_add_file_hashes_in_chunks(workdir):
+	from app.node import Node, topiquify_data
+	from app.ingest import digest
+
+	text = 'line of text\n' * 1000
+	with open('topic.txt', 'w') as topic_file:
+		topic_file.write(text)
+	""" Small chunks, same hash as one call """
+	assert digest('topic.txt', chunk_size=100).sha256 == topiquify_data(text)
+	assert digest(iter(['line of text\n'] * 1000)).size == len(text)
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	added = my_node.add_file('topic.txt')
+	assert added.size == len(text) and added.mb_per_second() > 0
+	assert my_node.topics.get(added.topic_id()) == topiquify_data(text)
+	with open('topic.txt', 'rb') as topic_file:
+		my_node.add_file(topic_file, topic_id='aabbcc01')
+	assert my_node.topics.get('aabbcc01') == added.sha256
+	my_node.socket.close()
@@ -0,0 +1,174 @@
+import asyncio
+import base64
+import socket
+import pytest
+
+from app.protocol import Message, OP_PING, OP_PONG, OP_GET, encode, decode
+from app.transport import SendQueue, ReceiveQueue, RateLimiter
+from app.retry import Retry, retry_budget
+from app.async_node import AsyncNode
+
+def test_rate_limiter_refills(workdir):
+	limiter = RateLimiter({'PING': (10.0, 2)})
+	assert [limiter.allow('10.0.0.1', OP_PING, now=0.0) for _ in range(3)] == [True, True, False]
+	""" Other peer and unlimited types are not affected """
+	assert limiter.allow('10.0.0.2', OP_PING, now=0.0)
+	assert limiter.allow('10.0.0.1', OP_GET, now=0.0)
+	assert limiter.allow('10.0.0.1', OP_PING, now=0.1)
+	assert not limiter.allow('10.0.0.1', OP_PING, now=0.1)
+	assert limiter.stats() == {'peers': 2, 'limited': 2}
+
+def test_retry_backoff(workdir):
+	retry = Retry(0.1, now=0.0)
+	assert retry.expires == pytest.approx(retry_budget(0.1)) == pytest.approx(0.7)
+	assert not retry.due(0.05) and retry.due(0.1)
+	assert retry.sample(0.05) == 0.05
+	assert retry.next(0.1) and retry.deadline == pytest.approx(0.3)
+	""" Answer may be for any attempt, no sample """
+	assert retry.sample(0.15) is None
+	assert retry.next(0.3) and retry.deadline == pytest.approx(0.7)
+	assert not retry.next(0.7)
+	""" Budget caps every attempt """
+	capped = Retry(0.5, now=0.0, budget=0.2)
+	assert capped.deadline == 0.2 and not capped.next(0.2)
+
+def test_bad_target_is_dropped_from_send_queue(workdir):
+	sent = list()
+	def sendto(datagram, target):
+		if target[1] == 9:
+			raise OverflowError("port must be 0-65535")
+		sent.append(datagram)
+	send_queue = SendQueue(sendto)
+	for datagram, target in ((b'a', None), (b'b', ('127.0.0.1', 99999)), (b'c', ('127.0.0.1', 9)), (b'd', ('127.0.0.1', 5000))):
+		send_queue.enqueue(datagram, target)
+	""" Each bad datagram is dropped on its own, the next ones still go """
+	assert send_queue.flush() == 1
+	assert sent == [b'd']
+	assert send_queue.stats()['errors'] == 3 and send_queue.depth() == 0
+
+def test_receive_queue_answers_first(workdir):
+	receive_queue = ReceiveQueue(max_queue=3, policy='drop_oldest')
+	requests = [Message(OP_GET, topic=str(index)) for index in range(3)]
+	for request in requests:
+		assert receive_queue.enqueue(request, ('10.0.0.1', 5000), True) is None
+	""" Full: an answer takes the place of the oldest request """
+	pong = Message(OP_PONG)
+	assert receive_queue.enqueue(pong, ('10.0.0.2', 5000), False) is requests[0]
+	assert receive_queue.pop()[0] is pong
+	assert receive_queue.pop()[0] is requests[1]
+
+	tail_drop = ReceiveQueue(max_queue=1, policy='drop_new')
+	tail_drop.enqueue(requests[0], ('10.0.0.1', 5000), True)
+	assert tail_drop.enqueue(requests[1], ('10.0.0.1', 5000), True) is requests[1]
+	assert tail_drop.stats()['dropped'] == 1
+
+def test_answers_are_admitted_first(workdir):
+	from app.node import Node
+	from app.protocol import OP_PRESENT, OP_STATS, OP_STORE
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.receive_queue.policy = 'drop_new'
+	my_node.receive_queue.max_queue = 12
+	sender = ('127.0.0.1', 9)
+	my_node.receive(encode(Message(OP_STORE, '11223344', 9, topic='11223344', data='x')), sender)
+	""" More STATS answers than its rate limit burst, then a STATS query into the full queue """
+	answers = [Message(OP_PRESENT, '11223344', 9)] + [Message(OP_STATS, '11223344', 9, data='{}', request_id=index) for index in range(10)]
+	for answer in answers:
+		my_node.receive(encode(answer), sender)
+	my_node.receive(encode(Message(OP_STATS, '11223344', 9, request_id=11)), sender)
+	assert [my_node.receive_queue.pop()[0].op for _ in range(len(answers) + 1)] == [OP_PRESENT] + [OP_STATS] * 10 + [OP_STORE]
+	assert my_node.receive_queue.stats()['dropped'] == 1
+	assert 'inbound_rate_limited' not in my_node.metrics_snapshot()['counters']
+	my_node.socket.close()
+
+def test_ping_flood_is_shed(workdir, monkeypatch):
+	monkeypatch.setattr('app.node.rate_limit_key', 'address')
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		my_node.rate_limiter.limits[OP_PING] = (1.0, 5)
+		flooder = AsyncNode(node_id='aabbcc01', port=0)
+		await my_node.start()
+		await flooder.start()
+		ping = encode(flooder.build_message(OP_PING, ping_port=flooder.node['port'], request_id=1))
+		for _ in range(50):
+			flooder.send_datagram(ping, ('127.0.0.1', my_node.node['port']))
+		await asyncio.sleep(0.2)
+		""" Answers from the same peer are never limited """
+		status = await my_node.ping(('', '127.0.0.1', flooder.node['port']))
+		snapshot = my_node.metrics_snapshot()
+		for node in (my_node, flooder):
+			node.close()
+		return status, snapshot
+
+	status, snapshot = asyncio.run(scenario())
+	assert status == 0
+	assert snapshot['counters']['inbound_rate_limited']['PING'] == 45
+
+def test_bad_content_does_not_stop_node(workdir):
+	from app.node import Node
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	sender = ('127.0.0.1', 9)
+	""" Decode fine, handlers raise on the topic ID """
+	my_node.receive(base64.b64encode(b'ID|11223344|AT|1|FIND|zz'), sender)
+	my_node.receive(base64.b64encode(b'ID|11223344|AT|1|GET|zz|FOR|55667788'), sender)
+	my_node.receive(encode(Message(OP_PING, '11223344', 9, ping_port=9, request_id=1)), sender)
+	assert my_node.process_inbound() == 3
+	assert my_node.metrics_snapshot()['counters']['messages_malformed'] == {'': 2}
+	assert my_node.metrics_snapshot()['counters']['messages_sent']['PONG'] == 1
+	my_node.socket.close()
+
+""" GET without an origin to answer, PING answer port out of range """
+UNANSWERABLE = [base64.b64encode(b'ID|11223344|AT|5000|GET|11223344'), base64.b64encode(b'ID|11223344|AT|5000|PING|99999')]
+
+def test_unanswerable_requests_do_not_stop_run_loop(workdir):
+	from app.node import Node
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	my_node.batching = True
+	client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	client.bind(('127.0.0.1', 0))
+	client.settimeout(2.0)
+	target = ('127.0.0.1', my_node.node['port'])
+	try:
+		for datagram in UNANSWERABLE:
+			client.sendto(datagram, target)
+			my_node.poll()
+		""" Still answering """
+		client.sendto(encode(Message(OP_PING, '11223344', 5000, ping_port=client.getsockname()[1], request_id=1)), target)
+		my_node.poll()
+		assert decode(client.recvfrom(2048)[0]).op == OP_PONG
+	finally:
+		client.close()
+		my_node.socket.close()
+	assert my_node.metrics_snapshot()['counters']['messages_malformed'] == {'': 2}
+
+def test_unanswerable_requests_do_not_close_transport(workdir):
+	async def scenario():
+		my_node = AsyncNode(node_id='aabbccdd', port=0)
+		pinger = AsyncNode(node_id='aabbcc01', port=0)
+		await my_node.start()
+		await pinger.start()
+		for datagram in UNANSWERABLE:
+			pinger.send_datagram(datagram, ('127.0.0.1', my_node.node['port']))
+		await asyncio.sleep(0.1)
+		""" Both ways, answers and requests still go through node transport """
+		statuses = [await pinger.ping(('', '127.0.0.1', my_node.node['port'])), await my_node.ping(('', '127.0.0.1', pinger.node['port']))]
+		closing = my_node.transport.is_closing()
+		for node in (my_node, pinger):
+			node.close()
+		return statuses, closing
+
+	statuses, closing = asyncio.run(scenario())
+	assert statuses == [0, 0] and not closing
+
+def test_unresolvable_target_is_not_queued(workdir):
+	from app.node import Node
+
+	my_node = Node(node_id='aabbccdd', port=0)
+	assert my_node.resolve_target(None) is None and my_node.resolve_target(('127.0.0.1', 99999)) is None
+	""" Empty table, no closest node """
+	assert my_node.resolve_target('aabbcc01') is None
+	my_node.send_message(my_node.build_message(OP_PONG), None)
+	assert my_node.transport_stats()['sent'] == 0 and my_node.transport_stats()['errors'] == 0
+	my_node.socket.close()
@@ -0,0 +1,95 @@
+import os
+import socket
+import threading
+import time
+import pytest
+
+from app.kbucket import Kbucket
+from app.store import TopicStore
+from app.workers import WorkerHost
+from app.protocol import Message, encode, decode, OP_PING, OP_FIND, OP_TOP
+
+def test_updates_replicate_without_echo(workdir):
+	primary = Kbucket(node_id='00000000', id_length=4)
+	replica = Kbucket(node_id='00000000', id_length=4)
+	for kbuckets in (primary, replica):
+		kbuckets.load_kbuckets()
+	replica.persist = False
+	published = list()
+	primary.replicate = published.append
+	replica.replicate = lambda record: pytest.fail("replica echoed an update")
+
+	primary.register_contact('000000ff', '127.0.0.1', 4000)
+	primary.try_delete_topic('000000ff')
+	primary.register_contact('0000ff00', '127.0.0.1', 4001)
+	for record in published:
+		replica.apply_update(record)
+	assert [contact[0] for contact in replica.get_k_closest_contacts('00000000', 5)] == ['0000ff00']
+
+	topics = TopicStore(node_id='00000000')
+	replica_topics = TopicStore(node_id='00000000')
+	replica_topics.persist = False
+	topics.replicate = replica_topics.apply_update
+	topics.put('aaaa', 'value001')
+	topics.put('bbbb', 'value002')
+	topics.delete('aaaa')
+	assert list(replica_topics.items()) == [('bbbb', 'value002')]
+	""" Only primary writes """
+	replica_topics.save()
+	assert not os.path.exists('data/00000000/topics.json')
+
+def test_workers_share_routing_view(workdir):
+	host = WorkerHost(node_id='aabbccdd', workers=2, bootstrap_nodes=list())
+	host.start()
+	relay = threading.Thread(target=host.relay, daemon=True)
+	relay.start()
+	target = ('127.0.0.1', host.port)
+
+	def request(message):
+		""" Fresh source port, any worker may get it """
+		client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		client.settimeout(2.0)
+		client.sendto(encode(message), target)
+		try:
+			return decode(client.recvfrom(2048)[0])
+		finally:
+			client.close()
+
+	try:
+		""" Close to node ID, large buckets """
+		contact_ids = ['aabbcc0' + str(i) for i in range(8)]
+		for contact_id in contact_ids:
+			ping = Message(OP_PING, contact_id, 5000, ping_port=0)
+			""" Pong goes to ping port, answer on requesting socket instead """
+			client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			client.bind(('127.0.0.1', 0))
+			ping.ping_port = client.getsockname()[1]
+			client.settimeout(2.0)
+			client.sendto(encode(ping), target)
+			client.recvfrom(2048)
+			client.close()
+		""" Let updates reach other worker """
+		time.sleep(0.2)
+
+		for contact_id in contact_ids:
+			for _ in range(3):
+				answer = request(Message(OP_FIND, 'eeeeeeee', 6000, topic=contact_id, request_id=1))
+				assert answer.op == OP_TOP
+				assert answer.data == '127.0.0.1:5000'
+	finally:
+		host.stop()
+		relay.join(2.0)
+	assert host.relayed >= len(contact_ids)
+
+def test_worker_publishes_own_topic(workdir):
+	from app.workers import WorkerNode
+
+	published = list()
+	class Channel:
+		def send(self, update):
+			published.append(update)
+	worker = WorkerNode('aabbccdd', 0, 0, Channel(), bootstrap_nodes=list())
+	worker.add_topic('aabbcc01', 'hello')
+	assert worker.topics.get('aabbcc01') is not None
+	assert [update[0] for update in published] == ['topics']
+	worker.socket.close()
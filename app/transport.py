@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import time
+import collections
+from data.config import max_send_queue, max_receive_queue, receive_drop_policy, rate_limits, rate_limit_peers
+from app.protocol import OP_CODES
+from app.log import get_logger
+
+log = get_logger('transport')
+
+def is_address(target):
+	""" (IP, port) a datagram can be sent to """
+	return isinstance(target, tuple) and len(target) == 2 and isinstance(target[0], str) \
+		and isinstance(target[1], int) and 0 <= target[1] <= 65535
+
+class SendQueue:
+	""" Outbound datagram queue written through the node bound socket """
+	""" Datagrams are queued by send_payload and written in batches by flush() """
+	def __init__(self, sendto, max_queue=max_send_queue):
+		self.sendto = sendto
+		self.max_queue = max_queue
+		self.queue = collections.deque()
+		self.sent = 0
+		self.dropped = 0
+		self.errors = 0
+		self.flushes = 0
+
+	def enqueue(self, datagram, target):
+		""" Returns False when queue is full and datagram is dropped """
+		if len(self.queue) >= self.max_queue:
+			self.dropped = self.dropped + 1
+			return False
+		self.queue.append((datagram, target))
+		return True
+
+	def flush(self, limit=0):
+		""" Write queued datagrams, at most limit (0 = all), returns sent count """
+		sent = 0
+		while len(self.queue) > 0:
+			if limit > 0 and sent >= limit:
+				break
+			datagram, target = self.queue[0]
+			try:
+				if not is_address(target):
+					""" Checked here, a loop transport closes on a bad address instead of raising """
+					raise ValueError("not an (IP, port) address")
+				self.sendto(datagram, target)
+			except (BlockingIOError, InterruptedError):
+				""" Kernel buffer full, keep datagram for next flush """
+				break
+			except Exception as e:
+				""" Unreachable target or bad address, drop it, the next datagrams still go """
+				log.info("flush:: Could not send to %s: %s", target, e)
+				self.errors = self.errors + 1
+			else:
+				sent = sent + 1
+			self.queue.popleft()
+
+		self.sent = self.sent + sent
+		self.flushes = self.flushes + 1
+		return sent
+
+	def depth(self):
+		return len(self.queue)
+
+	def stats(self):
+		return {
+			'depth': len(self.queue),
+			'max_queue': self.max_queue,
+			'sent': self.sent,
+			'dropped': self.dropped,
+			'errors': self.errors,
+			'flushes': self.flushes,
+		}
+
+class ReceiveQueue:
+	""" Inbound messages, decoded, waiting to be handled """
+	""" Answers to our own requests are handled before new requests """
+	""" Full queue sheds requests: oldest one ('drop_oldest') or arriving one ('drop_new') """
+	def __init__(self, max_queue=max_receive_queue, policy=receive_drop_policy):
+		self.max_queue = max_queue
+		self.policy = policy
+		self.responses = collections.deque()
+		self.requests = collections.deque()
+		self.dropped = 0
+
+	def enqueue(self, message, sender, is_request):
+		""" Returns dropped message (arriving or queued one), None when nothing was dropped """
+		item = (message, sender)
+		dropped = None
+		if self.depth() >= self.max_queue:
+			if len(self.requests) > 0 and (not is_request or self.policy == 'drop_oldest'):
+				dropped = self.requests.popleft()[0]
+			else:
+				self.dropped = self.dropped + 1
+				return message
+			self.dropped = self.dropped + 1
+		if is_request:
+			self.requests.append(item)
+		else:
+			self.responses.append(item)
+		return dropped
+
+	def pop(self):
+		""" (message, sender) or None when empty """
+		if len(self.responses) > 0:
+			return self.responses.popleft()
+		if len(self.requests) > 0:
+			return self.requests.popleft()
+		return None
+
+	def depth(self):
+		return len(self.responses) + len(self.requests)
+
+	def stats(self):
+		return {
+			'depth': self.depth(),
+			'requests': len(self.requests),
+			'max_queue': self.max_queue,
+			'dropped': self.dropped,
+		}
+
+class RateLimiter:
+	""" Token bucket per peer and message type """
+	""" limits: message type name -> (tokens per second, burst), types not listed are not limited """
+	def __init__(self, limits=rate_limits, max_peers=rate_limit_peers):
+		self.limits = {OP_CODES[name]: limit for name, limit in limits.items()}
+		self.max_peers = max_peers
+		""" (peer, op) -> [tokens, monotonic time of last refill], least recently used first """
+		self.buckets = collections.OrderedDict()
+		self.limited = 0
+
+	def allow(self, peer, op, now=None):
+		limit = self.limits.get(op)
+		if limit is None:
+			return True
+		rate, burst = limit
+		if now is None:
+			now = time.monotonic()
+		key = (peer, op)
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			bucket = [burst, now]
+			self.buckets[key] = bucket
+			if len(self.buckets) > self.max_peers:
+				""" Forgotten peer starts again with a full bucket """
+				self.buckets.popitem(last=False)
+		else:
+			self.buckets.move_to_end(key)
+			bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+			bucket[1] = now
+		if bucket[0] < 1:
+			self.limited = self.limited + 1
+			return False
+		bucket[0] = bucket[0] - 1
+		return True
+
+	def stats(self):
+		return {'peers': len(self.buckets), 'limited': self.limited}
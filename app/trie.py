@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+class TrieNode:
+	""" Internal node: keys below agree on every bit above bit, and split on it """
+	__slots__ = ('bit', 'zero', 'one')
+
+	def __init__(self, bit):
+		self.bit = bit
+		self.zero = None
+		self.one = None
+
+class XorTrie:
+	""" Path compressed binary trie (crit-bit) over integer IDs, ordered by XOR distance to a target """
+	""" Walking towards the target bits first yields entries by increasing XOR distance """
+	""" One internal node per entry whatever the key length """
+	""" Leaves are (key, entry) pairs, or the entries themselves when key(entry) gives their key """
+	def __init__(self, key=None):
+		self.key_of = key
+		self.root = None
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def __contains__(self, key):
+		return self.find_leaf(key) is not None
+
+	def leaf_key(self, leaf):
+		return leaf[0] if self.key_of is None else self.key_of(leaf)
+
+	def leaf_entry(self, leaf):
+		return leaf[1] if self.key_of is None else leaf
+
+	def find_leaf(self, key):
+		node = self.root
+		while isinstance(node, TrieNode):
+			node = node.one if (key >> node.bit) & 1 else node.zero
+		if node is not None and self.leaf_key(node) == key:
+			return node
+		return None
+
+	def get(self, key):
+		leaf = self.find_leaf(key)
+		return None if leaf is None else self.leaf_entry(leaf)
+
+	def insert(self, key, entry):
+		""" Insert or replace entry for key """
+		leaf = entry if self.key_of is not None else (key, entry)
+		if self.root is None:
+			self.root = leaf
+			self.size = 1
+			return
+
+		""" Closest stored key tells at which bit new key branches off """
+		node = self.root
+		while isinstance(node, TrieNode):
+			node = node.one if (key >> node.bit) & 1 else node.zero
+		crit = (self.leaf_key(node) ^ key).bit_length() - 1
+
+		parent = None
+		node = self.root
+		while isinstance(node, TrieNode) and node.bit > crit:
+			parent = node
+			node = node.one if (key >> node.bit) & 1 else node.zero
+
+		if crit < 0:
+			""" Same key, replace leaf """
+			replacement = leaf
+		else:
+			replacement = TrieNode(crit)
+			if (key >> crit) & 1:
+				replacement.zero, replacement.one = node, leaf
+			else:
+				replacement.zero, replacement.one = leaf, node
+			self.size = self.size + 1
+
+		if parent is None:
+			self.root = replacement
+		elif (key >> parent.bit) & 1:
+			parent.one = replacement
+		else:
+			parent.zero = replacement
+
+	def remove(self, key):
+		""" Remove key, returns removed entry or None """
+		grandparent = None
+		parent = None
+		node = self.root
+		while isinstance(node, TrieNode):
+			grandparent, parent = parent, node
+			node = node.one if (key >> node.bit) & 1 else node.zero
+		if node is None or self.leaf_key(node) != key:
+			return None
+
+		self.size = self.size - 1
+		if parent is None:
+			self.root = None
+			return self.leaf_entry(node)
+		""" Sibling takes parent place """
+		sibling = parent.zero if (key >> parent.bit) & 1 else parent.one
+		if grandparent is None:
+			self.root = sibling
+		elif (key >> grandparent.bit) & 1:
+			grandparent.one = sibling
+		else:
+			grandparent.zero = sibling
+		return self.leaf_entry(node)
+
+	def closest(self, target, k=1, exclude_exact=False, accept=None):
+		""" Returns up to k (key, entry) by increasing XOR distance to target """
+		""" accept(entry) filters entries without stopping the walk """
+		result = list()
+		if k <= 0 or self.root is None:
+			return result
+
+		stack = [self.root]
+		while len(stack) > 0 and len(result) < k:
+			node = stack.pop()
+			if not isinstance(node, TrieNode):
+				key = self.leaf_key(node)
+				if exclude_exact and key == target:
+					continue
+				entry = self.leaf_entry(node)
+				if accept is None or accept(entry):
+					result.append((key, entry))
+				continue
+			""" Push farther branch first, closer branch is popped first """
+			if (target >> node.bit) & 1:
+				stack.append(node.zero)
+				stack.append(node.one)
+			else:
+				stack.append(node.one)
+				stack.append(node.zero)
+		return result
+
+	def entries(self):
+		""" Every entry, by increasing key """
+		stack = [] if self.root is None else [self.root]
+		while len(stack) > 0:
+			node = stack.pop()
+			if isinstance(node, TrieNode):
+				stack.append(node.one)
+				stack.append(node.zero)
+			else:
+				yield self.leaf_entry(node)
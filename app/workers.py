@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+import os
+import socket
+import signal
+import multiprocessing
+from multiprocessing.connection import wait
+from data.config import ip_address, worker_count
+from app.node import Node
+from app.log import get_logger, setup_logging
+
+log = get_logger('node')
+
+class WorkerNode(Node):
+	""" One of several processes serving the same node ID on the same port """
+	""" Routing table and topic changes are published on channel, the host relays them to other workers """
+	""" Worker 0 is primary: it bootstraps and is the only one writing to disk """
+	def __init__(self, node_id, port, index, channel, bootstrap_nodes=None):
+		self.index = index
+		self.channel = channel
+		""" None: fetch from bootstrap source """
+		self.bootstrap_nodes = bootstrap_nodes
+		self.updates_received = 0
+		super().__init__(node_id=node_id, port=port, reuse_port=True)
+
+	def is_primary(self):
+		return self.index == 0
+
+	def load_storage(self, kbuckets_full_path=''):
+		""" Every worker loads the same snapshot, changes made while loading are not published """
+		self.kbuckets.replicate = self.topics.replicate = None
+		self.kbuckets.persist = self.topics.persist = self.is_primary()
+		super().load_storage(kbuckets_full_path)
+		self.kbuckets.replicate = self.publish_route
+		self.topics.replicate = self.publish_topic
+
+	def publish_route(self, record):
+		self.publish(('kbuckets', record))
+
+	def publish_topic(self, record):
+		self.publish(('topics', record))
+
+	def publish(self, update):
+		try:
+			self.channel.send(update)
+		except (OSError, EOFError):
+			""" Host is gone, keep serving with local view """
+			pass
+
+	def readers(self):
+		return [self.socket, self.channel]
+
+	def handle_readable(self, reader):
+		if reader is self.channel:
+			self.receive_updates()
+		else:
+			self.receive_batch()
+
+	def receive_updates(self):
+		""" Apply every update relayed by host """
+		while self.channel.poll():
+			try:
+				store, record = self.channel.recv()
+			except EOFError:
+				break
+			if store == 'kbuckets':
+				self.kbuckets.apply_update(record)
+			else:
+				self.topics.apply_update(record)
+			self.updates_received = self.updates_received + 1
+
+	def start_bootstrap(self):
+		""" Primary validates persisted contacts, evictions reach replicas as updates """
+		if self.is_primary():
+			super().start_bootstrap()
+
+	def fetch_bootstrap_nodes(self):
+		""" Primary bootstraps, contacts it learns reach replicas as updates """
+		if not self.is_primary():
+			return list()
+		if self.bootstrap_nodes is not None:
+			return self.bootstrap_nodes
+		return super().fetch_bootstrap_nodes()
+
+	def save_node(self):
+		if self.is_primary():
+			super().save_node()
+
+def run_worker(node_id, port, index, channel, bootstrap_nodes):
+	""" Worker process entry point, log writer thread does not survive fork """
+	setup_logging()
+	WorkerNode(node_id, port, index, channel, bootstrap_nodes).run()
+
+class WorkerHost:
+	""" Runs one node on several cores """
+	""" Workers bind the same UDP port with SO_REUSEPORT, the kernel spreads peers between them """
+	""" Host relays routing table and topic updates from each worker to every other one """
+	def __init__(self, node_id, port=0, workers=worker_count, bootstrap_nodes=None):
+		self.node_id = node_id
+		self.port = int(port)
+		self.workers = workers if workers > 0 else os.cpu_count()
+		self.bootstrap_nodes = bootstrap_nodes
+		self.processes = list()
+		self.channels = list()
+		self.relayed = 0
+
+	def start(self):
+		if self.port == 0:
+			self.port = pick_port()
+		for index in range(self.workers):
+			host_end, worker_end = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=run_worker, args=(self.node_id, self.port, index, worker_end, self.bootstrap_nodes), daemon=True)
+			process.start()
+			worker_end.close()
+			self.processes.append(process)
+			self.channels.append(host_end)
+		log.info("Running node %s on UDP port %d with %d workers", self.node_id, self.port, self.workers)
+
+	def relay(self):
+		""" Forward updates until every worker is gone """
+		channels = list(self.channels)
+		while len(channels) > 0:
+			for channel in wait(channels):
+				try:
+					update = channel.recv()
+				except (EOFError, OSError):
+					channels.remove(channel)
+					continue
+				for other in self.channels:
+					if other is not channel and other in channels:
+						try:
+							other.send(update)
+						except OSError:
+							pass
+				self.relayed = self.relayed + 1
+
+	def stop(self, timeout=2.0):
+		""" Ask workers for a clean shutdown, as on Ctrl-C """
+		for process in self.processes:
+			if process.is_alive():
+				os.kill(process.pid, signal.SIGINT)
+		for process in self.processes:
+			process.join(timeout)
+			if process.is_alive():
+				process.terminate()
+
+	def run(self):
+		self.start()
+		try:
+			self.relay()
+		except KeyboardInterrupt:
+			""" Workers got the signal too """
+			pass
+		self.stop()
+
+def pick_port():
+	""" Free port every worker can bind """
+	probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	probe.bind((ip_address, 0))
+	port = probe.getsockname()[1]
+	probe.close()
+	return port
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Run every benchmark, results as one JSON document to compare runs over time """
+""" Run from repository root: python -m benchmarks [--quick] [--nodes 1000 10000] [--contacts 1000000] [--output FILE] """
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from benchmarks import micro_bench, protocol_bench, network_sim, memory_bench
+
+def revision():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run(quick=False, nodes=(1000,), lookups=500, loss=0.0, seed=1, contacts=1000000):
+	number = 200 if quick else 2000
+	results = {
+		'revision': revision(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'micro': micro_bench.run(number=number, seed=seed),
+		'protocol': protocol_bench.run(number=number * 10),
+		'network': list(),
+		'memory': memory_bench.run(contacts=contacts // 10 if quick else contacts, seed=seed),
+	}
+	for count in nodes:
+		results['network'].append(network_sim.run(nodes=count, lookups=lookups // 5 if quick else lookups, loss=loss, seed=seed))
+	return results
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark suite')
+	parser.add_argument('--quick', action='store_true', help='fewer iterations and lookups')
+	parser.add_argument('--nodes', type=int, nargs='+', default=[1000], help='simulated network sizes')
+	parser.add_argument('--lookups', type=int, default=500)
+	parser.add_argument('--loss', type=float, default=0.0)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--contacts', type=int, default=1000000, help='routing table size for memory benchmark')
+	parser.add_argument('--output', help='write JSON to file instead of stdout')
+	arguments = parser.parse_args()
+
+	results = run(arguments.quick, arguments.nodes, arguments.lookups, arguments.loss, arguments.seed, arguments.contacts)
+	if arguments.output:
+		with open(arguments.output, 'w') as output_file:
+			json.dump(results, output_file, indent=2)
+	else:
+		json.dump(results, sys.stdout, indent=2)
+		print()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Open loop load generator: PING, GET and INFO sent to a running node at a fixed rate over one UDP socket """
+""" Requests leave on schedule whether or not earlier ones were answered, so a saturated node shows up as """
+""" loss and latency instead of slowing the generator down; several rates ramp load up to find saturation """
+""" Nodes rate limit requests per IP (rate_limits in data/config.py), on loopback every request comes from """
+""" one IP: run the target with limits raised, e.g. rate_limits = {}, to measure the node and not its limiter """
+""" Run from repository root: python run.py loadgen IP PORT [--rate 1000 5000 20000] [--duration 10] """
+""" [--mix PING=1,GET=8,INFO=1] [--keys 10000] [--skew zipf] [--wire binary] """
+
+import sys
+import json
+import time
+import bisect
+import random
+import select
+import socket
+import struct
+import argparse
+import itertools
+import collections
+from data.config import id_length
+from app.constants import WIRE_TEXT, WIRE_BINARY
+from app.protocol import Message, encode, decode, OP_CODES, OP_LABELS, OP_PING, OP_PONG, OP_GET, OP_TOP, OP_NOP, OP_INFO, RESPONSE_OPS
+from benchmarks.network_sim import summary
+
+""" Requests the generator sends, INFO is never answered """
+LOAD_OPS = (OP_PING, OP_GET, OP_INFO)
+""" Datagrams read per loop iteration, then sending resumes """
+RECEIVE_BATCH = 1024
+""" Socket buffers, large enough for a burst of answers while sending """
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+def parse_mix(mix):
+	""" PING=1,GET=8,INFO=1 -> {op: weight} """
+	weights = {}
+	for item in mix.split(','):
+		name, _, weight = item.partition('=')
+		op = OP_CODES.get(name.strip().upper())
+		if op not in LOAD_OPS:
+			raise ValueError("Unsupported request in mix: " + name)
+		weights[op] = float(weight) if weight != '' else 1.0
+	if sum(weights.values()) <= 0:
+		raise ValueError("Mix has no weight")
+	return weights
+
+def key_ids(keys, seed=1):
+	""" Topic IDs of keyspace, same IDs for same seed so they can be stored on target beforehand """
+	rand = random.Random(seed)
+	return [format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x') for _ in range(keys)]
+
+def popularity(keys, skew='uniform', exponent=1.0):
+	""" Cumulative weights of keys, rank r weighs 1 / r^exponent under zipf """
+	if skew == 'uniform':
+		return list(range(1, keys + 1))
+	if skew == 'zipf':
+		return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, keys + 1)))
+	raise ValueError("Unknown skew: " + skew)
+
+class LoadGenerator:
+	""" One socket, one node identity: target registers it as a contact and answers GET to it """
+	def __init__(self, target, mix='PING=1,GET=8,INFO=1', keys=10000, skew='uniform', exponent=1.0, wire=WIRE_BINARY, timeout=1.0, max_batch=256, seed=1):
+		self.target = target
+		self.rand = random.Random(seed)
+		weights = parse_mix(mix)
+		self.ops = list(weights)
+		self.op_weights = list(itertools.accumulate(weights.values()))
+		self.keys = key_ids(keys, seed)
+		""" Popular keys are spread over ID space, not neighbours of each other """
+		self.rand.shuffle(self.keys)
+		self.key_weights = popularity(keys, skew, exponent)
+		self.wire = wire
+		self.timeout = timeout
+		""" Sends per iteration when behind schedule, answers are read in between """
+		self.max_batch = max_batch
+		self.node_id = format(self.rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x')
+		self.request_ids = itertools.count(self.rand.getrandbits(32))
+
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+			try:
+				self.socket.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+			except OSError:
+				pass
+		self.socket.bind(('', 0))
+		self.socket.setblocking(False)
+		self.port = self.socket.getsockname()[1]
+
+	def pick(self, values, cumulative):
+		return values[bisect.bisect_right(cumulative, self.rand.random() * cumulative[-1])]
+
+	def build_request(self, op, request_id):
+		topic = self.pick(self.keys, self.key_weights)
+		if op == OP_PING:
+			message = Message(OP_PING, self.node_id, self.port, ping_port=self.port, request_id=request_id)
+		elif op == OP_GET:
+			""" Answer goes to origin, target knows our address from the request itself """
+			message = Message(OP_GET, self.node_id, self.port, topic=topic, origin=self.node_id, request_id=request_id)
+		else:
+			message = Message(OP_INFO, self.node_id, self.port, topic=topic, origin=self.node_id)
+		return encode(message, self.wire)
+
+	def run_step(self, rate, duration):
+		""" Send rate requests per second for duration seconds, then wait for the last answers """
+		total = int(rate * duration)
+		interval = 1.0 / rate
+		counters = {op: collections.Counter() for op in self.ops}
+		latencies = {op: list() for op in self.ops}
+		""" request_id -> (op, sent at), and timeouts in sending order """
+		outstanding = {}
+		waiting = collections.deque()
+		lags = list()
+		totals = collections.Counter()
+		sent = 0
+		started = time.perf_counter()
+		last_sent = last_answer = started
+
+		while True:
+			now = time.perf_counter()
+			due = min(total, int((now - started) * rate) + 1)
+			batch = 0
+			while sent < due and batch < self.max_batch:
+				op = self.pick(self.ops, self.op_weights)
+				request_id = next(self.request_ids) & 0xFFFFFFFF
+				datagram = self.build_request(op, request_id)
+				try:
+					self.socket.sendto(datagram, self.target)
+				except (BlockingIOError, InterruptedError):
+					""" Our own socket buffer is full, request never left """
+					totals['send_errors'] = totals['send_errors'] + 1
+				sent_at = last_sent = time.perf_counter()
+				lags.append(sent_at - started - sent * interval)
+				counters[op]['sent'] = counters[op]['sent'] + 1
+				if op != OP_INFO:
+					outstanding[request_id] = (op, sent_at)
+					waiting.append((sent_at + self.timeout, request_id))
+				sent = sent + 1
+				batch = batch + 1
+
+			if self.receive(outstanding, counters, latencies, totals) > 0:
+				last_answer = time.perf_counter()
+
+			now = time.perf_counter()
+			while len(waiting) > 0 and waiting[0][0] <= now:
+				entry = outstanding.pop(waiting.popleft()[1], None)
+				if entry is not None:
+					counters[entry[0]]['lost'] = counters[entry[0]]['lost'] + 1
+
+			if sent >= total:
+				if len(outstanding) == 0:
+					break
+				wait = waiting[0][0] - now
+			else:
+				wait = started + sent * interval - now
+			if wait > 0:
+				select.select([self.socket], [], [], wait)
+
+		""" Schedule of total requests spans total intervals """
+		send_seconds = last_sent - started + interval
+		return self.report(rate, duration, counters, latencies, lags, totals, send_seconds, last_answer - started)
+
+	def receive(self, outstanding, counters, latencies, totals):
+		""" Match answers to requests, returns answers read """
+		answered = 0
+		for _ in range(RECEIVE_BATCH):
+			try:
+				datagram, sender = self.socket.recvfrom(65536)
+			except (BlockingIOError, InterruptedError):
+				break
+			received_at = time.perf_counter()
+			try:
+				message = decode(datagram)
+			except (ValueError, IndexError, KeyError, struct.error):
+				totals['malformed'] = totals['malformed'] + 1
+				continue
+			if message.op == OP_PING:
+				""" Target checking we are alive, stay in its routing table so GET answers reach us """
+				self.socket.sendto(encode(Message(OP_PONG, self.node_id, self.port, request_id=message.request_id), message.wire), (sender[0], int(message.ping_port or sender[1])))
+				continue
+			entry = outstanding.pop(message.request_id, None) if message.op in RESPONSE_OPS else None
+			if entry is None:
+				""" Late, duplicate, or a request forwarded to us """
+				totals['unmatched'] = totals['unmatched'] + 1
+				continue
+			op, sent_at = entry
+			counters[op]['answered'] = counters[op]['answered'] + 1
+			if message.op == OP_TOP:
+				counters[op]['hits'] = counters[op]['hits'] + 1
+			elif message.op == OP_NOP:
+				counters[op]['misses'] = counters[op]['misses'] + 1
+			latencies[op].append(received_at - sent_at)
+			answered = answered + 1
+		return answered
+
+	def report(self, rate, duration, counters, latencies, lags, totals, send_seconds, answer_seconds):
+		sent = sum(counter['sent'] for counter in counters.values())
+		answered = sum(counter['answered'] for counter in counters.values())
+		lost = sum(counter['lost'] for counter in counters.values())
+		operations = {}
+		for op, counter in counters.items():
+			operations[OP_LABELS[op]] = {
+				**{name: counter[name] for name in ('sent', 'answered', 'lost')},
+				'latency_ms': summary(latencies[op], 1000),
+			}
+			if op == OP_GET:
+				operations[OP_LABELS[op]]['hits'] = counter['hits']
+				operations[OP_LABELS[op]]['misses'] = counter['misses']
+		return {
+			'target_rate': rate,
+			'duration': duration,
+			'sent': sent,
+			'send_rate': sent / send_seconds,
+			'send_errors': totals['send_errors'],
+			'answered': answered,
+			'throughput': answered / answer_seconds if answer_seconds > 0 else 0.0,
+			'lost': lost,
+			'loss_rate': lost / max(1, answered + lost),
+			'unmatched': totals['unmatched'],
+			'latency_ms': summary([latency for values in latencies.values() for latency in values], 1000),
+			'schedule_lag_ms': summary(lags, 1000),
+			'operations': operations,
+		}
+
+	def close(self):
+		self.socket.close()
+
+def run(ip, port, rates=(1000,), duration=10.0, mix='PING=1,GET=8,INFO=1', keys=10000, skew='uniform', exponent=1.0, wire='binary', timeout=1.0, max_batch=256, seed=1):
+	generator = LoadGenerator((ip, int(port)), mix, keys, skew, exponent, WIRE_BINARY if wire == 'binary' else WIRE_TEXT, timeout, max_batch, seed)
+	try:
+		steps = [generator.run_step(rate, duration) for rate in rates]
+	finally:
+		generator.close()
+	return {
+		'target': ip + ':' + str(port),
+		'node_id': generator.node_id,
+		'mix': mix,
+		'keys': keys,
+		'skew': skew,
+		'exponent': exponent,
+		'wire': wire,
+		'timeout': timeout,
+		'steps': steps,
+	}
+
+def parse_arguments(argv):
+	parser = argparse.ArgumentParser(prog='run.py loadgen', description='Open loop load generator against a running node')
+	parser.add_argument('ip')
+	parser.add_argument('port', type=int)
+	parser.add_argument('--rates', '--rate', type=float, nargs='+', default=[1000.0], help='requests per second, one step per rate')
+	parser.add_argument('--duration', type=float, default=10.0, help='seconds per step')
+	parser.add_argument('--mix', default='PING=1,GET=8,INFO=1', help='request weights')
+	parser.add_argument('--keys', type=int, default=10000, help='topic IDs requested by GET and INFO')
+	parser.add_argument('--skew', choices=('uniform', 'zipf'), default='uniform', help='key popularity')
+	parser.add_argument('--exponent', type=float, default=1.0, help='zipf exponent')
+	parser.add_argument('--wire', choices=('binary', 'text'), default='binary')
+	parser.add_argument('--timeout', type=float, default=1.0, help='seconds before a request is counted lost')
+	parser.add_argument('--max-batch', type=int, default=256, help='sends in a row when behind schedule')
+	parser.add_argument('--seed', type=int, default=1)
+	arguments = parser.parse_args(argv)
+	try:
+		parse_mix(arguments.mix)
+	except ValueError as e:
+		parser.error(str(e))
+	return arguments
+
+def main(argv):
+	print(json.dumps(run(**vars(parse_arguments(argv))), indent=2))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Routing table footprint: memory per contact, load time and queries on a large table """
+""" Run from repository root: python -m benchmarks.memory_bench [--contacts 1000000] [--id-length 20] """
+
+import os
+import gc
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from app.kbucket import Kbucket, compute_distance
+from benchmarks.micro_bench import measure
+
+def write_snapshot(node_id, contacts, id_length, rand):
+	""" kbuckets.json with random contacts, bucket limits do not apply to a loaded snapshot """
+	snapshot = {}
+	for _ in range(contacts):
+		contact_id = format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x')
+		address = '10.%d.%d.%d' % (rand.randrange(256), rand.randrange(256), rand.randrange(256))
+		snapshot.setdefault(compute_distance(node_id, contact_id, id_length), list()).append([contact_id, address, rand.randrange(1024, 65536)])
+	os.makedirs('data/' + node_id, exist_ok=True)
+	with open('data/' + node_id + '/kbuckets.json', 'w') as snapshot_file:
+		json.dump(snapshot, snapshot_file)
+	return snapshot
+
+def json_bytes_per_contact(snapshot, sample=10000):
+	""" Footprint of contacts as decoded JSON lists, the former in memory form """
+	entries = [entry for bucket in snapshot.values() for entry in bucket][:sample]
+	encoded = json.dumps(entries)
+	tracemalloc.start()
+	decoded = json.loads(encoded)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size // max(1, len(decoded))
+
+def run(contacts=1000000, id_length=20, seed=1):
+	rand = random.Random(seed)
+	node_id = format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x')
+	previous = os.getcwd()
+	with tempfile.TemporaryDirectory() as workdir:
+		os.chdir(workdir)
+		try:
+			snapshot = write_snapshot(node_id, contacts, id_length, rand)
+			json_bytes = json_bytes_per_contact(snapshot)
+			del snapshot
+			gc.collect()
+
+			kbuckets = Kbucket(node_id=node_id, id_length=id_length)
+			started = time.perf_counter()
+			kbuckets.load_kbuckets()
+			load_seconds = time.perf_counter() - started
+			loaded = len(kbuckets)
+			del kbuckets
+			gc.collect()
+
+			""" Second load under tracemalloc, it slows loading down """
+			tracemalloc.start()
+			kbuckets = Kbucket(node_id=node_id, id_length=id_length)
+			kbuckets.load_kbuckets()
+			gc.collect()
+			table_bytes = tracemalloc.get_traced_memory()[0]
+			tracemalloc.stop()
+
+			targets = [format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x') for _ in range(1000)]
+			cycle = iter(targets * 50)
+			k_closest_us = measure(lambda: kbuckets.get_k_closest_contacts(next(cycle), 20), 1000)
+			started = time.perf_counter()
+			kbuckets.save()
+			save_seconds = time.perf_counter() - started
+			return {
+				'contacts': loaded,
+				'id_length': id_length,
+				'load_seconds': load_seconds,
+				'save_seconds': save_seconds,
+				'bytes_per_contact': table_bytes // max(1, loaded),
+				'json_bytes_per_contact': json_bytes,
+				'k_closest_us': k_closest_us,
+			}
+		finally:
+			os.chdir(previous)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Routing table memory benchmark')
+	parser.add_argument('--contacts', type=int, default=1000000)
+	parser.add_argument('--id-length', type=int, default=20, help='ID bytes')
+	parser.add_argument('--seed', type=int, default=1)
+	arguments = parser.parse_args()
+	print(json.dumps(run(arguments.contacts, arguments.id_length, arguments.seed), indent=2))
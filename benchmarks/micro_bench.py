@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Microbenchmarks: distance, routing table queries and updates, message handling, file ingestion """
+""" Run from repository root: python -m benchmarks.micro_bench """
+
+import os
+import json
+import random
+import time
+import timeit
+import hashlib
+import tempfile
+from data.config import id_length
+from app.kbucket import Kbucket, compute_distance
+from app.node import Node
+from app import ingest
+from app.protocol import *
+from app.constants import WIRE_TEXT, WIRE_BINARY
+
+def measure(function, number):
+	""" Best of 5, microseconds per call """
+	return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+def random_id(rand):
+	return format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x')
+
+def filled_kbuckets(node_id, contacts, rand):
+	kbuckets = Kbucket(node_id=node_id, id_length=id_length)
+	kbuckets.load_kbuckets()
+	for port in range(contacts):
+		kbuckets.register_contact(random_id(rand), '127.0.0.1', 10000 + port)
+	return kbuckets
+
+def bench_compute_distance(rand, number):
+	pairs = [(random_id(rand), random_id(rand)) for _ in range(1000)]
+	cycle = iter(pairs * (number // len(pairs) + 1) * 5)
+	def step():
+		first, second = next(cycle)
+		compute_distance(first, second, id_length)
+	return {'us': measure(step, number)}
+
+def bench_closest(rand, number, contacts):
+	kbuckets = filled_kbuckets(random_id(rand), contacts, rand)
+	targets = [random_id(rand) for _ in range(1000)]
+	cycle = iter(targets * (number // len(targets) + 1) * 10)
+	return {
+		'contacts': len(kbuckets.get_all_known_nodes()),
+		'closest_us': measure(lambda: kbuckets.get_closest_known_node(next(cycle)), number),
+		'k_closest_us': measure(lambda: kbuckets.get_k_closest_contacts(next(cycle), 20), number),
+	}
+
+def bench_register_and_save(rand, number, contacts):
+	node_id = random_id(rand)
+	kbuckets = filled_kbuckets(node_id, contacts, rand)
+	new_ids = [random_id(rand) for _ in range(number * 5)]
+	cycle = iter(new_ids)
+	return {
+		'register_topic_us': measure(lambda: kbuckets.register_contact(next(cycle), '127.0.0.1', 9000), number),
+		'flush_us': measure(kbuckets.flush, 10),
+		'save_ms': measure(kbuckets.save, 5) / 1000,
+	}
+
+def bench_handle_message(rand, number):
+	""" Parse and dispatch, answers are queued and dropped unsent """
+	node = Node(node_id=random_id(rand), port=0)
+	for port in range(200):
+		node.kbuckets.register_contact(random_id(rand), '127.0.0.1', 10000 + port)
+	node.batching = True
+	sender = ('127.0.0.1', 9999)
+	samples = {
+		'PING': Message(OP_PING, 'aabbccdd', 9999, ping_port=9999, request_id=1),
+		'FIND': Message(OP_FIND, 'aabbccdd', 9999, topic=random_id(rand), request_id=2),
+		'GET': Message(OP_GET, 'aabbccdd', 9999, topic=random_id(rand), origin='aabbccdd', request_id=3),
+	}
+	results = {}
+	for name, message in samples.items():
+		for wire_name, wire in (('text', WIRE_TEXT), ('binary', WIRE_BINARY)):
+			datagram = encode(message, wire)
+			def step():
+				node.handle_message(datagram, sender)
+				node.send_queue.queue.clear()
+			results[name + '_' + wire_name + '_us'] = measure(step, number)
+			if name == 'PING' and wire == WIRE_TEXT:
+				""" Overhead of counters and handler timing """
+				node.metrics.enabled = False
+				results[name + '_' + wire_name + '_metrics_off_us'] = measure(step, number)
+				node.metrics.enabled = True
+	node.socket.close()
+	return results
+
+def bench_ingest(rand, megabytes):
+	""" File hashed chunk by chunk on pool threads, against one hashlib call on data in memory """
+	data = rand.randbytes(megabytes * 1024 * 1024)
+	with open('ingest.bin', 'wb') as ingest_file:
+		ingest_file.write(data)
+	digest = min((ingest.digest('ingest.bin') for _ in range(3)), key=lambda digest: digest.seconds)
+	started = time.perf_counter()
+	hashlib.sha256(data).hexdigest()
+	single_call_seconds = time.perf_counter() - started
+	os.remove('ingest.bin')
+	return {
+		'megabytes': megabytes,
+		'mb_per_s': digest.mb_per_second(),
+		'single_call_mb_per_s': len(data) / 1e6 / single_call_seconds,
+	}
+
+def run(number=2000, contacts=1000, seed=1):
+	rand = random.Random(seed)
+	""" Routing table writes go to a scratch directory """
+	previous = os.getcwd()
+	with tempfile.TemporaryDirectory() as workdir:
+		os.chdir(workdir)
+		try:
+			return {
+				'compute_distance': bench_compute_distance(rand, number * 10),
+				'get_closest_known_node': bench_closest(rand, number, contacts),
+				'register_topic_save': bench_register_and_save(rand, number, contacts),
+				'handle_message': bench_handle_message(rand, number),
+				'ingest': bench_ingest(rand, max(8, number // 32)),
+			}
+		finally:
+			os.chdir(previous)
+
+if __name__ == '__main__':
+	print(json.dumps(run(), indent=2))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Simulated network: thousands of nodes in one process, no socket """
+""" Nodes run the real message handling and iterative lookup, datagrams go through an in-memory network """
+""" with injected latency and loss, on an event loop whose clock jumps instead of sleeping, so a run is """
+""" deterministic for a seed and takes seconds of CPU whatever the simulated latency """
+""" Run from repository root: python -m benchmarks.network_sim --nodes 1000 --lookups 500 """
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import selectors
+from data.config import id_length
+from app.trie import XorTrie
+from app.async_node import AsyncNode
+
+class VirtualSelector(selectors.SelectSelector):
+	""" Advances loop clock by the wait asked for, instead of blocking """
+	def __init__(self, loop):
+		super().__init__()
+		self.loop = loop
+
+	def select(self, timeout=None):
+		if timeout is None:
+			raise RuntimeError("Simulation stalled, nothing scheduled")
+		self.loop.clock = self.loop.clock + timeout
+		return super().select(0)
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+	""" Event loop on simulated time, seconds since start of simulation """
+	def __init__(self):
+		self.clock = 0.0
+		super().__init__(VirtualSelector(self))
+
+	def time(self):
+		return self.clock
+
+class SimSocket:
+	""" Stands for node UDP socket """
+	def __init__(self, network, address):
+		self.network = network
+		self.address = address
+
+	def sendto(self, datagram, target):
+		self.network.send(self.address, datagram, target)
+		return len(datagram)
+
+	def getsockname(self):
+		return self.address
+
+	def close(self):
+		pass
+
+class SimNode(AsyncNode):
+	""" Node on the simulated network, nothing written to disk """
+	def __init__(self, network, node_id, port):
+		self.network = network
+		super().__init__(node_id=node_id, port=port)
+		self.kbuckets.persist = False
+		self.topics.persist = False
+
+	def bind(self, port, reuse_port=False):
+		self.socket = SimSocket(self.network, ('127.0.0.1', port))
+
+class SimNetwork:
+	""" Delivers datagrams after latency + jitter seconds, drops a loss fraction of them """
+	def __init__(self, loop, latency=0.02, jitter=0.01, loss=0.0, seed=0):
+		self.loop = loop
+		self.latency = latency
+		self.jitter = jitter
+		self.loss = loss
+		self.random = random.Random(seed)
+		""" Port -> node """
+		self.nodes = {}
+		self.datagrams = 0
+		self.dropped = 0
+
+	def send(self, source, datagram, target):
+		self.datagrams = self.datagrams + 1
+		node = self.nodes.get(int(target[1]))
+		if node is None or self.random.random() < self.loss:
+			self.dropped = self.dropped + 1
+			return
+		delay = self.latency + self.random.random() * self.jitter
+		self.loop.call_later(delay, node.handle_message, datagram, source)
+
+def build(network, nodes, contacts, neighbors, topics, seed):
+	""" Nodes know random contacts and their closest neighbors, each topic is held by its closest node """
+	rand = random.Random(seed)
+	node_ids = set()
+	while len(node_ids) < nodes:
+		node_ids.add(rand.getrandbits(id_length * 8))
+	node_ids = sorted(node_ids)
+	rand.shuffle(node_ids)
+
+	index = XorTrie()
+	for port, node_id in enumerate(node_ids, 10000):
+		node = SimNode(network, format(node_id, '0' + str(id_length * 2) + 'x'), port)
+		network.nodes[port] = node
+		index.insert(node_id, node)
+
+	all_nodes = list(network.nodes.values())
+	for node in all_nodes:
+		known = rand.sample(all_nodes, min(contacts, len(all_nodes)))
+		known.extend(entry for _, entry in index.closest(int(node.node['id'], 16), neighbors, exclude_exact=True))
+		for contact in known:
+			if contact is not node:
+				node.kbuckets.register_contact(contact.node['id'], '127.0.0.1', contact.node['port'])
+
+	topic_ids = list()
+	for i in range(topics):
+		topic_id = format(rand.getrandbits(id_length * 8), '0' + str(id_length * 2) + 'x')
+		holder = index.closest(int(topic_id, 16), 1)[0][1]
+		holder.topics.put(topic_id, 'value-' + str(i))
+		topic_ids.append(topic_id)
+	return all_nodes, topic_ids
+
+async def run_lookups(loop, all_nodes, topic_ids, lookups, concurrency, seed):
+	rand = random.Random(seed)
+	results = list()
+
+	async def one_lookup(node, topic_id):
+		started = loop.time()
+		result = await node.lookup(topic_id)
+		results.append((result, loop.time() - started))
+
+	for first in range(0, lookups, concurrency):
+		batch = [one_lookup(rand.choice(all_nodes), rand.choice(topic_ids)) for _ in range(min(concurrency, lookups - first))]
+		await asyncio.gather(*batch)
+	return results
+
+def percentile(values, fraction):
+	""" Nearest rank """
+	if len(values) == 0:
+		return None
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summary(values, scale=1.0):
+	if len(values) == 0:
+		return {}
+	return {
+		'mean': sum(values) / len(values) * scale,
+		'p50': percentile(values, 0.5) * scale,
+		'p90': percentile(values, 0.9) * scale,
+		'p99': percentile(values, 0.99) * scale,
+		'max': max(values) * scale,
+	}
+
+def run(nodes=1000, lookups=500, topics=200, contacts=20, neighbors=8, latency=0.02, jitter=0.01, loss=0.0, concurrency=16, seed=1):
+	loop = VirtualClockLoop()
+	network = SimNetwork(loop, latency, jitter, loss, seed)
+	started = time.perf_counter()
+	all_nodes, topic_ids = build(network, nodes, contacts, neighbors, topics, seed)
+	built = time.perf_counter()
+	try:
+		results = loop.run_until_complete(run_lookups(loop, all_nodes, topic_ids, lookups, concurrency, seed))
+	finally:
+		loop.close()
+	finished = time.perf_counter()
+
+	found = [result for result, _ in results if result.found]
+	return {
+		'nodes': nodes,
+		'lookups': lookups,
+		'topics': topics,
+		'contacts': contacts,
+		'neighbors': neighbors,
+		'latency_ms': latency * 1000,
+		'jitter_ms': jitter * 1000,
+		'loss': loss,
+		'concurrency': concurrency,
+		'seed': seed,
+		'found_ratio': len(found) / max(1, len(results)),
+		'lookup_latency_ms': summary([elapsed for _, elapsed in results], 1000),
+		'hops': summary([result.hops for result, _ in results]),
+		'messages_per_lookup': summary([result.messages for result, _ in results]),
+		'timeouts_per_lookup': summary([result.timeouts for result, _ in results]),
+		'datagrams': network.datagrams,
+		'dropped': network.dropped,
+		'simulated_seconds': loop.clock,
+		'build_seconds': built - started,
+		'wall_seconds': finished - built,
+	}
+
+def parse_arguments(argv):
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--nodes', type=int, default=1000)
+	parser.add_argument('--lookups', type=int, default=500)
+	parser.add_argument('--topics', type=int, default=200)
+	parser.add_argument('--contacts', type=int, default=20, help='random contacts per node')
+	parser.add_argument('--neighbors', type=int, default=8, help='closest nodes known by each node')
+	parser.add_argument('--latency', type=float, default=0.02, help='seconds')
+	parser.add_argument('--jitter', type=float, default=0.01, help='seconds')
+	parser.add_argument('--loss', type=float, default=0.0, help='fraction of datagrams dropped')
+	parser.add_argument('--concurrency', type=int, default=16)
+	parser.add_argument('--seed', type=int, default=1)
+	return parser.parse_args(argv)
+
+if __name__ == '__main__':
+	print(json.dumps(run(**vars(parse_arguments(sys.argv[1:]))), indent=2))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#encoding: utf-8
+
+""" Wire format benchmark: bytes per message and decode time """
+""" Run from repository root: python -m benchmarks.protocol_bench """
+
+import json
+import base64
+import timeit
+from app.constants import WIRE_TEXT, WIRE_BINARY
+from app.protocol import *
+
+SAMPLES = {
+	'PING': Message(OP_PING, '493b1310', 5000, ping_port=40000),
+	'GET': Message(OP_GET, '493b1310', 5000, topic='87f1640e', origin='2a5c9d01'),
+	'TOP': Message(OP_TOP, '493b1310', 5000, topic='87f1640e', data='2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824', origin='2a5c9d01'),
+	'INFO': Message(OP_INFO, '493b1310', 5000, topic='87f1640e', origin='493b1310'),
+}
+
+def legacy_decode(datagram):
+	""" Previous parsing: decode, substring classification, one split per field """
+	message = base64.b64decode(datagram).decode('ASCII')
+	for keyword in ('ID', 'WHO', 'PING', 'GET', 'TOP', 'FOR', 'NOP', 'ROUT', 'INFO'):
+		keyword in message
+	properties = message.split('|')
+	sender_id, sender_port = properties[1], properties[3]
+	return sender_id, sender_port, message.split('|')[-1], message.split('|')[-3]
+
+def measure(function, datagram, number):
+	return min(timeit.repeat(lambda: function(datagram), number=number, repeat=5)) / number * 1e6
+
+def run(number=20000):
+	results = {}
+	for name, message in SAMPLES.items():
+		text = encode(message, WIRE_TEXT)
+		binary = encode(message, WIRE_BINARY)
+		results[name] = {
+			'text_bytes': len(text),
+			'binary_bytes': len(binary),
+			'legacy_parse_us': measure(legacy_decode, text, number),
+			'text_decode_us': measure(decode, text, number),
+			'binary_decode_us': measure(decode, binary, number),
+		}
+	return results
+
+if __name__ == '__main__':
+	print(json.dumps(run(), indent=2))
@@ -19,6 +19,162 @@ ip_address = '127.0.0.1'
 """ If distance_from_me(topic) < interest_radius : store """
 interest_radius = 5
 
+""" Routing table maintenance """
+""" Contacts met while their bucket is full, kept per bucket to replace dead ones """
+replacement_cache_size = 8
+""" Seconds a contact has to answer a liveness ping, resent within it as timeouts expire """
+contact_check_timeout = 1.0
+""" Seconds without activity before a bucket is refreshed """
+bucket_refresh_interval = 3600.0
+""" Seconds without news before a contact is tried after fresher ones """
+contact_stale_after = 900.0
+""" Unanswered queries in a row before a contact is evicted """
+contact_max_failures = 3
+
+""" Round trip time, smoothed per contact (SRTT / RTTVAR as TCP), request timeouts derive from it """
+""" Seconds to wait for a contact never measured """
+rtt_initial_timeout = 0.5
+""" Bounds (seconds) of a derived timeout, backoff included """
+rtt_min_timeout = 0.05
+rtt_max_timeout = 5.0
+""" Unanswered request is sent again this many times, timeout doubles each time """
+request_retries = 2
+""" Forwarded GET crosses several hops, it waits this many times first hop timeout """
+forward_timeout_factor = 4
+""" Closest contacts compared on round trip time when they share XOR prefix length with the target """
+rtt_tie_candidates = 3
+
+""" Topic store byte budget, least recently used topics are evicted above it """
+topic_store_max_bytes = 64 * 1024 * 1024
+
+""" Segment store: published content and replicas in append-only files under data/<id>/segments """
+""" Memory keeps an index, values are read from mapped files; off keeps values in memory """
+""" and a SHA-256 of published content """
+topic_segments = False
+""" Byte budget of a segment store """
+segment_store_max_bytes = 64 * 1024 * 1024 * 1024
+""" A segment is closed and a new one started past this size (bytes) """
+segment_max_bytes = 64 * 1024 * 1024
+""" Sealed segments with this fraction of overwritten or deleted bytes are compacted """
+segment_garbage_ratio = 0.5
+""" Live bytes copied per run loop iteration by compaction """
+segment_compact_bytes = 4 * 1024 * 1024
+
+""" File ingestion (add file): published topic value is the SHA-256 of the file, read and hashed chunk by chunk """
+""" Bytes read at a time """
+ingest_chunk_bytes = 1024 * 1024
+""" Hashing threads, hashlib releases the GIL on large chunks so reading the next one overlaps hashing """
+ingest_threads = 2
+
+""" Replication """
+""" Closest nodes a published topic is stored at """
+replication_factor = 8
+""" Seconds a replica is kept without being republished """
+topic_expiry = 86400.0
+""" Seconds between two republications of our own topics """
+republish_interval = 3600.0
+""" Found values are cached at the closest nodes on the lookup path that did not have them """
+cache_path_nodes = 2
+""" Seconds a cached copy is kept, halved per bit of XOR distance past the holder """
+cache_ttl = 3600.0
+cache_min_ttl = 60.0
+
+""" Iterative lookup """
+""" Concurrent queries per lookup round """
+lookup_alpha = 3
+""" Shortlist size, closest contacts returned by a peer """
+lookup_k = 20
+""" Seconds before a whole lookup gives up """
+lookup_timeout = 5.0
+""" Lookup results kept, LRU evicted """
+lookup_cache_size = 4096
+""" Seconds a found topic is answered from cache """
+lookup_cache_ttl = 60.0
+""" Seconds a not found topic is answered from cache """
+lookup_negative_ttl = 5.0
+
+""" Chunked transfer """
+""" Values longer than this (bytes) are sent as a chunked transfer """
+chunk_threshold = 1024
+""" Payload bytes per chunk datagram """
+chunk_size = 1024
+""" Chunks in flight, and chunks buffered by a streaming reader """
+chunk_window = 32
+""" Seconds before an unacknowledged chunk is sent again """
+chunk_rto = 0.2
+""" Retransmission rounds without any ACK before sender gives up """
+chunk_max_retries = 10
+""" Seconds without any chunk before receiver gives up """
+chunk_transfer_timeout = 5.0
+""" Largest value (bytes) received whole, its buffer is allocated on first chunk; larger transfers are dropped """
+chunk_max_total = 64 * 1024 * 1024
+
+""" Wire format used with peers that did not talk to us yet """
+""" WIRE_TEXT = pipe delimited base64, understood by every node """
+""" WIRE_BINARY = compact binary, peers answer in the format they received """
+default_wire_format = WIRE_TEXT
+
+""" Bootstrap """
+""" Where seeds come from on a cold start: http(s) URL, file path (ID|IP|PORT separated by ; or new lines), list of ID|IP|PORT, or '' for none """
+bootstrap_source = 'https://pastebin.com/raw/WLSsLHfh'
+""" Seconds before a remote bootstrap source is given up """
+bootstrap_fetch_timeout = 5.0
+""" Recently seen contacts kept on disk, to start without the bootstrap source """
+seed_cache_size = 32
+""" Persisted contacts pinged in background on a warm start """
+warm_start_checks = 64
+
+""" Transport """
+""" Outbound datagrams queued before dropping """
+max_send_queue = 4096
+""" Datagrams sent / received per loop iteration """
+send_batch_size = 64
+
+""" Inbound admission, datagrams from the socket only """
+""" Decoded messages waiting to be handled """
+max_receive_queue = 1024
+""" Datagrams read from the socket per loop iteration, at most send_batch_size are handled """
+receive_batch_size = 256
+""" Full queue sheds a request: 'drop_oldest' the longest waiting one, 'drop_new' the arriving one """
+""" Answers to our own requests are handled first and only dropped when queue holds nothing else """
+receive_drop_policy = 'drop_oldest'
+""" Requests per second and burst, per peer and message type, types not listed are not limited """
+rate_limits = {'WHO': (5.0, 10), 'PING': (20.0, 40), 'GET': (50.0, 100), 'FIND': (50.0, 100), 'INFO': (20.0, 40), 'STORE': (20.0, 40), 'STATS': (1.0, 5)}
+""" Peer a rate limit applies to: 'ip', 'address' (IP and port) or 'id' (announced node ID, can be spoofed) """
+rate_limit_key = 'ip'
+""" Peers tracked by the rate limiter, least recently seen are forgotten first """
+rate_limit_peers = 65536
+
+""" Worker processes sharing one node port, 0 = one per core """
+worker_count = 0
+
+""" Persistence """
+""" Routing table changes buffered before the journal is written """
+journal_flush_count = 64
+""" Max age (seconds) of buffered journal records """
+journal_flush_interval = 1.0
+""" Journal records before compaction into kbuckets.json snapshot """
+journal_compact_records = 10000
+
+""" Logging """
+""" DEBUG logs every message handled and sent, INFO keeps the hot path free of formatting """
+log_level = 'INFO'
+""" Level per category (node, message, kbucket, lookup, transfer, store, journal, transport), e.g. {'kbucket': 'DEBUG'} """
+log_levels = {}
+""" Keep one record out of N per category below WARNING, e.g. {'message': 100} """
+log_sample_rates = {}
+log_format = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+""" Metrics """
+""" Count messages and time handlers, off leaves a single check on the hot path """
+metrics_enabled = True
+""" Prometheus text dump, empty to disable, {id} is replaced by node ID """
+metrics_file = ''
+""" Seconds between two dumps """
+metrics_dump_interval = 10.0
+""" Peers allowed to query stats over UDP """
+stats_allowed_addresses = ['127.0.0.1']
+
 """ Security configuration """
 """ Answer PING """
 """ 0 = Never """
@@ -2,20 +2,25 @@
 #encoding: utf-8
 
 import os
-from app.node import Node
 import sys
+from app.log import setup_logging
+from data.config import id_length
 
-print(sys.argv)
+""" Engines are imported by the command using them, short commands start fast """
+
+setup_logging()
 if len(sys.argv) > 1:
 	command = sys.argv[1]
 	if command == 'who':
 		""" Get node id corresponding to ip/port """
+		from app.node import Node
 		my_node = Node()
 		target_ip = sys.argv[2]
 		target_port = int(sys.argv[3])
 		my_node.send_presentation_request((target_ip, target_port))
 	elif command == 'ping':
 		""" Send ping request """
+		from app.node import Node
 		my_node = Node()
 		target_ip = sys.argv[2]
 		target_port = int(sys.argv[3])
@@ -25,31 +30,104 @@ if len(sys.argv) > 1:
 			print("Offline")
 	elif command == 'get':
 		""" Get topic """
+		from app.node import Node
 		my_node = Node()
 		my_node.get_topic(sys.argv[2])
 		""" Run node and wait for response """
 		my_node.run()
+	elif command == 'stats':
+		""" Query metrics of a running node """
+		""" stats IP PORT [prometheus] """
+		import json
+		import asyncio
+		from app.async_node import AsyncNode
+		from app.metrics import prometheus_text
+		my_node = AsyncNode(node_id=os.urandom(id_length).hex(), port=0)
+		async def query_stats():
+			await my_node.start()
+			try:
+				return await my_node.query_stats((sys.argv[2], int(sys.argv[3])))
+			finally:
+				my_node.close()
+		snapshot = asyncio.run(query_stats())
+		if snapshot is None:
+			print("No answer")
+		elif 'prometheus' in sys.argv[4:]:
+			print(prometheus_text(snapshot), end='')
+		else:
+			print(json.dumps(snapshot, indent=2))
+	elif command == 'loadgen':
+		""" Open loop PING/GET/INFO load against a running node """
+		""" loadgen IP PORT [--rates RATE ...] [--duration SECONDS] [--mix PING=1,GET=8,INFO=1] [--keys N] [--skew uniform|zipf] """
+		from benchmarks import loadgen
+		loadgen.main(sys.argv[2:])
 	elif command == 'add':
+		from app.node import Node
 		if sys.argv[2] == 'contact':
 			""" Add contact """
 			my_node = Node()
-			my_node.register_contact(sys.argv[3], sys.argv[4], sys.argv[5])
+			my_node.kbuckets.register_contact(sys.argv[3], sys.argv[4], int(sys.argv[5]))
+			my_node.flush_storage()
 		if sys.argv[2] == 'topic':
-			""" Add contact """
+			""" Add topic """
 			my_node = Node()
 			my_node.add_topic(topic_id=sys.argv[3], data=sys.argv[4])
 			my_node.run()
+		if sys.argv[2] == 'file':
+			""" Publish SHA-256 of a file of any size, add file PATH [TOPIC_ID] """
+			""" Topic ID defaults to a prefix of the hash """
+			my_node = Node()
+			digest = my_node.add_file(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+			my_node.flush_storage()
+			print("Topic", sys.argv[4] if len(sys.argv) > 4 else digest.topic_id(), digest.sha256)
+			print("%d bytes in %.3fs, %.1f MB/s" % (digest.size, digest.seconds, digest.mb_per_second()))
+		if sys.argv[2] in ('topics', 'contacts'):
+			""" Bulk import, add topics|contacts FILE """
+			""" JSON lines ({"id", "data"} / {"id", "ip", "port"}) or CSV in the same field order """
+			from app.importer import read_records
+			my_node = Node()
+			if sys.argv[2] == 'topics':
+				count = my_node.add_topics(read_records(sys.argv[3], ('id', 'data')))
+			else:
+				count = my_node.kbuckets.register_contacts(read_records(sys.argv[3], ('id', 'ip', 'port')))
+			my_node.flush_storage()
+			print(count, sys.argv[2], "added")
 	elif command == 'init':
 		""" Pass full path to a kbuckets.json file """
+		from app.node import Node
 		my_node = Node()
 		my_node.run(sys.argv[2])
 	elif command == 'specific':
 		""" Pass full path to a kbuckets.json file """
+		from app.node import Node
 		my_node = Node(node_id=sys.argv[2], port=sys.argv[3])
 		my_node.run()
 	elif command == 'port':
-		my_node = Node(node_id=os.urandom(4).hex(), port=sys.argv[2])
+		from app.node import Node
+		my_node = Node(node_id=os.urandom(id_length).hex(), port=sys.argv[2])
+		my_node.run()
+	elif command == 'async':
+		""" Run node on asyncio event loop """
+		from app.async_node import AsyncNode
+		port = sys.argv[2] if len(sys.argv) > 2 else 0
+		my_node = AsyncNode(node_id=os.urandom(id_length).hex(), port=port)
 		my_node.run()
+	elif command == 'workers':
+		""" Run node on several cores, workers share UDP port """
+		""" workers [COUNT] [PORT], count 0 = one per core """
+		from app.workers import WorkerHost
+		count = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+		port = sys.argv[3] if len(sys.argv) > 3 else 0
+		host = WorkerHost(node_id=os.urandom(id_length).hex(), port=port, workers=count)
+		host.run()
+	elif command == 'host':
+		""" Run many node identities in this process """
+		""" host COUNT [FIRST PORT] """
+		from app.host import VirtualHost
+		port = sys.argv[3] if len(sys.argv) > 3 else 0
+		host = VirtualHost(count=int(sys.argv[2]), port=port)
+		host.run()
 else:
+	from app.node import Node
 	my_node = Node()
 	my_node.run()